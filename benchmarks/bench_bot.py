@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Benchmark a WrexBot end to end against a local IRC server stand-in.
+
+Each scenario (see fake_ircd.py) is served by a FakeServer running in its own
+process to a fresh bot connected over localhost, and reports:
+    * lines/sec: lines handled per second, from the first line sent to the
+      PONG of a PING sent after the last one.
+    * PING latency: time from a PING being sent to its PONG being received,
+      while the bot is busy with the lines around it.
+    * handler cost: time spent per call in built-in and plugin handlers,
+      dispatch included (so on_privmsg includes the plugins it calls).
+    * peak memory: maximum resident set size of the bot process.
+
+Usage: python benchmarks/bench_bot.py [-n lines] [-p Plugin,...] [scenario ...]
+
+"""
+
+import argparse
+import functools
+import inspect
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+WREXBOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'wrexbot')
+sys.path.insert(0, WREXBOT_DIR)
+
+import log
+from core import WrexBot
+from eventloop import EventLoop
+from fake_ircd import FakeServer, SCENARIOS, percentile, script
+
+
+def handler_name(handler):
+    """'Class.method' of the class defining handler, e.g. 'Shepard.privmsg'."""
+    owner = getattr(handler, '__self__', None)
+    if owner is None:
+        return handler.__name__
+    for cls in inspect.getmro(owner.__class__):
+        if handler.__name__ in vars(cls):
+            return '{}.{}'.format(cls.__name__, handler.__name__)
+    return '{}.{}'.format(owner.__class__.__name__, handler.__name__)
+
+
+class TimedBot(WrexBot):
+    """WrexBot measuring the time spent in each handler."""
+    def __init__(self, *args, **kwargs):
+        self.costs = {}  # handler name -> [calls, seconds]
+        WrexBot.__init__(self, *args, **kwargs)
+        for plugin in self.plugins:
+            for commands in (plugin.commands, plugin.user_commands):
+                for command, handler in commands.items():
+                    if callable(handler):
+                        commands[command] = self.timed(handler)
+
+    def load_plugin(self, plugin_class, lazy=False):
+        # Plugins are created right away, so that imports are not measured
+        return WrexBot.load_plugin(self, plugin_class, lazy=False)
+
+    def record(self, name, elapsed):
+        cost = self.costs.setdefault(name, [0, 0.0])
+        cost[0] += 1
+        cost[1] += elapsed
+
+    def timed(self, handler):
+        name = handler_name(handler)
+
+        @functools.wraps(handler)  # keeps workers.offload marks
+        def wrapper(*args):
+            start = time.time()
+            try:
+                return handler(*args)
+            finally:
+                self.record(name, time.time() - start)
+        return wrapper
+
+    def run_handler(self, handler, message, *args):
+        start = time.time()
+        WrexBot.run_handler(self, handler, message, *args)
+        self.record(handler_name(handler), time.time() - start)
+
+
+def serve(server, lines, results):
+    results.send(server.serve(lines))
+
+
+def run(scenario, size, plugins, ping_every):
+    """Serve a fresh bot with scenario, return (server results, bot)."""
+    server = FakeServer()
+    results, child_results = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=serve, args=(server, script(scenario, size, ping_every),
+                            child_results))
+    process.start()
+    server.listener.close()  # the child process owns it
+    bot = TimedBot('WrexBench', channels=['#bench'], plugins_to_load=plugins,
+                   admins=['bench!*@bench.local'], loop=EventLoop(),
+                   store=':memory:')  # no state kept between runs
+    bot.auto_reconnect = False  # the run ends when the server hangs up
+    bot.shepardify(*server.address)
+    result = results.recv()
+    process.join()
+    bot.loop.map.clear()
+    return result, bot
+
+
+def report(scenario, result, bot):
+    latencies = [l * 1000 for l in result['latencies']]
+    print '{}: {:,} lines, {:.1f} MB{}'.format(
+        scenario, result['lines'], result['bytes'] / 1e6,
+        '' if result['completed'] else ' (NOT COMPLETED)')
+    print '  {:>12,.0f} lines/sec'.format(result['lines'] / result['elapsed'])
+    print '  PING latency (ms): p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}'\
+        .format(*[percentile(latencies, p) for p in (50, 90, 99, 100)])
+    print '  {:<32} {:>9} {:>12} {:>9}'.format('handler', 'calls', 'us/call',
+                                                'total s')
+    for name, (calls, seconds) in sorted(bot.costs.items(),
+                                         key=lambda item: -item[1][1]):
+        print '  {:<32} {:>9,} {:>12.2f} {:>9.3f}'.format(
+            name, calls, seconds / calls * 1e6, seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', default=sorted(SCENARIOS),
+                        help='scenario names or files of raw lines '
+                             '(default: every scenario)')
+    parser.add_argument('-n', '--lines', type=int, default=20000,
+                        help='lines per scenario (default: 20000)')
+    parser.add_argument('-p', '--plugins', default='Shepard,Admin',
+                        help='plugins to load (default: Shepard,Admin)')
+    parser.add_argument('--ping-every', type=int, default=500,
+                        help='lines between two PINGs (default: 500)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show logs and messages instead of discarding them')
+    args = parser.parse_args()
+    scenarios = [s if s in SCENARIOS else os.path.abspath(s)
+                 for s in args.scenarios]
+    os.chdir(WREXBOT_DIR)  # where plugins keep their files
+
+    if not args.verbose:
+        # Console messages are still formatted and written, but to /dev/null
+        devnull = open(os.devnull, 'w')
+        log.setup(logging.WARNING, stream=devnull)
+        console = logging.getLogger(log.CONSOLE)
+        console.addHandler(log.async_handler(log.StreamWriter(
+            devnull, log.Formatter('[%(asctime)s] %(message)s'))))
+        console.setLevel(logging.INFO)
+        console.propagate = False
+    else:
+        log.setup(logging.DEBUG)
+
+    start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for scenario in scenarios:
+        result, bot = run(scenario, args.lines, args.plugins.split(','),
+                          args.ping_every)
+        report(scenario, result, bot)
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes instead of kilobytes
+        start_memory, peak_memory = start_memory // 1024, peak_memory // 1024
+    print 'Peak memory: {:,} kB (started at {:,} kB)'.format(peak_memory,
+                                                             start_memory)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Benchmark IRC line parsing on a JOIN/NAMES/PRIVMSG burst.
+
+Compares message.parse with the split-based parsing found_terminator used to
+do (and which every plugin then did again on msg).
+
+Usage: python benchmarks/bench_parser.py [number_of_lines]
+
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'wrexbot'))
+
+from message import parse
+
+
+def legacy_parse(data):
+    """Parsing as done by WrexBot.found_terminator before message.py."""
+    if data.startswith(':'):
+        sender, data = data.split(' ', 1)
+        sender = sender[1:].split('!', 1)[0]
+    else:
+        sender = ''
+    try:
+        parts, msg = data.split(' :', 1)
+    except ValueError:
+        parts = data
+        msg = ''
+    parts = parts.split(' ')
+    return sender, parts[0], parts[1:], msg
+
+
+def legacy_parse_hostmask(data):
+    """legacy_parse, keeping user@host and tags as message.parse does."""
+    tags = ''
+    if data.startswith('@'):
+        tags, data = data.split(' ', 1)
+    if data.startswith(':'):
+        prefix, data = data.split(' ', 1)
+        nick, _, host = prefix[1:].partition('@')
+        nick, _, user = nick.partition('!')
+    else:
+        nick = user = host = ''
+    try:
+        parts, msg = data.split(' :', 1)
+    except ValueError:
+        parts = data
+        msg = ''
+    parts = parts.split(' ')
+    return tags, nick, user, host, parts[0], parts[1:], msg
+
+
+def burst(size):
+    """Return a list of size lines looking like a busy channel."""
+    names = ' '.join('@nick{0} +user{0} guest{0}'.format(i) for i in range(40))
+    lines = [
+        ':nick{0}!~user{0}@host-{0}.example.net JOIN #channel',
+        ':irc.example.net 353 WrexBot = #channel :' + names,
+        ':nick{0}!~user{0}@host-{0}.example.net PRIVMSG #channel :Shepard! '
+        'Wrex. Shepard! Wrex. Shepard! Wrex.',
+        '@time=2013-06-01T12:00:00.000Z;account=nick{0} '
+        ':nick{0}!~user{0}@host-{0}.example.net PRIVMSG #channel :hodor',
+        'PING :irc.example.net',
+    ]
+    return [lines[i % len(lines)].format(i) for i in range(size)]
+
+
+def bench(function, lines, repeat=5):
+    """Return best lines/sec of function over lines."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for line in lines:
+            function(line)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = burst(size)
+    for name, function in [('legacy split', legacy_parse),
+                           ('legacy hostmask', legacy_parse_hostmask),
+                           ('message.parse', parse)]:
+        print '{:<16} {:>12,.0f} lines/sec'.format(name, bench(function, lines))
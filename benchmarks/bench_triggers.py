@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Check and benchmark Shepard triggers matching on random messages.
+
+Compares trigger_engine.TriggerEngine with the regexes Shepard.privmsg used
+to run (with re.U, on the decoded message): answers must be identical,
+accented messages included ('il a nié', 'Niçoise', 'hodorà'...), then both
+are timed.
+
+Usage: python benchmarks/bench_triggers.py [number_of_messages]
+
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'wrexbot', 'plugins')
+sys.path.insert(0, PLUGINS_DIR)
+
+from trigger_engine import TriggerEngine, decode
+
+LEGACY = [
+    (re.compile(r'(?<!\w)(Wrex|Shepard)(?!\w).*?([\W1_]+)?$', re.I | re.U),
+     lambda word: 'Shepard' if word.lower() == u'wrex' else 'Wrex', '.'),
+    (re.compile(r'(?<!\w)(Ni)(?!\w).*?([\W1_]+)?$', re.I | re.U),
+     lambda word: 'Ekke ekke ekke ekke ptangya ziiinnggggggg ni', '!'),
+    (re.compile(r'(?<!\w)(Hodor(?:(?:at)?ing|e(?:u)?r)?)(?!\w).*?([\W1]+)?$',
+                re.I | re.U), None, None),
+]
+WORDS = ['wrex', 'Wrex', 'WREX', 'shepard', 'Shepard', 'SHEPARD', 'ni', 'Ni',
+         'NI', 'hodor', 'Hodoring', 'HODORER', 'nié', 'Niçoise', 'hodorà',
+         'éni', 'là', 'déjà', 'ça', 'the', 'of', 'niche', 'wrexy', '_ni',
+         'ni1', '«', '»', '…', '–', 'é', 'ひ']
+TERMS = ['', '', '.', '!', '?', '!!!111', ' !', '...', '…', ' ?!', '_', ' é',
+         ' à', '»']
+
+
+def messages(count, seed=42):
+    """Return count random utf-8 messages, a few of them in latin-1."""
+    rng = random.Random(seed)
+    texts = []
+    for i in xrange(count):
+        text = ' '.join(rng.choice(WORDS) for _ in xrange(rng.randint(1, 8)))
+        text += rng.choice(TERMS)
+        if not i % 50:
+            text = text.decode('utf-8').encode('latin-1', 'replace')
+        texts.append(text)
+    return texts
+
+
+def legacy_answers(msg):
+    """Answers of the legacy regexes ('HODOR' for the hodor handler)."""
+    msg, encoding = decode(msg)
+    answers = []
+    for regex, response, default_term in LEGACY:
+        match = regex.search(msg)
+        if match is None:
+            continue
+        if response is None:
+            answers.append('HODOR')
+            continue
+        word, term = match.groups()
+        answer = response(word)
+        if word.isupper():
+            answer = answer.upper()
+        answers.append(answer + (term.encode(encoding) if term is not None
+                                 else default_term))
+    return answers
+
+
+def engine_answers(engine, msg):
+    """Answers of engine, as Shepard.privmsg sends them."""
+    return ['HODOR' if trigger.handler is not None
+            else trigger.answer(word, term)
+            for trigger, word, term in engine.search(msg)]
+
+
+def bench(function, texts, repeat=3):
+    """Return best messages/sec of function over texts."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for text in texts:
+            function(text)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(texts) / best
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    engine = TriggerEngine.from_file(os.path.join(PLUGINS_DIR, 'shepard.json'))
+    texts = messages(count)
+    different = [text for text in texts
+                 if legacy_answers(text) != engine_answers(engine, text)]
+    print '{:,} messages, {:,} answered, {:,} different answers'.format(
+        len(texts), sum(1 for text in texts if legacy_answers(text)),
+        len(different))
+    for text in different[:10]:
+        print '  {!r}: {!r} != {!r}'.format(text, legacy_answers(text),
+                                             engine_answers(engine, text))
+    for name, function in [('legacy regexes', legacy_answers),
+                           ('TriggerEngine',
+                            lambda text: engine_answers(engine, text))]:
+        print '{:<16} {:>12,.0f} messages/sec'.format(name,
+                                                        bench(function, texts))
+    sys.exit(1 if different else 0)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for web sites, serving pages to the UrlTitle plugin.
+
+Connections are kept alive (HTTP/1.1), and every request is printed with
+the number of the connection it came on, to check connections are reused:
+
+    python benchmarks/fake_httpd.py 8000
+
+Pages:
+    /title/<text>      page titled text
+    /huge/<text>       page titled text, followed by a body of 10 MB
+    /chunked/<text>    page titled text, with chunked transfer encoding
+    /slow/<seconds>    page sent after seconds
+    /redirect/<path>   redirection to /path
+    /image             PNG image
+    anything else      404
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import sys
+import threading
+import time
+import urllib
+
+HUGE = 10 * 1024 * 1024
+
+
+def page(title, body=''):
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            '<title>{}</title></head><body>{}</body></html>\n'.format(title, body))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    connections = itertools.count(1)
+    lock = threading.Lock()
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.lock:
+            self.connection_number = next(self.connections)
+
+    def log_message(self, format, *args):
+        print 'connection {} {}'.format(self.connection_number, format % args)
+
+    def send(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.partition('?')[0]
+        _, kind, arg = (path.split('/', 2) + ['', ''])[:3]
+        arg = urllib.unquote(arg)
+        if kind == 'title':
+            self.send(200, 'text/html; charset=utf-8', page(arg))
+        elif kind == 'huge':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            head = page(arg)
+            self.send_header('Content-Length', str(len(head) + HUGE))
+            self.end_headers()
+            try:  # the client hangs up once it has the title
+                self.wfile.write(head)
+                for _ in xrange(HUGE // 65536):
+                    self.wfile.write(' ' * 65536)
+            except IOError:
+                self.close_connection = 1
+        elif kind == 'chunked':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in xrange(0, len(page(arg)), 16):
+                chunk = page(arg)[i:i + 16]
+                self.wfile.write('{:x}\r\n{}\r\n'.format(len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        elif kind == 'slow':
+            time.sleep(float(arg or 1))
+            self.send(200, 'text/html', page('Slow page'))
+        elif kind == 'redirect':
+            self.send(302, 'text/html', '', [('Location', '/' + arg)])
+        elif kind == 'image':
+            self.send(200, 'image/png', '\x89PNG\r\n\x1a\n' + '\0' * 1024)
+        else:
+            self.send(404, 'text/html', page('Not Found'))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], IOError):  # client hung up
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+def main(argv):
+    port = int(argv[1]) if len(argv) > 1 else 8000
+    server = Server(('127.0.0.1', port), Handler)
+    print 'Serving on http://127.0.0.1:{}/'.format(server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for an IRC server, driving a bot with scripted traffic.
+
+The server accepts a single connection, answers the NICK/USER registration
+with a welcome, then sends the lines of a script as fast as the bot reads
+them. PINGs found in the script are timed until the bot PONGs them back, and
+a last PING tells when the bot has handled every line.
+
+Scripts are lists of raw lines (without line endings). The scenarios below
+generate typical ones, and any file of raw lines can be used as well:
+
+    python benchmarks/fake_ircd.py 6667 flood   # serve a bot on port 6667
+    python benchmarks/fake_ircd.py 6667 my_lines.txt
+
+"""
+
+import socket
+import sys
+import threading
+import time
+
+SERVER = 'irc.bench.local'
+CHANNEL = '#bench'
+END = 'bench-end'
+
+
+def hostmask(i):
+    return 'nick{0}!~user{0}@host-{0}.bench.local'.format(i % 1000)
+
+
+def flood(size):
+    """PRIVMSG flood, a third of them triggering Shepard."""
+    texts = ['Shepard!', 'nothing to see here, move along',
+             'I heard Wrex is around, is that right?']
+    return [':{} PRIVMSG {} :{}'.format(hostmask(i), CHANNEL, texts[i % 3])
+            for i in xrange(size)]
+
+
+def names(size):
+    """JOIN bursts, as after a netsplit, with NAMES replies."""
+    lines = []
+    for i in xrange(size):
+        if i % 50 == 49:
+            nicks = ' '.join('@nick{0} +nick{1} nick{2}'.format(j, j + 1, j + 2)
+                             for j in xrange(i - 49, i, 3))
+            lines.append(':{} 353 {{nick}} = {} :{}'.format(SERVER, CHANNEL, nicks))
+        elif i % 50 == 48:
+            lines.append(':{} 366 {{nick}} {} :End of /NAMES list.'.format(
+                SERVER, CHANNEL))
+        else:
+            lines.append(':{} JOIN {}'.format(hostmask(i), CHANNEL))
+    return lines
+
+
+def long_lines(size):
+    """PRIVMSG using the whole 512 bytes of an IRC line."""
+    lines = []
+    for i in xrange(size):
+        line = ':{} PRIVMSG {} :'.format(hostmask(i), CHANNEL)
+        words = 'the quick brown fox jumps over the lazy dog shepard '
+        line += (words * 10)[:510 - len(line)]
+        lines.append(line)
+    return lines
+
+
+def encodings(size):
+    """PRIVMSG in utf-8, latin-1, cp1252 and shift_jis."""
+    texts = [u'Wrex, ça va ? Shepard !'.encode('utf-8'),
+             u'Wrex, ça va ? Shepard !'.encode('latin-1'),
+             u'“Shepard” – Wrex…'.encode('cp1252'),
+             u'シェパード Wrex'.encode('shift_jis')]
+    return [':{} PRIVMSG {} :{}'.format(hostmask(i), CHANNEL, texts[i % 4])
+            for i in xrange(size)]
+
+
+def commands(size):
+    """Custom commands, from users and from the bench admin."""
+    texts = ['!help', '!admins', '!unknown command', '!ignores']
+    return [':{} PRIVMSG {} :{}'.format('bench!~bench@bench.local' if i % 2
+                                        else hostmask(i), CHANNEL, texts[i % 4])
+            for i in xrange(size)]
+
+
+def mixed(size):
+    """Every other scenario, interleaved."""
+    parts = [scenario(size // len(OTHERS) + 1) for scenario in OTHERS]
+    lines = [line for group in zip(*parts) for line in group]
+    return lines[:size]
+
+
+OTHERS = [flood, names, long_lines, encodings, commands]
+SCENARIOS = dict((f.__name__, f) for f in OTHERS + [mixed])
+
+
+def script(scenario, size, ping_every=500):
+    """Lines of scenario (a name from SCENARIOS or a file of raw lines),
+    with a PING every ping_every lines."""
+    if scenario in SCENARIOS:
+        lines = SCENARIOS[scenario](size)
+    else:
+        with open(scenario, 'rb') as script_file:
+            lines = script_file.read().splitlines()
+    timed = []
+    for i, line in enumerate(lines):
+        if ping_every and i % ping_every == 0:
+            timed.append('PING :bench-{}'.format(i))
+        timed.append(line)
+    return timed
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return float('nan')
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class FakeServer(object):
+    """IRC server stand-in serving one connection with a script."""
+    def __init__(self, host='127.0.0.1', port=0, chunk_size=64 * 1024):
+        """Listen on host:port (default: any free port, see self.address)."""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.chunk_size = chunk_size
+
+    def serve(self, lines, timeout=60.0):
+        """Serve a bot with lines, return the measures as a dict.
+
+        :param lines: raw lines to send once the bot is registered, '{nick}'
+                      being replaced by its nickname
+        :type lines: list of string
+        :keyword timeout: seconds to wait for the bot (default=60.0)
+        :type timeout: float
+
+        """
+        self.listener.settimeout(timeout)
+        connection, _ = self.listener.accept()
+        connection.settimeout(None)
+        self.connection = connection
+        self.nick = None
+        self.registered = threading.Event()
+        self.done = threading.Event()
+        self.completed = False
+        self.pings = {}  # token -> time sent
+        self.latencies = []
+        self.received = {}  # command -> count
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+
+        self.registered.wait(timeout)
+        lines = [line.replace('{nick}', self.nick or '*') for line in lines]
+        size = len(lines)
+        start = time.time()
+        self._send(lines)
+        self.pings[END] = time.time()
+        connection.sendall('PING :{}\r\n'.format(END))
+        self.done.wait(timeout)
+        elapsed = time.time() - start
+        connection.close()
+        return {
+            'lines': size,
+            'bytes': sum(len(line) + 2 for line in lines),
+            'elapsed': elapsed,
+            'completed': self.completed,
+            'latencies': sorted(self.latencies),
+            'received': self.received,
+        }
+
+    def _send(self, lines):
+        """Send lines in chunks, timing PINGs when their chunk is sent."""
+        chunk = []
+        chunk_bytes = 0
+        pings = []
+        for line in lines:
+            chunk.append(line)
+            chunk_bytes += len(line) + 2
+            if line.startswith('PING :'):
+                pings.append(line[6:])
+            if chunk_bytes >= self.chunk_size:
+                self._send_chunk(chunk, pings)
+                chunk, chunk_bytes, pings = [], 0, []
+        if chunk:
+            self._send_chunk(chunk, pings)
+
+    def _send_chunk(self, chunk, pings):
+        sent = time.time()
+        for token in pings:
+            self.pings[token] = sent
+        self.connection.sendall('\r\n'.join(chunk) + '\r\n')
+
+    def _read(self):
+        """Handle what the bot sends: registration, PONGs and the rest."""
+        buffer = ''
+        while not self.done.is_set():
+            try:
+                data = self.connection.recv(4096)
+            except socket.error:
+                break
+            if not data:
+                break
+            buffer += data
+            lines = buffer.split('\r\n')
+            buffer = lines.pop()
+            for line in lines:
+                command, _, params = line.partition(' ')
+                self.received[command] = self.received.get(command, 0) + 1
+                if command == 'NICK':
+                    self.nick = params
+                elif command == 'USER':
+                    self.connection.sendall(':{} 001 {} :Welcome to the bench\r\n'
+                                            .format(SERVER, self.nick))
+                    self.registered.set()
+                elif command == 'JOIN':  # tracked channels, see state.py
+                    self.connection.sendall(':{}!~bench@bench.local JOIN {}\r\n'
+                                            .format(self.nick, params))
+                elif command == 'PONG':
+                    token = params.lstrip(':')
+                    if token in self.pings:
+                        self.latencies.append(time.time() - self.pings.pop(token))
+                    if token == END:
+                        self.completed = True
+                        self.done.set()
+        self.done.set()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6667
+    scenario = sys.argv[2] if len(sys.argv) > 2 else 'mixed'
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    server = FakeServer(port=port)
+    print 'Waiting for a bot on {}:{}...'.format(*server.address)
+    result = server.serve(script(scenario, size))
+    print '{lines} lines in {elapsed:.2f}s'.format(**result)
@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 """Simple Python IRC bot written for fun."""
 
-import asyncore
 import asynchat
 import socket
 import sys
 import datetime
 import logging
+import os
+import random
 import re
+import time
+
+import log
+import metrics
+from eventloop import get_loop
+from hostmasks import HostmaskIndex
+from lru import LRUCache
+from message import parse
+from plugin_manager import PluginManager
+from sendqueue import SendQueue
+from state import StateTracker
+from store import get_store
+from workers import get_workers
 
 # Some RFC constants
 RPL_WELCOME = '001'
@@ -16,9 +30,66 @@ ERR_ERRONEUSNICKNAME = '432'
 ERR_NICKNAMEINUSE = '433'
 ERR_NICKCOLLISION = '436'
 
+# Lines length: 512 bytes with \r\n, including the ':nick!user@host ' prefix
+# servers add when relaying our messages (user is 10 bytes max, host 63)
+MAX_LINE = 512
+PREFIX_RESERVE = len(':!@ ') + 10 + 63
+NEWLINE = re.compile(r'\r\n?|\n')  # not unicode.splitlines: \x1d is italic
+
 # Some settings
-DATE_FORMAT = '%Y-%m-%d %H:%M:%S'  # Datetime format for logs and stdout
+DATE_FORMAT = log.DATE_FORMAT  # Datetime format for logs and stdout
 PLUGIN_DIR = 'plugins'  # Plugins directory
+STORE_FILE = 'wrexbot.db'  # Bots and plugins state (see store.py)
+DATA_DIR = 'data'  # Plugins files, in a directory per bot (see data_path)
+
+# Connection settings (seconds)
+RECONNECT_DELAY = 2.0  # first reconnection delay, doubled at each failure
+MAX_RECONNECT_DELAY = 300.0
+PING_INTERVAL = 30.0  # lag measurement: a PING every 30 seconds...
+PING_TIMEOUT = 60.0  # ...and no PONG (or no welcome) after 60 = dead
+NICK_RECOVERY_INTERVAL = 300.0  # attempts to take the main nick back
+LAG_TOKEN = 'wrexbot-lag'
+
+
+_clocks = {}  # strftime format -> log.Clock
+
+
+def split_text(text, budget, encode=str):
+    """Split text in encoded chunks of at most budget bytes.
+
+    Chunks end on a space when there is one in their second half, and never
+    in the middle of a character (as long as text is unicode).
+
+    :param text: text to split, unicode or bytes
+    :param budget: maximum size of an encoded chunk, in bytes
+    :type budget: int
+    :param encode: function encoding a piece of text (default=str)
+    :return: encoded chunks
+    :rtype: list of string
+
+    """
+    chunks = []
+    while text:
+        data = encode(text)
+        if len(data) <= budget:
+            chunks.append(data)
+            break
+        # Longest prefix fitting in budget, then last space in its 2nd half
+        lo, hi = 1, min(len(text), budget)
+        while lo < hi:
+            middle = (lo + hi + 1) // 2
+            if len(encode(text[:middle])) <= budget:
+                lo = middle
+            else:
+                hi = middle - 1
+        space = text.rfind(' ', lo // 2, lo)
+        if space > 0:
+            chunks.append(encode(text[:space]))
+            text = text[space + 1:]
+        else:
+            chunks.append(encode(text[:lo]))
+            text = text[lo:]
+    return chunks
 
 
 def now(date=True, fmt=DATE_FORMAT):
@@ -33,11 +104,26 @@ def now(date=True, fmt=DATE_FORMAT):
 
     """
     if date:
-        return str(datetime.datetime.today().strftime(fmt))
+        if fmt not in _clocks:
+            _clocks[fmt] = log.Clock(fmt)
+        return _clocks[fmt]()  # formatted once per second
     else:
         return str(datetime.time.today().strftime(fmt))
 
 
+def last_param(message):
+    """Last parameter of message, trailing or not ('PONG server token' or
+    'PONG server :token')."""
+    if message.trailing or not message.params:
+        return message.trailing
+    return message.params[-1]
+
+
+def bot_key(nick, network=None):
+    """Key of the bot of nick on network, in its store and data directory."""
+    return nick if network is None else '{}@{}'.format(nick, network)
+
+
 class WrexBot(asynchat.async_chat):
     """Simple Python IRC Bot written for fun."""
     def __init__(self,
@@ -46,7 +132,11 @@ class WrexBot(asynchat.async_chat):
                  plugins_to_load=None,
                  ignores=None,
                  admins=None,
-                 prefix='!'):
+                 prefix='!',
+                 loop=None,
+                 store=STORE_FILE,
+                 alt_nicks=None,
+                 network=None):
         """Create an IRC WrexBot, ready for duty o/
 
         :param nick: bot nickname (default=WrexBot)
@@ -54,71 +144,264 @@ class WrexBot(asynchat.async_chat):
         :param channels: channels to join upon connection (default=[])
         :type channels: list of string
         :param plugins_to_load: plugins to load at startup
-                                (default=['Shepard', 'Admin'])
+                                (default=the plugins loaded when the bot
+                                last ran, or ['Shepard', 'Admin'])
         :type plugins_to_load: list of string
-        :param ignores: users to ignore (default=[self.nick])
+        :param ignores: users to ignore, nicks or hostmasks such as
+                        '*!*@*.example.net', added to the ones ignored when
+                        the bot last ran (default=[self.nick])
         :type ignores: list of string
-        :param admins: users with admin rights on the bot (default=[])
+        :param admins: users with admin rights on the bot, nicks or
+                       hostmasks, added to the admins of when the bot last
+                       ran (default=[])
         :type admins: list of string
         :param prefix: prefix for users/admins custom commands
                                        (default='!')
         :type prefix: string
+        :param loop: event loop serving the connection, bots sharing a loop
+                     run in the same process (default=get_loop())
+        :type loop: eventloop.EventLoop
+        :param store: database file keeping the state of the bot (admins,
+                      ignores and plugins) and of its plugins, shared by the
+                      bots using the same file (default=STORE_FILE)
+        :type store: string
+        :param alt_nicks: nicks used when nick is taken (default=[nick + '_',
+                          nick + '__'], then nick with random digits)
+        :type alt_nicks: list of string
+        :param network: name of the network, telling apart the saved state
+                        (and plugins files) of bots using the same nick on
+                        several networks (default=None, the nick alone)
+        :type network: string
         :return: a bot instance
         :rtype: WrexBot
 
         """
+        if loop is None:
+            loop = get_loop()
+        # State saved when the bot last ran (see save_state)
+        self.store = get_store(store, loop)
+        # The nick may change, the key does not
+        self.network = network
+        self.store_key = bot_key(nick, network)
+        saved = self.store.get('bots', self.store_key, {})
+
         # Replace None placeholders with default values:
         if channels is None:
             channels = []
         if plugins_to_load is None:
-            plugins_to_load = ['Shepard', 'Admin']
+            plugins_to_load = saved.get('plugins', ['Shepard', 'Admin'])
         if ignores is None:
             ignores = []
         if admins is None:
             admins = []
-
-        asynchat.async_chat.__init__(self)
+        if alt_nicks is None:
+            alt_nicks = [nick + '_', nick + '__']
+        ignores = ignores + saved.get('ignores', [])
+        admins = admins + saved.get('admins', [])
+
+        self.loop = loop
+        self.console = log.get_console()
+        self.metrics = metrics.Metrics()
+        self.workers = get_workers(self.loop)
+        asynchat.async_chat.__init__(self, map=self.loop.map)
         self.set_terminator('\n')  # handle non-RFC-compliant servers
+        self.sendq = SendQueue()
+        self.encoded = LRUCache(256)  # write arguments -> encoded lines
+        self.flush_pending = False
+        self.flush_scheduled = False
+        self.metrics.gauge('sendq', lambda: len(self.sendq))
+        self.metrics.gauge('sendq_dropped', lambda: self.sendq.dropped)
+        self.metrics.gauge('workers_pending', lambda: self.workers.pending)
+        self.metrics.gauge('encoded_cache_hits', lambda: self.encoded.hits)
+        self.metrics.gauge('lag', lambda: self.lag)
         self.nick = nick
-        self.channels = channels
+        self.nicks = [nick] + alt_nicks  # main nick, then alternatives
+        self.channels = list(channels)  # kept up to date by join and part
+        # Connection state (see shepardify)
+        self.servers = []  # (host, port) of the network, tried in turn
+        self.server_index = 0
+        self.auto_reconnect = True
+        self.reconnect_attempts = 0  # failures since last registration
+        self.reconnect_pending = False
+        self.watchdog = None  # timer of check_connection
+        self.connect_time = None
+        self.registered = False
+        self.ping_time = None  # when the unanswered lag PING was sent
+        self.nick_time = 0  # last attempt to take the main nick back
+        self.lag = None
         self.plugins_to_load = plugins_to_load
         self.plugins = []
+        # Built-in handlers, then plugins routing tables (see update_routes)
+        self.handlers = {
+            'PING': self.on_ping,
+            'PONG': self.on_pong,
+            'PRIVMSG': self.on_privmsg,
+            RPL_WELCOME: self.on_welcome,
+            ERR_CANNOTSENDTOCHAN: self.on_cannot_send_to_chan,
+            ERR_ERRONEUSNICKNAME: self.on_nickname_in_use,
+            ERR_NICKNAMEINUSE: self.on_nickname_in_use,
+            ERR_NICKCOLLISION: self.on_nickname_in_use,
+        }
+        # Channels and users tracking (see state.py)
+        self.state = StateTracker(self)
+        self.handlers.update(self.state.commands)
+        self.routes = {}
+        self.custom_routes = {}
+        self.ignores = HostmaskIndex(ignores)
+        self.ignores.add(self.nick)  # avoid loops
+        self.admins = HostmaskIndex(admins)
+        self.prefix = prefix
+        self.plugin_manager = PluginManager(self, PLUGIN_DIR)
         for plugin_class in self.plugins_to_load:
             self.load_plugin(plugin_class)
-        self.ignores = ignores
-        self.ignores.append(self.nick)  # avoid loops
-        self.admins = admins
-        self.prefix = prefix
+        self.ignores.on_change = self.admins.on_change = self.save_state
 
-    def load_plugin(self, plugin_class):
-        """Load plugin to be used by the bot."""
-        # Plugin filename and class must follow plugin convention, see README
-        plugin_loaded = False
-        for plugin in self.plugins:
-            if plugin_class in str(plugin.__class__):
-                plugin_loaded = True
-                logging.info('Plugin {} already loaded.'.format(plugin_class))
-        if not plugin_loaded:
-            # Guess plugin filename from plugin class name and then import it
-            plugin_file = '_'.join(re.findall('[A-Z][^A-Z]*', plugin_class)).lower()
-            module = __import__('{}.{}'.format(PLUGIN_DIR, plugin_file),
-                                fromlist=[plugin_class])
-            # Create an instance of module.plugin_class and append to plugins
-            init = getattr(module, plugin_class)
-            self.plugins.append(init(self))
+    def data_path(self, name):
+        """Path of name, a file or directory of a plugin, in the data
+        directory of the bot: bots of a process, or of several processes
+        running in the same directory, never share plugins files."""
+        return os.path.join(DATA_DIR, self.store_key, name)
+
+    def save_state(self):
+        """Save admins, ignores and plugins, restored when the bot restarts."""
+        self.store.set('bots', self.store_key, {
+            'admins': list(self.admins),
+            'ignores': [mask for mask in self.ignores if mask != self.nicks[0]],
+            'plugins': [self.plugin_manager.name(plugin)
+                        for plugin in self.plugins],
+        })
+
+    def load_plugin(self, plugin_class, lazy=True):
+        """Load plugin to be used by the bot.
+
+        Unless lazy is False, the plugin is only imported when it first
+        receives a line it handles (see plugin_manager.py).
+
+        """
+        loaded = self.plugin_manager.load(plugin_class, lazy)
+        if loaded:
+            self.save_state()
+        return loaded
 
     def unload_plugin(self, plugin_class):
         """Unload plugin so it's not used anymore."""
+        unloaded = self.plugin_manager.unload(plugin_class)
+        if unloaded:
+            self.save_state()
+        return unloaded
+
+    def reload_plugin(self, plugin_class=None):
+        """Reload plugin from its file (by default, all the plugins whose
+        file changed), return the list of plugins reloaded and the errors
+        of the ones which could not be (see PluginManager.reload)."""
+        names = None if plugin_class is None else [plugin_class]
+        return self.plugin_manager.reload(names)
+
+    def update_routes(self):
+        """Build routing tables from the commands handled by loaded plugins.
+
+        Incoming lines are only passed to the plugins which registered their
+        command, so the cost of a line does not grow with the number of
+        plugins loaded. Plugins changing their commands dictionaries after
+        their __init__ must call this method again.
+
+        """
+        routes = {}
+        custom_routes = {}
         for plugin in self.plugins:
-            if plugin_class in str(plugin.__class__):
-                self.plugins.remove(plugin)
+            for command in plugin.commands:
+                routes.setdefault(command, []).append(plugin)
+            for command in set(plugin.user_commands) | set(plugin.admin_commands):
+                custom_routes.setdefault(command, []).append(plugin)
+        self.routes = dict((k, tuple(v)) for k, v in routes.items())
+        self.custom_routes = dict((k, tuple(v)) for k, v in custom_routes.items())
+
+    def shepardify(self, host, port=6667, encoding='utf-8', run=True):
+        """Connect to host:port and start operations.
+
+        host can also be a list of servers of the network, as 'host' or
+        'host:port' (port is the default port). When the connection is
+        lost, the bot reconnects after a delay growing at each failure,
+        to the next server if the last attempt failed.
+
+        Use run=False to only open the connection: several bots can then be
+        connected before serving them all at once with self.loop.run().
 
-    def shepardify(self, host, port=6667, encoding='utf-8'):
-        """Connect to host:port and start operations."""
+        """
         self.encoding = encoding
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect((host, port))
-        asyncore.loop()
+        if isinstance(host, basestring):
+            host = [host]
+        self.servers = []
+        for server in host:
+            server_host, _, server_port = server.partition(':')
+            self.servers.append((server_host, int(server_port or port)))
+        self.server_index = 0
+        self.connect_server()
+        if run:
+            self.loop.run()
+
+    def connect_server(self):
+        """Open a new connection to the current server of self.servers."""
+        self.registered = False
+        self.ping_time = None
+        self.nick = self.nicks[0]
+        self.discard_buffers()
+        self.sendq.clear()
+        self.host, port = self.servers[self.server_index]
+        self.connect_time = time.time()
+        logging.info('Connecting to %s:%s', self.host, port)
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect((self.host, port))
+        except socket.error as error:
+            logging.error('Cannot connect to %s:%s: %s', self.host, port, error)
+            self.handle_close()
+            return
+        self.watchdog = self.loop.call_every(PING_INTERVAL,
+                                             self.check_connection)
+
+    def check_connection(self):
+        """Measure lag with a PING, close the connection if the server
+        stopped answering, and try to take the main nick back."""
+        now = time.time()
+        if not self.registered:
+            if now - self.connect_time > PING_TIMEOUT:
+                logging.warning('No welcome from %s after %ss, reconnecting',
+                                self.host, PING_TIMEOUT)
+                self.handle_close()
+        elif self.ping_time is not None:
+            if now - self.ping_time > PING_TIMEOUT:
+                logging.warning('No PONG from %s after %ss, reconnecting',
+                                self.host, PING_TIMEOUT)
+                self.handle_close()
+        else:
+            self.ping_time = now
+            self.write('PING', ':' + LAG_TOKEN)
+            if (self.nick != self.nicks[0]
+                    and now - self.nick_time > NICK_RECOVERY_INTERVAL):
+                self.nick_time = now
+                self.write('NICK', self.nicks[0])
+
+    def schedule_reconnect(self):
+        """Reconnect after a jittered delay, doubled at each failure."""
+        if not self.registered:  # try another server of the network
+            self.server_index = (self.server_index + 1) % len(self.servers)
+        delay = min(MAX_RECONNECT_DELAY,
+                    RECONNECT_DELAY * 2 ** self.reconnect_attempts)
+        delay = random.uniform(delay / 2, delay)
+        self.reconnect_attempts += 1
+        self.reconnect_pending = True
+        self.loop.holds += 1  # keep the loop running meanwhile
+        logging.info('Reconnecting to %s in %.1fs',
+                     self.servers[self.server_index][0], delay)
+        self.loop.call_later(delay, self._reconnect)
+
+    def _reconnect(self):
+        self.loop.holds -= 1
+        self.reconnect_pending = False
+        if self.auto_reconnect:
+            self.metrics.count('connections', 'reconnect')
+            self.connect_server()
 
     def collect_incoming_data(self, data):
         """Decode incoming data using self.encoding and encode it in utf-8.
@@ -132,96 +415,284 @@ class WrexBot(asynchat.async_chat):
             data = data.decode(self.encoding)
             self.incoming.append(data.encode('utf-8'))
         except (UnicodeDecodeError, UnicodeEncodeError):
-            logging.info('Data not decoded from {}'.format(self.encoding))
+            logging.info('Data not decoded from %s', self.encoding)
             self.incoming.append(data)
 
+    def now(self):
+        """Current time, as seen by plugins (cooldowns, history...).
+
+        ReplayBot returns the time of the line being replayed instead, None
+        when logs have no time tags (cooldowns are then off).
+
+        """
+        return time.time()
+
     def found_terminator(self):
         """Handle data reception and pass it to the dispatcher.
 
-        Split data in sender, command, command parameters and msg.
-        Data is received in the following RFC format:
-        [:sender] COMMAND [params] [:msg]
-        ([x] means x may or may not be present)
+        Data is parsed once into a Message (see message.py), which is then
+        passed as is to the dispatcher and the plugins.
 
         """
         # Take out \r if present (= server follows RFC)
         data = self._get_data().rstrip('\r')
-        logging.debug(data)
-        # Take out sender (prefixed with the first ':')
-        if data.startswith(':'):
-            sender, data = data.split(' ', 1)
-            sender = sender[1:].split('!', 1)[0]  # just keep username
-        else:  # No sender (happens for PING for example)
-            sender = ''
-        # Take out message (after the second ':')
-        try:
-            parts, msg = data.split(' :', 1)
-        except ValueError:  # in case there's no message
-            parts = data
-            msg = ''
-        # Split RFC command (e.g. PRIVMSG) and its parameters
-        parts = parts.split(' ')
-        command = parts[0]
-        params = parts[1:]  # can be an empty list
-
-        # Process data (unless we ignore sender)
-        if sender not in self.ignores:
-            self.dispatch(sender, command, params, msg)
-
-    def dispatch(self, sender, command, params, msg):
-        """Dispatch received data based on command."""
-        logging.info('RECEIVED: {}{}{}{}'.format(sender + ' ', command + ' ',
-                                                 ' '.join(params) + ' ', msg))
-
-        if 'PING' in command:
-            self.write('PONG', msg)
-        elif 'PRIVMSG' in command:
-            self.print_msg(sender, params[0], msg)
-            # Custom command plugin handlers
-            if msg.startswith(self.prefix):
-                for plugin in self.plugins:
-                    plugin.dispatch(sender, command, params, msg, custom=True,
-                                    admin=sender in self.admins)
-        elif RPL_WELCOME in command:  # connect to default channels upon welcome
-            self.print_msg(sender, self.nick, msg)
-            for channel in self.channels:
-                self.join(channel)
-        # Various RFC constants handlers
-        elif ERR_CANNOTSENDTOCHAN in command:
-            self.print_msg(sender, self.nick, 'Cannot send to chan: {}'.format(params[0]))
-        elif ERR_ERRONEUSNICKNAME in command:
-            self.print_msg(sender, self.nick, 'Invalid nickname: {}'.format(self.nick))
-        elif ERR_NICKNAMEINUSE in command or ERR_NICKCOLLISION in command:
-            self.print_msg(sender, self.nick, 'Nickname {} already in use.'.format(self.nick))
-
+        logging.debug('%s', data)
+        message = parse(data)
+        self.metrics.count('lines_in', message.command)
+
+        # Process data (unless we ignore sender, servers cannot be ignored)
+        if not (message.user or message.host) or not self.ignores.match(
+                message.nick, message.user, message.host):
+            self.dispatch(message)
+        else:  # ignored users (the bot included) still join, part...
+            handler = self.state.commands.get(message.command)
+            if handler is not None:
+                self.run_handler(handler, message)
+
+    def dispatch(self, message):
+        """Dispatch received message based on command."""
+        logging.info('RECEIVED: %s', message)
+        if message.user:
+            self.state.see(message)
+
+        # Built-in handlers
+        handler = self.handlers.get(message.command)
+        if handler is not None:
+            self.run_handler(handler, message)
         # Plugin handlers
-        for plugin in self.plugins:
-            plugin.dispatch(sender, command, params, msg)
+        for plugin in self.routes.get(message.command, ()):
+            self.run_handler(plugin.dispatch, message)
+
+    def run_handler(self, handler, message, *args):
+        """Call handler(message, *args), logging exceptions it raises.
+
+        asyncore closes the connection when an exception reaches it, so a
+        failing plugin must not let one go through. The time spent in handler
+        is recorded in the 'dispatch' histograms of self.metrics.
+
+        """
+        name = '{}.{}'.format(handler.__self__.__class__.__name__,
+                              handler.__name__)
+        start = time.time()
+        try:
+            handler(message, *args)
+        except Exception:
+            self.metrics.count('errors', name)
+            logging.exception('%s failed on: %s', handler, message)
+        self.metrics.observe('dispatch', name, time.time() - start)
+
+    def on_ping(self, message):
+        self.write('PONG', last_param(message))
+
+    def on_pong(self, message):
+        if last_param(message) == LAG_TOKEN and self.ping_time is not None:
+            self.lag = time.time() - self.ping_time
+            self.metrics.observe('lag', self.host, self.lag)
+            self.ping_time = None
+
+    def on_privmsg(self, message):
+        sender, msg = message.nick, message.trailing
+        self.print_msg(sender, message.params[0], msg)
+        # Custom command plugin handlers
+        if msg.startswith(self.prefix):
+            parts = msg.split(' ')
+            command = parts[0].lstrip(self.prefix)
+            plugins = self.custom_routes.get(command)
+            if plugins:
+                params = parts[1:]  # can be an empty list
+                # In case of PRIVMSG to the bot, answer to the sender
+                # Else respond in channel
+                recipient = message.params[0]
+                if recipient == self.nick:
+                    recipient = sender
+                admin = self.admins.match(sender, message.user, message.host)
+                for plugin in plugins:
+                    self.run_handler(plugin.dispatch_custom, message, command,
+                                     params, recipient, admin)
+
+    def on_welcome(self, message):
+        # Connect to default channels upon welcome
+        self.print_msg(message.nick, self.nick, message.trailing)
+        self.registered = True
+        self.reconnect_attempts = 0
+        if message.params:  # the nick the server registered us with
+            self.nick = message.params[0]
+        self.join(*self.channels)
+
+    def on_cannot_send_to_chan(self, message):
+        self.print_msg(message.nick, self.nick,
+                       'Cannot send to chan: {}'.format(message.params[0]))
+
+    def on_nickname_in_use(self, message):
+        """Try the next alternative nick if the nick was refused during
+        registration (taken or invalid)."""
+        nick = message.params[1] if len(message.params) > 1 else self.nick
+        if message.command == ERR_ERRONEUSNICKNAME:
+            self.print_msg(message.nick, self.nick,
+                           'Invalid nickname: {}'.format(nick))
+        else:
+            self.print_msg(message.nick, self.nick,
+                           'Nickname {} already in use.'.format(nick))
+        if self.registered:  # we keep the current one
+            return
+        if nick in self.nicks[:-1]:
+            self.nick = self.nicks[self.nicks.index(nick) + 1]
+        else:
+            self.nick = '{}{}'.format(self.nicks[0][:6],
+                                      random.randint(1000, 9999))
+        self.write('NICK', self.nick)
 
     def write(self, *args):
-        """Try to encode message and push it to the server."""
-        msg = ' '.join(args)
-        logging.info('SENT: {}'.format(msg))
+        """Encode message and queue it for the server (see flush).
+
+        The trailing parameter (the last one, if it starts with ':') is sent
+        over several lines, with the same command and parameters, when it
+        contains newlines or is too long for a single line (see encode_line).
+
+        """
+        key = (self.nick, args)
+        lines = self.encoded.get(key)
+        if lines is None:
+            lines = self.encode_line(args)
+            self.encoded.put(key, lines)
+        command = args[0]
+        target = args[1] if command in ('PRIVMSG', 'NOTICE') else None
+        for line in lines:
+            logging.info('SENT: %s', line)
+            self.metrics.count('lines_out', command)
+            self.sendq.put(line + '\r\n', command, target)
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.loop.call_soon(self.flush)
+
+    def encode(self, text):
+        """Encode text (unicode, or utf-8 as handled by the bot) for the
+        server. Text which cannot be decoded nor encoded is sent as is."""
         try:
-            self.push(msg.encode(self.encoding) + '\r\n')
+            if isinstance(text, str):
+                text = text.decode('utf-8')
+            return text.encode(self.encoding)
         except (UnicodeDecodeError, UnicodeEncodeError):
-            self.push(msg + '\r\n')
+            return text if isinstance(text, str) else text.encode('utf-8')
+
+    def encode_line(self, args):
+        """Return the encoded lines (without \\r\\n) sending args.
+
+        Lines are split on newlines, then to fit in MAX_LINE bytes once
+        relayed by the server: on word boundaries when possible, and never in
+        the middle of a character. Encoded lines are cached by write, so that
+        fixed answers (help, triggers...) are only encoded once.
+
+        """
+        args = list(args)
+        trailing = None
+        if len(args) > 1 and args[-1].startswith(':'):
+            trailing = args.pop()[1:]
+        # Newlines in other parameters would inject commands: drop them
+        head = ' '.join(self.encode(arg) for arg in args)
+        head = head.replace('\r', ' ').replace('\n', ' ')
+        if trailing is None:
+            return [head]
+        budget = MAX_LINE - len('\r\n') - PREFIX_RESERVE - len(self.nick) \
+            - len(head) - len(' :')
+        try:
+            text = trailing.decode('utf-8') if isinstance(trailing, str) else trailing
+        except UnicodeDecodeError:  # raw bytes, e.g. latin-1 answered as is
+            text = trailing
+        encode = self.encode if isinstance(text, unicode) else str
+        lines = []
+        for text_line in NEWLINE.split(text):
+            if text_line.strip():
+                lines.extend('{} :{}'.format(head, chunk) for chunk in
+                             split_text(text_line, max(budget, 16), encode))
+        return lines or [head + ' :']
+
+    def flush(self):
+        """Push queued lines allowed by flood control in a single write.
+
+        Called by the loop once the current handlers are done, so that all
+        the lines they wrote are sent together. If some lines have to wait,
+        flush is called again when they can go.
+
+        """
+        self.flush_pending = False
+        lines, delay = self.sendq.pop(time.time())
+        if lines:
+            self.push(''.join(lines))
+        if delay is not None and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_later(delay, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self.flush_scheduled = False
+        self.flush()
 
     def handle_connect(self):
         """RFC connection protocol."""
+        self.metrics.count('connections', 'connect')
+        # Extensions making NAMES replies complete, see state.py
+        self.write('CAP', 'REQ', ':multi-prefix userhost-in-names')
+        self.write('CAP', 'END')
         self.write('NICK', self.nick)
         self.write('USER', self.nick, self.nick, self.nick, ":" + self.nick)
 
-    def join(self, channel):
-        """RFC JOIN message."""
-        if not channel.startswith('#'):
-            channel = '#' + channel
-        self.write('JOIN', channel)
+    def handle_close(self):
+        """Connection lost (or never opened): reconnect, unless
+        self.auto_reconnect was set to False."""
+        self.metrics.count('connections', 'close')
+        self.state.clear()
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+            self.watchdog = None
+        if self.socket is not None:
+            self.close()
+        if self.auto_reconnect and self.servers and not self.reconnect_pending:
+            self.schedule_reconnect()
+
+    def handle_error(self):
+        """Log errors (refused connections and such) before handle_close."""
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error):
+            logging.error('Connection to %s failed: %s', self.host, error)
+        else:
+            logging.exception('Unexpected error on connection to %s', self.host)
+        self.handle_close()
+
+    def quit(self, msg=''):
+        """RFC QUIT message, the bot does not reconnect afterwards."""
+        self.auto_reconnect = False
+        self.write('QUIT', ':' + msg)
+
+    def join(self, *channels):
+        """RFC JOIN message, for as many channels as a line can hold.
+
+        Joined channels are added to self.channels, joined again when the
+        bot reconnects.
+
+        """
+        budget = MAX_LINE - len('JOIN \r\n')
+        batch = []
+        size = 0
+        for channel in channels:
+            if not channel.startswith('#'):
+                channel = '#' + channel
+            if channel not in self.channels:
+                self.channels.append(channel)
+            if batch and size + len(channel) >= budget:
+                self.write('JOIN', ','.join(batch))
+                batch = []
+                size = 0
+            batch.append(channel)
+            size += len(channel) + 1
+        if batch:
+            self.write('JOIN', ','.join(batch))
 
     def part(self, channel):
         """RFC PART message."""
         if not channel.startswith('#'):
             channel = '#' + channel
+        if channel in self.channels:
+            self.channels.remove(channel)
         self.write('PART', channel)
 
     def privmsg(self, recipient, msg):
@@ -230,12 +701,13 @@ class WrexBot(asynchat.async_chat):
         self.print_msg(recipient, self.nick, msg)
 
     def print_msg(self, sender, recipient, msg):
-        """Format and print a received message."""
-        print "[{}] {} | {}: {}".format(now(), recipient, sender, msg)
+        """Print a received message (formatted and printed off the loop)."""
+        self.console.info('%s | %s: %s', recipient, sender, msg,
+                          extra={'fields': {'recipient': recipient,
+                                            'sender': sender, 'msg': msg}})
 
 
 if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s %(message)s', datefmt=DATE_FORMAT, stream=sys.stdout)
-    logging.getLogger().setLevel(logging.DEBUG)
+    log.setup(logging.DEBUG)
     wrex_bot = WrexBot('WrexBotTest', channels=['#test-bot'], admins=['Skymirrh'])
     wrex_bot.shepardify('irc.epiknet.org')
\ No newline at end of file
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Event loop shared by every connection of a process.
+
+asyncore serves every dispatcher registered in a given socket map, so as long
+as all bots use the same map, a single process can hold connections to as many
+networks as we want. Plugins can use the loop as well:
+    * register their own asyncore dispatchers in loop.map to do non-blocking
+      I/O next to the IRC connections.
+    * hand results from other threads back to the loop thread with
+      call_soon_threadsafe (bots are not thread-safe, the loop thread is the
+      only one which may touch them).
+    * run something later with call_later, or periodically with call_every.
+      Both return a Timer, whose cancel method unschedules it.
+
+Timers are kept in a heap: scheduling is O(log n), cancelling is O(1) (the
+timer is only marked, and skipped when due; the heap is rebuilt without
+cancelled timers once they are the majority). The loop sleeps until the
+next timer is due or some I/O happens, it is not woken up in between.
+
+"""
+
+import asyncore
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import select
+import time
+from collections import deque
+
+if hasattr(select, 'poll'):
+    poll = asyncore.poll2  # scales past the FD_SETSIZE limit of select()
+else:
+    poll = asyncore.poll
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Self-pipe used by other threads to wake the loop up."""
+    background = True
+
+    def __init__(self, map):
+        self.rfd, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.rfd, map=map)
+        flags = fcntl.fcntl(self.wfd, fcntl.F_GETFL)
+        fcntl.fcntl(self.wfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, IOError):
+            pass
+
+    def wake(self):
+        try:
+            os.write(self.wfd, 'x')
+        except (OSError, IOError) as e:
+            if e.errno != errno.EAGAIN:  # pipe full = loop already awake
+                raise
+
+
+class Timer(object):
+    """Callback scheduled by EventLoop.call_later or call_every."""
+    __slots__ = ('loop', 'when', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, loop, when, interval, callback, args):
+        self.loop = loop
+        self.when = when
+        self.interval = interval  # None unless periodic
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Unschedule the timer (does nothing if it already ran)."""
+        if not self.cancelled:
+            self.cancelled = True
+            self.loop._cancelled += 1
+
+    def __repr__(self):
+        return '<Timer {} at {}{}>'.format(
+            self.callback, self.when, ' (cancelled)' if self.cancelled else '')
+
+
+class EventLoop(object):
+    """asyncore socket map plus callbacks and timers."""
+    def __init__(self, timeout=None):
+        """Create an empty event loop.
+
+        :keyword timeout: maximum time spent waiting for I/O when nothing
+                          else is scheduled, in seconds (default=None, no
+                          maximum)
+        :type timeout: float
+
+        """
+        self.map = {}
+        self.timeout = timeout
+        self._ready = deque()
+        self._timers = []  # heap of (when, sequence, Timer)
+        self._sequence = 0  # keeps heap ordering stable for equal deadlines
+        self._cancelled = 0  # cancelled timers still in the heap
+        self.holds = 0  # connections to be opened later (e.g. reconnections)
+        self._waker = _Waker(self.map)
+
+    def call_soon(self, callback, *args):
+        """Run callback(*args) in the loop thread once current I/O is handled."""
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Run callback(*args) in the loop thread as soon as possible.
+
+        This is the only loop method which may be called from another thread.
+
+        """
+        self._ready.append((callback, args))
+        self._waker.wake()
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) in the loop thread after delay seconds.
+
+        :return: the scheduled timer
+        :rtype: Timer
+
+        """
+        return self._schedule(Timer(self, time.time() + delay, None, callback,
+                                    args))
+
+    def call_every(self, interval, callback, *args):
+        """Run callback(*args) in the loop thread every interval seconds,
+        starting in interval seconds, until the returned timer is cancelled.
+
+        :return: the scheduled timer
+        :rtype: Timer
+
+        """
+        return self._schedule(Timer(self, time.time() + interval, interval,
+                                    callback, args))
+
+    def _schedule(self, timer):
+        self._sequence += 1
+        heapq.heappush(self._timers, (timer.when, self._sequence, timer))
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._timers):
+            self._timers = [entry for entry in self._timers
+                            if not entry[2].cancelled]
+            heapq.heapify(self._timers)
+            self._cancelled = 0
+        return timer
+
+    @property
+    def timers(self):
+        """Number of timers scheduled (not counting cancelled ones)."""
+        return len(self._timers) - self._cancelled
+
+    def alive(self):
+        """Whether there is still some connection served by the loop.
+
+        Dispatchers with a true background attribute (e.g. the waker or a
+        metrics endpoint) do not count. Holds do: a bot waiting to reconnect
+        increments loop.holds until it does.
+
+        """
+        if self.holds:
+            return True
+        for dispatcher in self.map.itervalues():
+            if not getattr(dispatcher, 'background', False):
+                return True
+        return False
+
+    def run_once(self):
+        """Wait for I/O once, then run every callback and timer due."""
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+            self._cancelled -= 1
+        timeout = self.timeout
+        if self._ready:
+            timeout = 0
+        elif timers:
+            delay = max(0, timers[0][0] - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+        poll(timeout, self.map)
+
+        while self._ready:
+            callback, args = self._ready.popleft()
+            self._run(callback, args)
+        current = time.time()
+        while timers and timers[0][0] <= current:
+            timer = heapq.heappop(timers)[2]
+            if timer.cancelled:
+                self._cancelled -= 1
+                continue
+            if timer.interval is not None:  # periodic: schedule next run
+                timer.when = max(timer.when + timer.interval, current)
+                self._schedule(timer)
+            else:
+                timer.cancelled = True  # ran, cancel must not count it
+            self._run(timer.callback, timer.args)
+            timers = self._timers  # may have been rebuilt
+
+    def run(self):
+        """Serve every connection until they are all closed."""
+        while self.alive():
+            self.run_once()
+
+    def _run(self, callback, args):
+        """Run a callback, making sure it cannot take the whole loop down."""
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('Callback {} failed'.format(callback))
+
+
+_default_loop = None
+
+
+def get_loop():
+    """Return the process-wide default event loop."""
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
+
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Users matching by nick or by hostmask (nick!user@host, with wildcards)."""
+
+import re
+import string
+from collections import OrderedDict
+
+# RFC 1459 case mapping: {}|^ are the lowercase equivalents of []\~
+IRC_LOWER = string.maketrans(string.ascii_uppercase + '[]\\~',
+                             string.ascii_lowercase + '{}|^')
+
+
+def irc_lower(name):
+    """Lowercase name following the IRC case mapping."""
+    return name.translate(IRC_LOWER)
+
+
+def has_wildcards(pattern):
+    return '*' in pattern or '?' in pattern
+
+
+def split_hostmask(mask):
+    """Split 'nick!user@host' in (nick, user, host), missing parts being '*'."""
+    nick, at, host = mask.partition('@')
+    nick, bang, user = nick.partition('!')
+    if not at and not bang:  # plain nick
+        return nick, '*', '*'
+    return nick or '*', user or '*', host or '*'
+
+
+class _Part(object):
+    """Matcher for one part (nick, user or host) of a hostmask."""
+    __slots__ = ('pattern', 'regex')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = None
+        if pattern != '*' and has_wildcards(pattern):
+            regex = re.escape(pattern).replace('\\*', '.*').replace('\\?', '.')
+            self.regex = re.compile(regex + r'\Z', re.S)
+
+    def match(self, value):
+        if self.pattern == '*':
+            return True
+        if self.regex is None:
+            return value == self.pattern
+        return self.regex.match(value) is not None
+
+
+class HostmaskIndex(object):
+    """Set of nicks and hostmasks, e.g. 'Wrex' or '*!*@*.example.net'.
+
+    Entries are indexed by their literal nick, literal host or '*.domain'
+    host suffix, so that matching a user only checks the few entries which
+    could match it, whatever the number of entries. Only entries without any
+    of these (e.g. '*bot*!*@*') are checked one by one.
+
+    Matching is case-insensitive. Entries with a plain nick only check the
+    nick, which anybody can use: prefer hostmasks for admins.
+
+    """
+    def __init__(self, masks=()):
+        self.masks = OrderedDict()  # lowercased mask -> mask as added
+        self.by_nick = {}
+        self.by_host = {}
+        self.by_suffix = {}
+        self.generic = {}
+        self.on_change = None  # function called after each change
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __iter__(self):
+        return iter(self.masks.values())
+
+    def __contains__(self, mask):
+        return irc_lower(mask) in self.masks
+
+    def _bucket(self, parts):
+        """Return (index, key) where the entry with parts has to be stored."""
+        nick, user, host = parts
+        if not has_wildcards(nick):
+            return self.by_nick, nick
+        if not has_wildcards(host):
+            return self.by_host, host
+        if host.startswith('*.') and not has_wildcards(host[1:]):
+            return self.by_suffix, host[1:]
+        return self.generic, None
+
+    def add(self, mask):
+        """Add mask, return False if it was already there."""
+        key = irc_lower(mask)
+        if key in self.masks:
+            return False
+        self.masks[key] = mask
+        parts = split_hostmask(key)
+        index, index_key = self._bucket(parts)
+        index.setdefault(index_key, {})[key] = tuple(_Part(p) for p in parts)
+        if self.on_change is not None:
+            self.on_change()
+        return True
+
+    def remove(self, mask):
+        """Remove mask, return False if it was not there."""
+        key = irc_lower(mask)
+        if key not in self.masks:
+            return False
+        del self.masks[key]
+        index, index_key = self._bucket(split_hostmask(key))
+        entries = index[index_key]
+        del entries[key]
+        if not entries:
+            del index[index_key]
+        if self.on_change is not None:
+            self.on_change()
+        return True
+
+    def _candidates(self, nick, host):
+        yield self.by_nick.get(nick)
+        if host:
+            yield self.by_host.get(host)
+            dot = host.find('.')
+            while dot != -1:
+                yield self.by_suffix.get(host[dot:])
+                dot = host.find('.', dot + 1)
+        yield self.generic.get(None)
+
+    def match(self, nick, user='', host=''):
+        """Whether the user nick!user@host matches one of the entries."""
+        nick, user, host = irc_lower(nick), irc_lower(user), irc_lower(host)
+        for entries in self._candidates(nick, host):
+            if entries:
+                for nick_part, user_part, host_part in entries.itervalues():
+                    if (nick_part.match(nick) and user_part.match(user)
+                            and host_part.match(host)):
+                        return True
+        return False
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Logging and console output off the event loop.
+
+Log records are put in a bounded queue by the loop thread, then formatted and
+written by a writer thread: the loop only pays for creating the record, and
+never waits for the terminal or the disk. Records are only created for
+enabled levels, so arguments must be passed to the logging functions rather
+than formatted beforehand:
+    logging.info('SENT: %s', msg)  # and not logging.info('SENT: ' + msg)
+
+Timestamps are formatted once per second, and records can be written as
+plain text or as JSON lines.
+
+"""
+
+import atexit
+import json
+import logging
+import sys
+import threading
+import time
+import Queue
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'  # Datetime format for logs and stdout
+CONSOLE = 'wrexbot.console'  # Logger of messages displayed on stdout
+
+_structured = False  # whether console output goes to JSON logs
+
+
+class Clock(object):
+    """Current time formatted string, formatted once per second at most."""
+    def __init__(self, fmt=DATE_FORMAT):
+        self.fmt = fmt
+        self.second = None
+        self.text = ''
+
+    def __call__(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        second = int(timestamp)
+        if second != self.second:
+            self.text = time.strftime(self.fmt, time.localtime(second))
+            self.second = second
+        return self.text
+
+
+class Formatter(logging.Formatter):
+    """logging.Formatter with cached timestamps."""
+    def __init__(self, fmt=None, datefmt=DATE_FORMAT):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.clock = Clock(datefmt)
+
+    def formatTime(self, record, datefmt=None):
+        return self.clock(record.created)
+
+
+class JsonFormatter(Formatter):
+    """Format records as JSON objects, one per line.
+
+    Fields given with extra={'fields': {...}} are added to the object.
+
+    """
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        try:
+            return json.dumps(data, ensure_ascii=False, default=str)
+        except UnicodeDecodeError:  # not utf-8, e.g. a latin-1 message
+            return json.dumps(data, ensure_ascii=False, default=str,
+                              encoding='latin-1')
+
+
+class QueueHandler(logging.Handler):
+    """Handler putting records in a queue, for a QueueListener to handle.
+
+    Records are dropped (and counted) rather than blocking the caller when
+    the queue is full.
+
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        # Tracebacks cannot wait for the listener: format them right away
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class StreamWriter(logging.Handler):
+    """StreamHandler which only flushes when asked to (see QueueListener)."""
+    def __init__(self, stream, formatter):
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.setFormatter(formatter)
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            self.stream.write(text + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class QueueListener(object):
+    """Thread handling the records of a queue with some handlers.
+
+    Records are handled in batches: everything waiting in the queue is
+    written before handlers are flushed.
+
+    """
+    _stop = None  # not a record, and the same once pickled (see supervisor.py)
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self._run, name='log writer')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write remaining records and stop the thread."""
+        if self.thread.is_alive():
+            self.queue.put(self._stop)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            for record in records:
+                if record is self._stop:
+                    self._flush()
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            self._flush()
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+
+def async_handler(handler, queue_size=10000):
+    """Return a QueueHandler feeding handler from a writer thread."""
+    queue = Queue.Queue(queue_size)
+    QueueListener(queue, handler).start()
+    return QueueHandler(queue)
+
+
+def setup(level=logging.INFO, stream=None, json_lines=False,
+          fmt='%(asctime)s %(message)s', datefmt=DATE_FORMAT,
+          queue_size=10000):
+    """Configure logging (and console output) to go through a writer thread.
+
+    :keyword level: root logger level (default=logging.INFO)
+    :keyword stream: where to write logs (default=sys.stdout)
+    :keyword json_lines: write JSON objects instead of fmt (default=False)
+    :keyword fmt: logging format of plain text logs
+    :keyword datefmt: strftime format of timestamps (default=DATE_FORMAT)
+    :keyword queue_size: number of records waiting to be written before new
+                         ones get dropped (default=10000)
+
+    """
+    if stream is None:
+        stream = sys.stdout
+    formatter = JsonFormatter(datefmt=datefmt) if json_lines else Formatter(fmt, datefmt)
+    root = logging.getLogger()
+    root.handlers = [async_handler(StreamWriter(stream, formatter), queue_size)]
+    root.setLevel(level)
+    global _structured
+    _structured = json_lines
+    if json_lines:  # console output is part of the structured logs
+        console = logging.getLogger(CONSOLE)
+        console.handlers = []
+        console.propagate = True
+
+
+def get_console():
+    """Return the logger of messages displayed on stdout.
+
+    Unless setup(json_lines=True) was called, it writes to stdout on its own
+    (like print did), whatever the logging configuration.
+
+    """
+    console = logging.getLogger(CONSOLE)
+    if not console.handlers and not _structured:
+        formatter = Formatter('[%(asctime)s] %(message)s')
+        console.addHandler(async_handler(StreamWriter(sys.stdout, formatter)))
+        console.setLevel(logging.INFO)
+        console.propagate = False
+    return console
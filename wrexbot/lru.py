@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Least recently used caches."""
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Mapping keeping its maxsize most recently used items."""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        """Return the value of key (now the most recently used one)."""
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Set the value of key, evicting the least recently used item if
+        the cache is full."""
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose items also expire ttl seconds after being put."""
+    def __init__(self, maxsize=128, ttl=3600.0):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None, now=None):
+        item = super(TTLCache, self).get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires <= (now or time.time()):
+            del self.items[key]
+            self.hits -= 1
+            self.misses += 1
+            return default
+        return value
+
+    def __contains__(self, key):
+        item = self.items.get(key)
+        return item is not None and item[0] > time.time()
+
+    def put(self, key, value, ttl=None):
+        """Set the value of key, expiring after ttl seconds (default=the
+        ttl of the cache)."""
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        super(TTLCache, self).put(key, (expires, value))
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        return default if item is None else item[1]
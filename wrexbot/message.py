@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""IRC line parsing.
+
+Lines are parsed once, when received, into a Message which is then passed to
+the bot dispatcher and to every plugin. Data is received in the following
+format (RFC 1459 plus IRCv3 message tags):
+[@tags] [:prefix] COMMAND [params] [:trailing]
+([x] means x may or may not be present)
+
+"""
+
+import calendar
+import time
+
+# IRCv3 tag values escaping, see http://ircv3.net/specs/core/message-tags-3.2.html
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+class Message(object):
+    """Parsed IRC line.
+
+    Attributes:
+        * raw: the line as received, without line terminator.
+        * prefix: the whole prefix, e.g. 'nick!user@host' ('' if none).
+        * nick, user, host: prefix parts ('' when absent, nick is the server
+          name for server messages).
+        * command: RFC command or numeric, e.g. 'PRIVMSG' or '001'.
+        * params: list of command parameters, trailing excluded.
+        * trailing: last parameter, after ' :' ('' if none).
+        * tags: dict of IRCv3 message tags, only parsed when accessed.
+        * server_time: timestamp of the IRCv3 time tag, None if there is
+          none (or it is invalid).
+
+    """
+    __slots__ = ('raw', 'prefix', 'nick', 'user', 'host', 'command', 'params',
+                 'trailing', '_raw_tags', '_tags')
+
+    def __init__(self, raw, prefix, nick, user, host, command, params,
+                 trailing, raw_tags=''):
+        self.raw = raw
+        self.prefix = prefix
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+        self._raw_tags = raw_tags
+        self._tags = None
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = parse_tags(self._raw_tags)
+        return self._tags
+
+    @property
+    def server_time(self):
+        value = self.tags.get('time')  # e.g. '2011-10-19T16:40:51.620Z'
+        if not value:
+            return None
+        date, _, fraction = value.rstrip('Z').partition('.')
+        try:
+            return (calendar.timegm(time.strptime(date, '%Y-%m-%dT%H:%M:%S'))
+                    + float('0.' + (fraction or '0')))
+        except ValueError:
+            return None
+
+    def __str__(self):
+        return self.raw
+
+    def __repr__(self):
+        return '<Message {!r}>'.format(self.raw)
+
+
+def parse_tags(raw_tags):
+    """Parse IRCv3 tags ('a=b;c;d=e\\\\sf') into a dict ({'a': 'b', ...})."""
+    tags = {}
+    if not raw_tags:
+        return tags
+    for tag in raw_tags.split(';'):
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            unescaped = []
+            i = 0
+            while i < len(value):
+                char = value[i]
+                if char == '\\' and i + 1 < len(value):
+                    i += 1
+                    char = TAG_ESCAPES.get(value[i], value[i])
+                elif char == '\\':  # a trailing lone backslash is dropped
+                    char = ''
+                unescaped.append(char)
+                i += 1
+            value = ''.join(unescaped)
+        tags[key] = value
+    return tags
+
+
+def parse(line):
+    """Parse a raw IRC line (without line terminator) into a Message.
+
+    The line is scanned once from left to right: each field is sliced out
+    of it directly, only the command and its middle parameters are split.
+
+    """
+    start = 0
+    raw_tags = ''
+    if line[:1] == '@':
+        start = line.find(' ')
+        if start == -1:
+            start = len(line)
+        raw_tags = line[1:start]
+        start += 1
+
+    if line[start:start + 1] == ':':
+        end = line.find(' ', start)
+        if end == -1:
+            end = len(line)
+        prefix = line[start + 1:end]
+        start = end + 1
+        nick, _, host = prefix.partition('@')
+        nick, _, user = nick.partition('!')
+    else:  # No prefix (happens for PING for example)
+        prefix = nick = user = host = ''
+
+    # Take out trailing message (after the first ' :')
+    end = line.find(' :', start)
+    if end == -1:
+        end = len(line)
+        trailing = ''
+    else:
+        trailing = line[end + 2:]
+    params = line[start:end].split()
+    command = params.pop(0) if params else ''
+    return Message(line, prefix, nick, user, host, command, params, trailing,
+                   raw_tags)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Runtime metrics: counters, latency histograms and gauges.
+
+Each bot records its metrics in bot.metrics:
+    * counters: lines in and out by command, connections, errors...
+    * histograms: time spent in built-in handlers and plugins dispatch
+      ('dispatch', e.g. 'Shepard.dispatch'), and in plugin handlers
+      ('handlers', e.g. 'Shepard.privmsg').
+    * gauges: values read when metrics are displayed, e.g. the send queue
+      length.
+
+Recording costs a couple of dictionary lookups, so metrics are always on.
+They can be displayed with the !stats admin command, or polled as JSON over
+HTTP from localhost once an endpoint is served on the bots loop:
+    metrics.serve(bot.loop, 8080)  # then: curl http://127.0.0.1:8080/
+
+"""
+
+import asynchat
+import asyncore
+import bisect
+import json
+import logging
+import socket
+import time
+
+# Histograms buckets upper bounds, in seconds (10us to 10s)
+BOUNDS = tuple(m * 10 ** e for e in range(-5, 1) for m in (1, 2.5, 5)) + (10,)
+
+
+class Histogram(object):
+    """Distribution of durations, in fixed buckets."""
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)  # last one: above BOUNDS[-1]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the percent-th percentile."""
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(BOUNDS[index], self.max) if index < len(BOUNDS) \
+                    else self.max
+        return 0.0
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': dict((str(bound), count) for bound, count
+                            in zip(BOUNDS + ('inf',), self.counts) if count),
+        }
+
+
+class Metrics(object):
+    """Counters, histograms and gauges of a bot."""
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}  # name -> {key: count}
+        self.histograms = {}  # name -> {key: Histogram}
+        self.gauges = {}  # name -> function returning the value
+
+    def count(self, name, key, n=1):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = {}
+        counter[key] = counter.get(key, 0) + n
+
+    def observe(self, name, key, value):
+        histograms = self.histograms.get(name)
+        if histograms is None:
+            histograms = self.histograms[name] = {}
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, function):
+        """Register function, called to get gauge name when it is read."""
+        self.gauges[name] = function
+
+    def read_gauges(self):
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception:
+                logging.exception('Cannot read gauge %s', name)
+        return gauges
+
+    def snapshot(self):
+        """Return every metric, as a JSON-serializable dict."""
+        return {
+            'uptime': time.time() - self.started,
+            'counters': self.counters,
+            'gauges': self.read_gauges(),
+            'histograms': dict(
+                (name, dict((key, histogram.snapshot())
+                            for key, histogram in histograms.items()))
+                for name, histograms in self.histograms.items()),
+        }
+
+
+class _Request(asynchat.async_chat):
+    """HTTP request to a MetricsServer, answered with the metrics as JSON."""
+    background = True
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.request = []
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        if sum(len(chunk) for chunk in self.request) < 8192:
+            self.request.append(data)
+
+    def found_terminator(self):
+        body = json.dumps(self.server.snapshot(), default=str, indent=1,
+                          sort_keys=True)
+        self.push('HTTP/1.0 200 OK\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: {}\r\n'
+                  'Connection: close\r\n\r\n{}'.format(len(body), body))
+        self.close_when_done()
+        self.set_terminator(None)
+
+
+def bots_snapshot(loop):
+    """Metrics of every bot served by loop, by nick@server."""
+    bots = {}
+    for dispatcher in loop.map.values():
+        metrics = getattr(dispatcher, 'metrics', None)
+        if isinstance(metrics, Metrics):
+            name = '{}@{}'.format(dispatcher.nick,
+                                  getattr(dispatcher, 'host', '?'))
+            bots[name] = metrics.snapshot()
+    return {'bots': bots}
+
+
+class MetricsServer(asyncore.dispatcher):
+    """HTTP endpoint serving the metrics of the bots of a loop."""
+    background = True  # does not keep the loop alive
+
+    def __init__(self, loop, port, host='127.0.0.1', snapshot=None):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.map = loop.map
+        if snapshot is None:
+            snapshot = lambda: bots_snapshot(loop)
+        self.snapshot = snapshot
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Request(pair[0], self)
+
+
+def serve(loop, port, host='127.0.0.1', snapshot=None):
+    """Serve the metrics of the bots of loop over HTTP on host:port.
+
+    Only bind to localhost unless the network is trusted: metrics include
+    nicks and channels names.
+
+    :keyword snapshot: function returning what to serve instead of the
+                       metrics of the bots of loop (see supervisor.py)
+
+    """
+    return MetricsServer(loop, port, host, snapshot)
+
+
+def format_duration(seconds):
+    """Short human-readable duration, e.g. '250us', '12.5ms' or '2.0s'."""
+    if seconds < 1e-3:
+        return '{:.0f}us'.format(seconds * 1e6)
+    if seconds < 1:
+        return '{:.1f}ms'.format(seconds * 1e3)
+    return '{:.1f}s'.format(seconds)
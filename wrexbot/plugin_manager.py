@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Plugins discovery, lazy loading and hot reload.
+
+Plugin modules are not imported to be discovered: their source is parsed
+once into a manifest listing each plugin class and the commands it handles
+(as long as they are set with literal dicts in __init__, see example.py).
+Plugins are then only imported and created when a line they handle is
+received for the first time, and can be reloaded from their file without
+restarting the bot (and thus without reconnecting).
+
+Plugins which must be running before they receive anything (e.g. because
+they schedule tasks) can opt out with a class attribute: lazy = False.
+
+"""
+
+import ast
+import importlib
+import logging
+import os
+
+COMMANDS_ATTRIBUTES = ('commands', 'user_commands', 'admin_commands')
+NOT_PLUGINS = ('__init__.py', 'plugin_base.py')
+HERE = os.path.dirname(os.path.abspath(__file__))  # before any chdir
+
+
+class PluginInfo(object):
+    """Manifest entry of a plugin class."""
+    __slots__ = ('name', 'module', 'path', 'mtime', 'lazy', 'commands',
+                 'custom_commands')
+
+    def __init__(self, name, module, path, mtime):
+        self.name = name
+        self.module = module
+        self.path = path
+        self.mtime = mtime
+        self.lazy = True
+        self.commands = set()  # None if they cannot be known before import
+        self.custom_commands = set()
+
+
+def _literal_keys(node):
+    """Keys of a dict literal, or of OrderedDict([('key', value), ...])."""
+    if isinstance(node, ast.Dict):
+        items = node.keys
+    elif (isinstance(node, ast.Call) and len(node.args) == 1
+            and isinstance(node.args[0], (ast.List, ast.Tuple))):
+        items = [getattr(item, 'elts', [None])[0] for item in node.args[0].elts]
+    else:
+        return None
+    if not all(isinstance(item, ast.Str) for item in items):
+        return None
+    return [item.s for item in items]
+
+
+def _scan_class(info, node):
+    """Fill info with what plugin class node handles."""
+    for statement in node.body:
+        if (isinstance(statement, ast.Assign)
+                and [getattr(t, 'id', None) for t in statement.targets] == ['lazy']
+                and isinstance(statement.value, ast.Name)):
+            info.lazy = statement.value.id != 'False'
+        if isinstance(statement, ast.FunctionDef) and statement.name == '__init__':
+            for assign in ast.walk(statement):
+                if not isinstance(assign, ast.Assign):
+                    continue
+                for target in assign.targets:
+                    if (isinstance(target, ast.Attribute)
+                            and isinstance(target.value, ast.Name)
+                            and target.value.id == 'self'
+                            and target.attr in COMMANDS_ATTRIBUTES):
+                        keys = _literal_keys(assign.value)
+                        if keys is None:
+                            info.commands = None
+                        elif target.attr == 'commands':
+                            if info.commands is not None:
+                                info.commands.update(keys)
+                        else:
+                            info.custom_commands.update(keys)
+
+
+_scanned = {}  # (path, mtime) -> plugins infos, shared by all bots
+
+
+def scan_module(path, module):
+    """Return the PluginInfo of plugin classes defined in path."""
+    mtime = os.path.getmtime(path)
+    if (path, mtime) in _scanned:
+        return _scanned[path, mtime]
+    with open(path) as source:
+        tree = ast.parse(source.read(), path)
+    infos = []
+    for node in tree.body:
+        bases = [getattr(base, 'id', getattr(base, 'attr', None))
+                 for base in getattr(node, 'bases', [])]
+        if isinstance(node, ast.ClassDef) and 'PluginBase' in bases:
+            info = PluginInfo(node.name, module, path, mtime)
+            _scan_class(info, node)
+            infos.append(info)
+    _scanned[path, mtime] = infos
+    return infos
+
+
+class LazyPlugin(object):
+    """Stand-in for a plugin not imported yet.
+
+    It registers the plugin commands found in the manifest, and replaces
+    itself with the real plugin when it first has something to handle.
+
+    """
+    def __init__(self, manager, info):
+        self.manager = manager
+        self.info = info
+        self.commands = dict.fromkeys(info.commands)
+        self.user_commands = dict.fromkeys(info.custom_commands)
+        self.admin_commands = {}
+
+    def dispatch(self, message):
+        self.manager.resolve(self).dispatch(message)
+
+    def dispatch_custom(self, message, command, params, recipient, admin=False):
+        self.manager.resolve(self).dispatch_custom(message, command, params,
+                                                   recipient, admin)
+
+    def unload(self):
+        pass
+
+
+class PluginManager(object):
+    """Load, unload and reload the plugins of a bot."""
+    def __init__(self, bot, plugin_dir):
+        """Create a manager for bot, finding plugins in package plugin_dir."""
+        self.bot = bot
+        self.plugin_dir = plugin_dir
+        self.path = os.path.join(HERE, plugin_dir)
+        self.manifest = {}  # class name -> PluginInfo
+        self.mtimes = {}  # file path -> mtime when scanned
+        self.scan()
+
+    def scan(self):
+        """Update manifest with the plugin files added or changed since last
+        scan, return the names of plugins whose file changed."""
+        changed = []
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith('.py') or filename in NOT_PLUGINS:
+                continue
+            path = os.path.join(self.path, filename)
+            mtime = os.path.getmtime(path)
+            if self.mtimes.get(path) == mtime:
+                continue
+            self.mtimes[path] = mtime
+            try:
+                infos = scan_module(path, filename[:-3])
+            except SyntaxError:
+                logging.exception('Cannot scan plugin file {}'.format(path))
+                continue
+            for name, info in self.manifest.items():
+                if info.path == path:
+                    del self.manifest[name]
+            for info in infos:
+                self.manifest[info.name] = info
+                changed.append(info.name)
+        return changed
+
+    def find(self, name):
+        """Return (index, plugin) of loaded plugin name, (None, None) if none."""
+        for index, plugin in enumerate(self.bot.plugins):
+            if self.name(plugin) == name:
+                return index, plugin
+        return None, None
+
+    def name(self, plugin):
+        if isinstance(plugin, LazyPlugin):
+            return plugin.info.name
+        return plugin.__class__.__name__
+
+    def plugin_class(self, info, reload_module=False):
+        """Import plugin module if needed and return the plugin class."""
+        module = importlib.import_module('{}.{}'.format(self.plugin_dir,
+                                                        info.module))
+        if reload_module:
+            module = reload(module)
+        return getattr(module, info.name)
+
+    def create(self, info):
+        """Import plugin module if needed and return a new plugin instance."""
+        return self.plugin_class(info)(self.bot)
+
+    def load(self, name, lazy=True):
+        """Load plugin class name, return False if it is unknown or loaded."""
+        if self.find(name)[1] is not None:
+            logging.info('Plugin {} already loaded.'.format(name))
+            return False
+        if name not in self.manifest:
+            self.scan()
+        info = self.manifest.get(name)
+        if info is None:
+            logging.error('Plugin {} not found in {}.'.format(name, self.path))
+            return False
+        if lazy and info.lazy and info.commands is not None:
+            self.bot.plugins.append(LazyPlugin(self, info))
+        else:
+            self.bot.plugins.append(self.create(info))
+        self.bot.update_routes()
+        return True
+
+    def resolve(self, lazy_plugin):
+        """Replace lazy_plugin with the real plugin and return it."""
+        index, plugin = self.find(lazy_plugin.info.name)
+        if plugin is lazy_plugin:
+            logging.info('Loading plugin {}.'.format(lazy_plugin.info.name))
+            plugin = self.create(lazy_plugin.info)
+            self.bot.plugins[index] = plugin
+            self.bot.update_routes()
+        elif plugin is None:  # unloaded meanwhile, the line is handled anyway
+            plugin = self.create(lazy_plugin.info)
+        return plugin
+
+    def unload(self, name):
+        """Unload plugin class name, return False if it was not loaded."""
+        index, plugin = self.find(name)
+        if plugin is None:
+            return False
+        del self.bot.plugins[index]
+        self.bot.update_routes()
+        plugin.unload()
+        return True
+
+    def reload(self, names=None):
+        """Reload plugins names from their file (by default, the loaded
+        plugins whose file changed).
+
+        The module is imported again before the plugin is unloaded: when it
+        fails, the plugin keeps running its previous code. When the new
+        instance fails to start, an instance of the previous class replaces
+        it (the old one is unloaded first, so that two instances never use
+        the same files).
+
+        :return: the names of the plugins reloaded, and the errors of the
+                 ones which could not be, by name
+        :rtype: tuple (list of string, dict)
+
+        """
+        changed = self.scan()
+        if names is None:
+            names = changed
+        reloaded = []
+        failed = {}
+        modules = set()  # reloaded already
+        for name in names:
+            index, plugin = self.find(name)
+            info = self.manifest.get(name)
+            if plugin is None or info is None:
+                continue
+            if (isinstance(plugin, LazyPlugin) and info.lazy
+                    and info.commands is not None):  # not imported yet
+                self.bot.plugins[index] = LazyPlugin(self, info)
+                reloaded.append(name)
+                continue
+            try:
+                plugin_class = self.plugin_class(
+                    info, reload_module=info.module not in modules)
+                modules.add(info.module)
+            except Exception as e:
+                logging.exception('Cannot reload plugin {}'.format(name))
+                failed[name] = '{}: {}'.format(e.__class__.__name__, e)
+                continue
+            plugin.unload()
+            try:
+                self.bot.plugins[index] = plugin_class(self.bot)
+                reloaded.append(name)
+            except Exception as e:
+                logging.exception('Cannot start reloaded plugin {}'.format(name))
+                failed[name] = '{}: {}'.format(e.__class__.__name__, e)
+                if isinstance(plugin, LazyPlugin):
+                    self.bot.plugins[index] = LazyPlugin(self, info)
+                    continue
+                try:
+                    self.bot.plugins[index] = plugin.__class__(self.bot)
+                except Exception:
+                    logging.exception('Cannot restart plugin {}'.format(name))
+                    del self.bot.plugins[index]
+        self.bot.update_routes()
+        return reloaded, failed
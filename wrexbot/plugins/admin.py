@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 """Plugin handling some basic admins commands."""
 
+import os
+import time
 from operator import lt, le, eq, ne, ge, gt
 from collections import OrderedDict
+from metrics import format_duration
 from plugin_base import PluginBase
+from profiler import SamplingProfiler
 
 
 class Admin(PluginBase):
     """Plugin handling basic admin commands."""
+    max_profile = 600  # seconds, longest profiling window
+    profiles_directory = 'profiles'  # of !profile dump files, in data_path
+
     def __init__(self, bot):
         super(Admin, self).__init__(bot)
         # We use an OrederedDict so that when we use .items() to list
@@ -32,27 +39,52 @@ class Admin(PluginBase):
                        'admins',
                        'Show the list of bot admins.')),
             ('admin', (1, lt, self.admin,
-                      'admin [username] [username]...',
-                      'Add one or several bot admins.')),
+                      'admin [nick_or_hostmask] [nick_or_hostmask]...',
+                      'Add one or several bot admins (by hostmask if seen).')),
             ('unadmin', (1, lt, self.unadmin,
-                        'unadmin [username] [username]...',
+                        'unadmin [nick_or_hostmask] [nick_or_hostmask]...',
                         'Remove one or several bot admins.')),
             ('ignores', (0, lt, self.ignores,
                         'ignores',
                         'Show the list of ignored users')),
             ('ignore', (1, lt, self.ignore,
-                       'ignore [username] [username]...',
-                       'Add one or several ignored users.')),
+                       'ignore [nick_or_hostmask] [nick_or_hostmask]...',
+                       'Add one or several ignored users (by hostmask if seen).')),
             ('unignore', (1, lt, self.unignore,
-                         'unignore [username] [username]...',
+                         'unignore [nick_or_hostmask] [nick_or_hostmask]...',
                          'Remove one or several ignored users.')),
+            ('plugins', (0, lt, self.plugins,
+                        'plugins',
+                        'Show the lists of loaded and available plugins.')),
+            ('load', (1, lt, self.load,
+                     'load [Plugin] [Plugin]...',
+                     'Load one or several plugins.')),
+            ('unload', (1, lt, self.unload_plugins,
+                       'unload [Plugin] [Plugin]...',
+                       'Unload one or several plugins.')),
+            ('reload', (0, lt, self.reload,
+                       'reload [Plugin] [Plugin]...',
+                       'Reload plugins from their files (default: changed files).')),
+            ('stats', (1, gt, self.stats,
+                      'stats [lines|dispatch|handlers]',
+                      'Show bot metrics, or the details of one kind.')),
+            ('profile', (1, lt, self.profile,
+                        'profile [start|stop|dump] [seconds|file]',
+                        'Sample the bot for some seconds (default: 60, at '
+                        'most {}), show hot spots and write stacks for '
+                        'flamegraph.pl.'.format(self.max_profile))),
         ])
+        self.profiler = None
+
+    def unload(self):
+        if self.profiler is not None:
+            self.profiler.stop()
 
-    def dispatch(self, sender, command, params, msg, custom=False, admin=False):
+    def dispatch_custom(self, message, command, params, recipient, admin=False):
         """Dispatch according to command and pass the other parameters.
 
-        Base dispatch function is overloaded so we can have a cleaner approach
-        to handle admin commands with usage and help messages.
+        Base dispatch_custom function is overloaded so we can have a cleaner
+        approach to handle admin commands with usage and help messages.
 
         What happens is:
             * we receive an admin command.
@@ -61,20 +93,12 @@ class Admin(PluginBase):
             * if the number of parameters is valid, we call command handler.
 
         """
-        if custom and admin:  # we care only about admin commands
-            recipient = params[0]
-            # In case of PRIVMSG to the bot, answer to the sender
-            # Else respond in channel
-            if recipient == self.bot.nick:
-                recipient = sender
-            parts = msg.split(' ')
-            command = parts[0].lstrip(self.bot.prefix)
-            params = parts[1:]  # can be an empty list
+        if admin:  # we care only about admin commands
             nb_params, operator, handler, usage, help_msg = self.admin_commands[command]
             if operator(len(params), nb_params):
                 self.bot.privmsg(recipient, self.usage(usage))
             else:
-                handler(sender, params, recipient)
+                self.call(handler, recipient, message.nick, params, recipient)
 
     def usage(self, usage):
         return 'Usage: {}{}\n\t'.format(self.bot.prefix, usage)
@@ -98,8 +122,7 @@ class Admin(PluginBase):
         self.bot.privmsg(params[0], ' '.join(params[1:]))
 
     def join(self, sender, params, recipient):
-        for channel in params:
-            self.bot.join(channel)
+        self.bot.join(*params)
 
     def part(self, sender, params, recipient):
         for channel in params:
@@ -108,23 +131,163 @@ class Admin(PluginBase):
     def admins(self, sender, params, recipient):
         self.bot.privmsg(recipient, 'Admins list: {}'.format(' '.join(self.bot.admins)))
 
+    def hostmask(self, name):
+        """Return '*!user@host' if name is the nick of a user on a channel
+        shared with the bot (anybody can take a nick), name otherwise."""
+        user = self.bot.state.user(name)
+        if '!' in name or '@' in name or user is None or not user.host:
+            return name
+        return '*!{}@{}'.format(user.user, user.host)
+
     def admin(self, sender, params, recipient):
         for admin in params:
-            if admin not in self.bot.admins:
-                self.bot.admins.append(admin)
+            self.bot.admins.add(self.hostmask(admin))
 
     def unadmin(self, sender, params, recipient):
         for admin in params:
             self.bot.admins.remove(admin)
+            self.bot.admins.remove(self.hostmask(admin))
 
     def ignores(self, sender, params, recipient):
         self.bot.privmsg(recipient, 'Ignore list: {}'.format(' '.join(self.bot.ignores)))
 
     def ignore(self, sender, params, recipient):
         for ignore in params:
-            if ignore not in self.bot.ignores:
-                self.bot.ignores.append(ignore)
+            self.bot.ignores.add(self.hostmask(ignore))
 
     def unignore(self, sender, params, recipient):
         for ignore in params:
-            self.bot.ignores.remove(ignore)
\ No newline at end of file
+            self.bot.ignores.remove(ignore)
+            self.bot.ignores.remove(self.hostmask(ignore))
+
+    def plugins(self, sender, params, recipient):
+        manager = self.bot.plugin_manager
+        manager.scan()
+        loaded = [manager.name(plugin) for plugin in self.bot.plugins]
+        available = sorted(set(manager.manifest) - set(loaded))
+        self.bot.privmsg(recipient, 'Loaded plugins: {}'.format(' '.join(loaded)))
+        self.bot.privmsg(recipient, 'Available plugins: {}'.format(' '.join(available)))
+
+    def load(self, sender, params, recipient):
+        for plugin in params:
+            if not self.bot.load_plugin(plugin):
+                self.bot.privmsg(recipient, "Plugin '{}' not loaded.".format(plugin))
+
+    def unload_plugins(self, sender, params, recipient):
+        for plugin in params:
+            self.bot.unload_plugin(plugin)
+
+    def reload(self, sender, params, recipient):
+        if params:
+            reloaded, failed = [], {}
+            for plugin in params:
+                plugin_reloaded, plugin_failed = self.bot.reload_plugin(plugin)
+                reloaded += plugin_reloaded
+                failed.update(plugin_failed)
+        else:
+            reloaded, failed = self.bot.reload_plugin()
+        self.bot.privmsg(recipient, 'Reloaded plugins: {}'.format(' '.join(reloaded)))
+        for name, error in sorted(failed.items()):
+            self.bot.privmsg(recipient, 'Cannot reload {}, previous code kept: {}'
+                             .format(name, error))
+
+    def stats(self, sender, params, recipient):
+        metrics = self.bot.metrics
+        kind = params[0] if params else None
+        if kind is None:
+            counters = metrics.counters
+            gauges = metrics.read_gauges()
+            uptime = int(time.time() - metrics.started)
+            connections = counters.get('connections', {})
+            lag = 'unknown' if gauges.get('lag') is None \
+                else format_duration(gauges['lag'])
+            self.bot.privmsg(recipient, 'Up for {}h{:02d}m, {} connection(s) '
+                             '({} reconnection(s)), lag {}, {} error(s).'.format(
+                                 uptime // 3600, uptime // 60 % 60,
+                                 connections.get('connect', 0),
+                                 connections.get('reconnect', 0), lag,
+                                 sum(counters.get('errors', {}).values())))
+            self.bot.privmsg(recipient, 'Lines in: {}'.format(
+                self.top(counters.get('lines_in', {}))))
+            self.bot.privmsg(recipient, 'Lines out: {}'.format(
+                self.top(counters.get('lines_out', {}))))
+            self.bot.privmsg(recipient, 'Send queue: {sendq} line(s) ({sendq_dropped} '
+                             'dropped), workers: {workers_pending} pending.'
+                             .format(**gauges))
+        elif kind == 'lines':
+            for name in ('lines_in', 'lines_out'):
+                self.bot.privmsg(recipient, '{}: {}'.format(
+                    name, self.top(metrics.counters.get(name, {}), None)))
+        elif kind in ('dispatch', 'handlers'):
+            histograms = metrics.histograms.get(kind, {})
+            for name, histogram in sorted(histograms.items(),
+                                          key=lambda item: -item[1].total)[:10]:
+                self.bot.privmsg(recipient, '{}: {} calls, mean {}, p99 {}, max {}'
+                                 .format(name, histogram.count,
+                                         format_duration(histogram.mean()),
+                                         format_duration(histogram.percentile(99)),
+                                         format_duration(histogram.max)))
+        else:
+            self.bot.privmsg(recipient, self.usage(self.admin_commands['stats'][3]))
+
+    def top(self, counter, limit=5):
+        """Total of counter and its top limit keys, e.g. '12 (PRIVMSG 10, PING 2)'."""
+        top = sorted(counter.items(), key=lambda item: -item[1])[:limit]
+        return '{} ({})'.format(sum(counter.values()), ', '.join(
+            '{} {}'.format(key, count) for key, count in top))
+
+    def profile(self, sender, params, recipient):
+        action = params[0]
+        if action == 'start':
+            if self.profiler is not None and self.profiler.running:
+                self.bot.privmsg(recipient, 'Profiler already running.')
+                return
+            try:
+                duration = float(params[1]) if len(params) > 1 else 60.0
+            except ValueError:
+                duration = None
+            if duration is None or not 0 < duration <= self.max_profile:
+                self.bot.privmsg(recipient, self.usage(self.admin_commands['profile'][3]))
+                return
+            # Handlers run in the loop thread: that's the one to sample
+            self.profiler = SamplingProfiler(duration=duration)
+            self.profiler.reported = False
+            self.profiler.start()
+            self.bot.loop.call_later(duration, self.profile_done,
+                                     self.profiler, recipient)
+            self.bot.privmsg(recipient, 'Profiling for {:g}s.'.format(duration))
+        elif self.profiler is None:
+            self.bot.privmsg(recipient, 'Profiler not started.')
+        elif action == 'stop':
+            self.profiler.stop()
+            self.profile_report(self.profiler, recipient)
+        elif action == 'dump':
+            # Only a file name: admins must not write anywhere else
+            filename = os.path.basename(params[1]) if len(params) > 1 \
+                else time.strftime('profile-%Y%m%d-%H%M%S.folded')
+            if filename in ('', '.', '..'):
+                self.bot.privmsg(recipient, self.usage(self.admin_commands['profile'][3]))
+                return
+            directory = self.bot.data_path(self.profiles_directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, filename)
+            self.profiler.dump(path)
+            self.bot.privmsg(recipient, '{} samples written to {}'.format(
+                self.profiler.samples, path))
+        else:
+            self.bot.privmsg(recipient, self.usage(self.admin_commands['profile'][3]))
+
+    def profile_done(self, profiler, recipient):
+        """Report when the sampling window ends, unless stopped before."""
+        if not profiler.reported:
+            profiler.stop()
+            self.profile_report(profiler, recipient)
+
+    def profile_report(self, profiler, recipient):
+        profiler.reported = True
+        elapsed = (profiler.stopped or time.time()) - profiler.started
+        self.bot.privmsg(recipient, '{} samples in {:.1f}s, hot spots:'.format(
+            profiler.samples, elapsed))
+        for label, percent in profiler.top():
+            self.bot.privmsg(recipient, '{:5.1f}% {}'.format(percent, label))
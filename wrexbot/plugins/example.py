@@ -45,8 +45,12 @@ class Example(PluginBase):
         and should use self.bot.{whichever function defined in core.py}
         to interact with the bot and the server it is connected to.
 
+        The bot only passes a line to the plugins which registered its
+        command: if you change the dictionaries after __init__, call
+        self.bot.update_routes() so that the bot knows about it.
+
         For more complex operations, you may even want to overload the dispatch
-        function! An example can be found in admin.py.
+        or dispatch_custom functions! An example can be found in admin.py.
 
         """
         super(Example, self).__init__(bot)
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""Plugin archiving channel messages, with !seen, !last and !grep commands.
+
+Messages are appended to segment files, which are memory-mapped to answer
+queries: the history is never loaded in memory, only the names table and the
+word index of the segment being written are.
+
+!seen only looks at the channels shared by the asker and the bot, !last and
+!grep at the channel they are used in (not in private messages), so that
+nobody reads the channels they are not on.
+
+Archive layout (in History.directory, see WrexBot.data_path):
+    * names.txt: channel and nick names, one per line (id = line number).
+    * NNNNNN.log: messages, one 'timestamp\\tchannel\\tnick\\ttext' per line.
+    * NNNNNN.idx: one (timestamp, channel id, nick id, .log offset) record of
+      4 native unsigned ints per message.
+    * NNNNNN.terms and NNNNNN.post: inverted word index of a segment, written
+      when the segment is full. .terms has one sorted 'word\\tstart\\tcount'
+      line per word, start and count locating the numbers of the messages
+      containing the word in .post (an array of native unsigned ints).
+    * NNNNNN.last: (field, name id, record number) records of 3 native
+      unsigned ints, sorted, giving the last message of each channel (field
+      1) and nick (field 2) of a segment. Written when the segment is full,
+      along with the word index.
+
+"""
+
+import mmap
+import os
+import re
+import struct
+import time
+from array import array
+
+from plugin_base import PluginBase
+from hostmasks import irc_lower
+
+RECORD = struct.Struct('IIII')  # timestamp, channel id, nick id, offset
+LAST = struct.Struct('III')  # field, name id, record number
+CHANNEL, NICK = 1, 2  # fields of RECORD
+WORD = re.compile(r'\w{2,}')
+CHUNK = 4096  # records read at once when scanning .idx files backwards
+
+
+def ago(seconds):
+    """Human readable duration, e.g. '3h12m'."""
+    seconds = int(seconds)
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return '{}d{}h'.format(days, hours)
+    if hours:
+        return '{}h{}m'.format(hours, minutes)
+    return '{}m'.format(minutes)
+
+
+def words(text):
+    """Distinct words of text, lowercased."""
+    return set(WORD.findall(text.lower()))
+
+
+def find_line(data, key):
+    """Binary search key in data, sorted 'key\\tvalue\\n' lines.
+
+    Return value, or None if key is not there.
+
+    """
+    lo, hi = 0, len(data)
+    while lo < hi:
+        newline = data.rfind('\n', lo, (lo + hi) // 2)
+        start = newline + 1 if newline != -1 else lo
+        end = data.find('\n', start)
+        line_key, _, value = data[start:end].partition('\t')
+        if line_key == key:
+            return value
+        if line_key < key:
+            lo = end + 1
+        else:
+            hi = start
+    return None
+
+
+def mmap_file(path):
+    """Read-only memory map of path (None if path is empty)."""
+    with open(path, 'rb') as mapped:
+        if not os.fstat(mapped.fileno()).st_size:
+            return None
+        return mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment(object):
+    """One segment of the archive, read through memory maps."""
+    def __init__(self, path):
+        self.path = path  # without extension
+        self.maps = {}
+
+    def map(self, extension):
+        """Memory map of file path.extension, remapped if it grew."""
+        data = self.maps.get(extension)
+        size = os.path.getsize(self.path + extension)
+        if data is None or len(data) != size:
+            if data is not None:
+                data.close()
+            data = self.maps[extension] = mmap_file(self.path + extension)
+        return data
+
+    def __len__(self):
+        return os.path.getsize(self.path + '.idx') // RECORD.size
+
+    def field(self, number, field):
+        """Return field (CHANNEL or NICK id) of the record of message number."""
+        return RECORD.unpack_from(self.map('.idx'), number * RECORD.size)[field]
+
+    def record(self, number):
+        """Return (timestamp, channel, nick, text) of message number."""
+        log = self.map('.log')
+        offset = RECORD.unpack_from(self.map('.idx'), number * RECORD.size)[3]
+        line = log[offset:log.find('\n', offset)]
+        timestamp, channel, nick, text = line.split('\t', 3)
+        return int(timestamp), channel, nick, text
+
+    def backwards(self, field=None, value=None, end=None):
+        """Yield numbers of records before end (default: all of them), newest
+        first, where field == value."""
+        idx = self.map('.idx')
+        if idx is None:
+            return
+        if end is None:
+            end = len(idx) // RECORD.size
+        while end > 0:
+            start = max(0, end - CHUNK)
+            chunk = array('I')
+            chunk.fromstring(idx[start * RECORD.size:end * RECORD.size])
+            if field is None:
+                for number in range(end - 1, start - 1, -1):
+                    yield number
+            else:
+                values = chunk[field::4]
+                for i in range(len(values) - 1, -1, -1):
+                    if values[i] == value:
+                        yield start + i
+            end = start
+
+    def last(self, field, value):
+        """Number of the last record where field == value (sealed segments
+        only), None if there is none."""
+        if not os.path.exists(self.path + '.last'):  # sealed without one
+            return next(self.backwards(field, value), None)
+        data = self.map('.last')
+        lo, hi = 0, len(data) // LAST.size if data is not None else 0
+        while lo < hi:
+            middle = (lo + hi) // 2
+            line_field, name_id, number = LAST.unpack_from(
+                data, middle * LAST.size)
+            if (line_field, name_id) == (field, value):
+                return number
+            if (line_field, name_id) < (field, value):
+                lo = middle + 1
+            else:
+                hi = middle
+        return None
+
+    def postings(self, word):
+        """Numbers of the records containing word (sealed segments only)."""
+        value = find_line(self.map('.terms') or '', word)
+        if value is None:
+            return array('I')
+        start, count = [int(v) for v in value.split('\t')]
+        postings = array('I')
+        postings.fromstring(self.map('.post')[start * 4:(start + count) * 4])
+        return postings
+
+    def sealed(self):
+        return os.path.exists(self.path + '.terms')
+
+    def close(self):
+        for data in self.maps.values():
+            if data is not None:
+                data.close()
+        self.maps.clear()
+
+
+class Archive(object):
+    """Append-only, segmented messages archive."""
+    def __init__(self, directory, segment_size=16 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Names table
+        self.names = []
+        self.ids = {}
+        names_path = os.path.join(directory, 'names.txt')
+        if os.path.exists(names_path):
+            with open(names_path, 'rb') as names:
+                for name in names.read().splitlines():
+                    self.ids[irc_lower(name)] = len(self.names)
+                    self.names.append(name)
+        self.names_file = open(names_path, 'ab')
+        # Segments
+        self.segments = [Segment(os.path.join(directory, name[:-4]))
+                         for name in sorted(os.listdir(directory))
+                         if name.endswith('.idx')]
+        if not self.segments or self.segments[-1].sealed():
+            self._new_segment()
+        else:
+            self._open_active()
+
+    def _new_segment(self):
+        number = len(self.segments) + 1
+        path = os.path.join(self.directory, '{:06d}'.format(number))
+        open(path + '.log', 'ab').close()
+        open(path + '.idx', 'ab').close()
+        self.segments.append(Segment(path))
+        self._open_active()
+
+    def _open_active(self):
+        """Open the last segment for writing, rebuilding its indexes."""
+        segment = self.segments[-1]
+        # Drop whatever a crash could have left after the last full record
+        records = len(segment)
+        log_size = 0
+        log = segment.map('.log') or ''
+        while records:
+            last = RECORD.unpack_from(segment.map('.idx'),
+                                      (records - 1) * RECORD.size)[3]
+            end = log.find('\n', last)
+            if end != -1:
+                log_size = end + 1
+                break
+            records -= 1  # message not fully written
+        segment.close()
+        with open(segment.path + '.idx', 'r+b') as idx:
+            idx.truncate(records * RECORD.size)
+        with open(segment.path + '.log', 'r+b') as log:
+            log.truncate(log_size)
+        self.log = open(segment.path + '.log', 'ab')
+        self.idx = open(segment.path + '.idx', 'ab')
+        self.log_size = log_size
+        self.records = records
+        self.index = {}  # word -> array of record numbers
+        self.latest = {}  # (field, name id) -> number of its last record
+        idx = segment.map('.idx')
+        for number in range(records):
+            _, channel_id, nick_id, _ = RECORD.unpack_from(idx, number * RECORD.size)
+            self.latest[CHANNEL, channel_id] = number
+            self.latest[NICK, nick_id] = number
+            for word in words(segment.record(number)[3]):
+                self.index.setdefault(word, array('I')).append(number)
+
+    def name_id(self, name, create=True):
+        key = irc_lower(name)
+        name_id = self.ids.get(key)
+        if name_id is None and create:
+            name_id = self.ids[key] = len(self.names)
+            self.names.append(name)
+            self.names_file.write(name + '\n')
+        return name_id
+
+    def append(self, timestamp, channel, nick, text):
+        """Archive a message."""
+        if self.log_size >= self.segment_size:
+            self.seal()
+        channel_id = self.name_id(channel)
+        nick_id = self.name_id(nick)
+        line = '{}\t{}\t{}\t{}\n'.format(int(timestamp), channel, nick, text)
+        self.idx.write(RECORD.pack(int(timestamp), channel_id, nick_id,
+                                   self.log_size))
+        self.log.write(line)
+        self.log_size += len(line)
+        for word in words(text):
+            self.index.setdefault(word, array('I')).append(self.records)
+        self.latest[CHANNEL, channel_id] = self.records
+        self.latest[NICK, nick_id] = self.records
+        self.records += 1
+
+    def flush(self):
+        for archive_file in (self.names_file, self.log, self.idx):
+            archive_file.flush()
+
+    def seal(self):
+        """Write the indexes of the active segment and start a new one."""
+        self.flush()
+        path = self.segments[-1].path
+        with open(path + '.last', 'wb') as last:
+            for (field, name_id), number in sorted(self.latest.iteritems()):
+                last.write(LAST.pack(field, name_id, number))
+        with open(path + '.post', 'wb') as post, open(path + '.terms', 'wb') as terms:
+            start = 0
+            for word in sorted(self.index):
+                postings = self.index[word]
+                postings.tofile(post)
+                terms.write('{}\t{}\t{}\n'.format(word, start, len(postings)))
+                start += len(postings)
+        self.log.close()
+        self.idx.close()
+        self._new_segment()
+
+    def close(self):
+        self.flush()
+        for archive_file in (self.names_file, self.log, self.idx):
+            archive_file.close()
+        for segment in self.segments:
+            segment.close()
+
+    def _last(self, segment, field, value):
+        """Number of the last record of segment where field == value, None
+        if there is none."""
+        if segment is self.segments[-1]:
+            return self.latest.get((field, value))
+        return segment.last(field, value)
+
+    def last_seen(self, nick, channels=None):
+        """Return last (timestamp, channel, nick, text) of nick, or None.
+
+        Only messages of channels are looked at, unless channels is None.
+
+        """
+        nick_id = self.name_id(nick, create=False)
+        if nick_id is None:
+            return None
+        channel_ids = None
+        if channels is not None:
+            channel_ids = set(self.name_id(channel, create=False)
+                              for channel in channels)
+            channel_ids.discard(None)
+            if not channel_ids:
+                return None
+        self.flush()
+        for segment in reversed(self.segments):
+            number = self._last(segment, NICK, nick_id)
+            if number is None:
+                continue
+            if channel_ids is None:
+                return segment.record(number)
+            for number in segment.backwards(NICK, nick_id, number + 1):
+                if segment.field(number, CHANNEL) in channel_ids:
+                    return segment.record(number)
+        return None
+
+    def last(self, channel, count):
+        """Return the last count messages of channel, oldest first."""
+        channel_id = self.name_id(channel, create=False)
+        if channel_id is None:
+            return []
+        self.flush()
+        records = []
+        for segment in reversed(self.segments):
+            number = self._last(segment, CHANNEL, channel_id)
+            if number is None:  # segment without messages of channel
+                continue
+            for number in segment.backwards(CHANNEL, channel_id, number + 1):
+                records.append(segment.record(number))
+                if len(records) == count:
+                    return records[::-1]
+        return records[::-1]
+
+    def grep(self, text, channel=None, count=3, budget=0.5):
+        """Return the last count messages containing text (ignoring case),
+        newest first (in channel only, unless channel is None).
+
+        Only messages containing all words of text are checked, according to
+        the word indexes. Texts without words (e.g. ':)') are looked for by
+        scanning messages backwards. Either way, the search stops after
+        budget seconds.
+
+        """
+        channel_id = None
+        if channel is not None:
+            channel_id = self.name_id(channel, create=False)
+            if channel_id is None:
+                return []
+        needle = text.lower()
+        query = words(text)
+        deadline = time.time() + budget
+        self.flush()
+        found = []
+        for segment in reversed(self.segments):
+            if query:
+                numbers = self._candidates(segment, query)
+            else:
+                numbers = segment.backwards(
+                    None if channel_id is None else CHANNEL, channel_id)
+            for number in numbers:
+                record = segment.record(number)
+                if ((channel is None or irc_lower(record[1]) == irc_lower(channel))
+                        and needle in record[3].lower()):
+                    found.append(record)
+                    if len(found) == count:
+                        return found
+                if time.time() > deadline:
+                    return found
+        return found
+
+    def _candidates(self, segment, query):
+        """Numbers of the records of segment containing all words of query,
+        newest first."""
+        if segment is self.segments[-1]:
+            postings = [self.index.get(word, array('I')) for word in query]
+        else:
+            postings = [segment.postings(word) for word in query]
+        postings.sort(key=len)
+        numbers = set(postings[0])
+        for other in postings[1:]:
+            numbers.intersection_update(other)
+        return sorted(numbers, reverse=True)
+
+
+class History(PluginBase):
+    """Plugin archiving channel messages, with !seen, !last and !grep."""
+    directory = 'history'
+    max_results = 5
+
+    def __init__(self, bot):
+        super(History, self).__init__(bot)
+        self.commands = {'PRIVMSG': self.privmsg}
+        self.user_commands = {'seen': self.seen, 'last': self.last, 'grep': self.grep}
+        self.archive = Archive(self.bot.data_path(self.directory))
+        self.time = None  # of the message being handled, from its time tag
+        self.flush_timer = self.bot.loop.call_every(5, self.flush)
+
+    def flush(self):
+        """Periodically write buffered messages to disk."""
+        self.archive.flush()
+
+    def unload(self):
+        self.flush_timer.cancel()
+        self.archive.close()
+        self.archive = None
+
+    def now(self):
+        return self.bot.now() or time.time()
+
+    def dispatch(self, message):
+        # Archived at their time tag when they have one (e.g. replayed logs)
+        self.time = message.server_time
+        super(History, self).dispatch(message)
+
+    def privmsg(self, sender, params, msg):
+        if params and params[0][:1] in '#&':
+            self.archive.append(self.time or self.now(), params[0], sender, msg)
+
+    def channel(self, recipient):
+        """Channel queries are restricted to (None if asked by PM)."""
+        return recipient if recipient[:1] in '#&' else None
+
+    def seen(self, sender, params, recipient):
+        if not params:
+            self.bot.privmsg(recipient, 'Usage: {}seen nick'.format(self.bot.prefix))
+            return
+        record = self.archive.last_seen(params[0],
+                                        self.bot.state.channels_of(sender))
+        if record is None:
+            self.bot.privmsg(recipient, "I've never seen {}.".format(params[0]))
+        else:
+            timestamp, channel, nick, text = record
+            self.bot.privmsg(recipient, '{} was last seen on {} {} ago: <{}> {}'.format(
+                nick, channel, ago(self.now() - timestamp), nick, text))
+
+    def last(self, sender, params, recipient):
+        channel = self.channel(recipient)
+        if channel is None:
+            return
+        try:
+            count = int(params[0]) if params else self.max_results
+        except ValueError:
+            count = self.max_results
+        for record in self.archive.last(channel, max(1, min(count, self.max_results))):
+            self.reply_record(recipient, record)
+
+    def grep(self, sender, params, recipient):
+        channel = self.channel(recipient)
+        if channel is None:
+            return
+        if not params:
+            self.bot.privmsg(recipient, 'Usage: {}grep text'.format(self.bot.prefix))
+            return
+        found = self.archive.grep(' '.join(params), channel, self.max_results)
+        if not found:
+            self.bot.privmsg(recipient, 'No match.')
+        for record in found:
+            self.reply_record(recipient, record)
+
+    def reply_record(self, recipient, record):
+        timestamp, channel, nick, text = record
+        self.bot.privmsg(recipient, '[{} ago] <{}> {}'.format(
+            ago(self.now() - timestamp), nick, text))
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""Plugin learning from channel messages to babble like the channel does.
+
+Messages train an order-2 Markov chain: for each pair of consecutive words,
+how many times each word came next. The chain answers !babble [word], and
+mentions of the bot (each user gets mention_burst answers at once per
+channel, then one every mention_cooldown seconds).
+
+Words are interned (a word is an int, its position in the vocabulary) and
+transitions are kept in flat arrays rather than in dicts of strings:
+    * the snapshot, written from time to time, holds the transitions sorted
+      by state (pair of words) and is memory-mapped, so startup does not
+      depend on the size of the chain and its pages are shared with the OS
+      cache.
+    * transitions learnt since the snapshot are appended to arrays, linked
+      per state (states being in an array-backed hash table), until the next
+      snapshot merges them (in a worker thread, the bot is not blocked).
+
+Chain layout (in Markov.directory, see WrexBot.data_path):
+    * words.txt: vocabulary, one word per line (id = line number).
+    * chain.bin: header (magic, words, states, edges), then one (first word,
+      second word, first edge, edges) record of 4 native unsigned ints per
+      state, sorted, then one (next word, count) record per edge.
+
+"""
+
+import os
+import random
+import struct
+import threading
+from array import array
+
+from plugin_base import PluginBase
+from history import mmap_file
+from workers import THREAD
+
+MAGIC = 'WMC1'
+HEADER = struct.Struct('4sIII')  # magic, words, states, edges
+STATE = struct.Struct('IIII')  # first word, second word, first edge, edges
+EDGE = struct.Struct('II')  # next word, count
+START, END = 0, 1  # pseudo-words around each message
+NO_EDGE = 0xFFFFFFFF
+
+
+def state_key(first, second):
+    return first << 32 | second
+
+
+class Snapshot(object):
+    """Transitions of a chain snapshot, read through a memory map."""
+    def __init__(self, path):
+        self.data = mmap_file(path) if os.path.exists(path) else None
+        self.states = self.edges_count = 0
+        if self.data is not None:
+            magic, _, self.states, self.edges_count = HEADER.unpack_from(self.data)
+            if magic != MAGIC:
+                raise ValueError('{} is not a chain snapshot'.format(path))
+        self.edges_offset = HEADER.size + self.states * STATE.size
+
+    def edges(self, first, second):
+        """Return [(next word, count)] of state (first, second)."""
+        lo, hi = 0, self.states
+        while lo < hi:
+            middle = (lo + hi) // 2
+            state = STATE.unpack_from(self.data, HEADER.size + middle * STATE.size)
+            if state[:2] == (first, second):
+                return self._edges(state[2], state[3])
+            if state[:2] < (first, second):
+                lo = middle + 1
+            else:
+                hi = middle
+        return []
+
+    def _edges(self, start, count):
+        edges = array('I')
+        offset = self.edges_offset + start * EDGE.size
+        edges.fromstring(self.data[offset:offset + count * EDGE.size])
+        return zip(edges[::2], edges[1::2])
+
+    def __iter__(self):
+        """Yield (state key, [(next word, count)]), sorted by state."""
+        for number in xrange(self.states):
+            first, second, start, count = STATE.unpack_from(
+                self.data, HEADER.size + number * STATE.size)
+            yield state_key(first, second), self._edges(start, count)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+class StateTable(object):
+    """Hash table of state (first word, second word) -> int, in flat arrays.
+
+    Open addressing with linear probing: a state costs 12 bytes (plus free
+    slots) instead of the hundred or so of a dict item and its int key.
+
+    """
+    def __init__(self, size=1024):
+        self.firsts = array('I', [NO_EDGE]) * size  # NO_EDGE: free slot
+        self.seconds = array('I', [0]) * size
+        self.values = array('I', [0]) * size
+        self.mask = size - 1
+        self.used = 0
+
+    def __len__(self):
+        return self.used
+
+    def _slot(self, first, second):
+        """Index of the slot of state, or of the free slot where it goes."""
+        hashed = (first * 0x9E3779B1 + second) * 0x85EBCA6B
+        index = (hashed ^ hashed >> 16) & self.mask
+        firsts, seconds = self.firsts, self.seconds
+        while True:
+            slot_first = firsts[index]
+            if slot_first == NO_EDGE or (slot_first == first
+                                         and seconds[index] == second):
+                return index
+            index = (index + 1) & self.mask
+
+    def get(self, first, second, default=None):
+        index = self._slot(first, second)
+        if self.firsts[index] == NO_EDGE:
+            return default
+        return self.values[index]
+
+    def set(self, first, second, value):
+        index = self._slot(first, second)
+        if self.firsts[index] == NO_EDGE:
+            if (self.used + 1) * 3 > len(self.firsts) * 2:
+                self._grow()
+                index = self._slot(first, second)
+            self.firsts[index] = first
+            self.seconds[index] = second
+            self.used += 1
+        self.values[index] = value
+
+    def _grow(self):
+        firsts, seconds, values = self.firsts, self.seconds, self.values
+        self.__init__(len(firsts) * 2)
+        for index, first in enumerate(firsts):
+            if first != NO_EDGE:
+                self.set(first, seconds[index], values[index])
+
+    def items(self):
+        """Yield (first word, second word, value), in no particular order."""
+        for index, first in enumerate(self.firsts):
+            if first != NO_EDGE:
+                yield first, self.seconds[index], self.values[index]
+
+
+class Transitions(object):
+    """Transitions learnt since the last snapshot, in flat arrays.
+
+    Each transition seen is appended to a linked list of its state, so that
+    learning costs the same whatever the number of words which can follow a
+    state: counts are only summed up when a snapshot is written.
+
+    """
+    def __init__(self):
+        self.heads = StateTable()  # state -> last transition seen
+        self.words = array('I')
+        self.next = array('I')  # previous transition of the same state
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, first, second, word):
+        self.words.append(word)
+        self.next.append(self.heads.get(first, second, NO_EDGE))
+        self.heads.set(first, second, len(self.words) - 1)
+
+    def extend(self, other):
+        """Add every transition of other (another Transitions)."""
+        for first, second, edge in other.heads.items():
+            for word in other._words(edge):
+                self.add(first, second, word)
+
+    def _words(self, edge):
+        words = self.words
+        next_edges = self.next
+        while edge != NO_EDGE:
+            yield words[edge]
+            edge = next_edges[edge]
+
+    def edges(self, first, second):
+        """Return [(next word, 1)], once per transition seen."""
+        edge = self.heads.get(first, second, NO_EDGE)
+        return [(word, 1) for word in self._words(edge)]
+
+    def __iter__(self):
+        """Yield (state key, [(next word, count)]), sorted by state."""
+        for first, second, edge in sorted(self.heads.items()):
+            counts = {}
+            for word in self._words(edge):
+                counts[word] = counts.get(word, 0) + 1
+            yield state_key(first, second), sorted(counts.items())
+
+
+def merge(base, learnt):
+    """Merge two sorted (state key, edges) iterables."""
+    base, learnt = iter(base), iter(learnt)
+    a, b = next(base, None), next(learnt, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a
+            a = next(base, None)
+        elif a is None or b[0] < a[0]:
+            yield b
+            b = next(learnt, None)
+        else:
+            counts = dict(a[1])
+            for word, count in b[1]:
+                counts[word] = counts.get(word, 0) + count
+            yield a[0], sorted(counts.items())
+            a, b = next(base, None), next(learnt, None)
+
+
+class MarkovChain(object):
+    """Order-2 Markov chain of words."""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.words_path = os.path.join(directory, 'words.txt')
+        self.chain_path = os.path.join(directory, 'chain.bin')
+        self.words = ['', '']  # START, END
+        if os.path.exists(self.words_path):
+            with open(self.words_path, 'rb') as words:
+                self.words = words.read().split('\n')[:-1]
+        self.ids = dict((word, i) for i, word in enumerate(self.words) if i > END)
+        self.snapshot = Snapshot(self.chain_path)
+        self.learning = Transitions()
+        self.saving = None  # transitions being written by a snapshot
+        self.lock = threading.Lock()  # held while writing a snapshot
+
+    def word_id(self, word):
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def learn(self, text):
+        """Train the chain with a message."""
+        first, second = START, START
+        for word in text.split():
+            word_id = self.word_id(word)
+            self.learning.add(first, second, word_id)
+            first, second = second, word_id
+        if second != START:
+            self.learning.add(first, second, END)
+
+    def edges(self, first, second):
+        edges = self.snapshot.edges(first, second)
+        if self.saving is not None:
+            edges += self.saving.edges(first, second)
+        return edges + self.learning.edges(first, second)
+
+    def generate(self, seeds=(), max_words=30):
+        """Return a message, starting with one of seeds if possible."""
+        first, second = START, START
+        words = []
+        for seed in seeds:
+            seed_id = self.ids.get(seed)
+            if seed_id is not None and self.edges(START, seed_id):
+                second = seed_id
+                words.append(seed)
+                break
+        while len(words) < max_words:
+            edges = self.edges(first, second)
+            if not edges:
+                break
+            pick = random.randrange(sum(count for word, count in edges))
+            for word, count in edges:
+                pick -= count
+                if pick < 0:
+                    break
+            if word == END:
+                break
+            words.append(self.words[word])
+            first, second = second, word
+        return ' '.join(words)
+
+    def freeze(self):
+        """Start a snapshot: return the transitions to write with write(),
+        or None if there is nothing to write or a snapshot is running."""
+        if self.saving is not None or not len(self.learning):
+            return None
+        self.saving, self.learning = self.learning, Transitions()
+        return self.saving
+
+    def write(self, frozen):
+        """Write a snapshot including frozen (called from a worker thread)."""
+        with self.lock:
+            if self.saving is not frozen:  # saved by save() meanwhile
+                return
+            self._write(frozen, len(self.words))
+
+    def thaw(self, frozen):
+        """Use the snapshot written by write(frozen)."""
+        if self.saving is frozen:
+            self.saving = None
+            self.snapshot.close()
+            self.snapshot = Snapshot(self.chain_path)
+
+    def unfreeze(self, frozen):
+        """Keep the transitions of a snapshot which could not be written
+        (see freeze), so that the next snapshot writes them."""
+        if self.saving is frozen:
+            learnt = Transitions()
+            learnt.extend(frozen)
+            learnt.extend(self.learning)
+            self.learning = learnt
+            self.saving = None
+
+    def save(self):
+        """Write a snapshot including everything learnt, right away."""
+        with self.lock:
+            learnt = self.learning
+            if self.saving is not None:
+                learnt = merge(self.saving, self.learning)
+            if self.saving is not None or len(self.learning):
+                self._write(learnt, len(self.words))
+            self.saving = None
+            self.learning = Transitions()
+            self.snapshot.close()
+            self.snapshot = Snapshot(self.chain_path)
+
+    def _write(self, learnt, words):
+        states = array('I')
+        edges = array('I')
+        for key, state_edges in merge(self.snapshot, learnt):
+            states.extend((key >> 32, key & 0xFFFFFFFF, len(edges) // 2,
+                           len(state_edges)))
+            for word, count in state_edges:
+                edges.extend((word, count))
+        with open(self.words_path + '.tmp', 'wb') as words_file:
+            words_file.write('\n'.join(self.words[:words]) + '\n')
+        with open(self.chain_path + '.tmp', 'wb') as chain:
+            chain.write(HEADER.pack(MAGIC, words, len(states) // 4,
+                                    len(edges) // 2))
+            states.tofile(chain)
+            edges.tofile(chain)
+        # Words first: words of a chain must always be there
+        os.rename(self.words_path + '.tmp', self.words_path)
+        os.rename(self.chain_path + '.tmp', self.chain_path)
+
+    def close(self):
+        self.save()
+        self.snapshot.close()
+
+
+class Markov(PluginBase):
+    """Plugin babbling like the channel does, on !babble or when mentioned."""
+    directory = 'markov'
+    snapshot_interval = 600  # seconds between two snapshots
+    mention_cooldown = 30.0
+    mention_burst = 2
+
+    def __init__(self, bot):
+        super(Markov, self).__init__(bot)
+        self.commands = {'PRIVMSG': self.privmsg}
+        self.user_commands = {'babble': self.babble}
+        self.chain = MarkovChain(self.bot.data_path(self.directory))
+        self.cooldown('mentions', 1 / self.mention_cooldown, self.mention_burst)
+        self.snapshot_timer = self.bot.loop.call_every(self.snapshot_interval,
+                                                       self.snapshot)
+
+    def snapshot(self):
+        """Periodically merge learnt transitions in the snapshot."""
+        frozen = self.chain.freeze()
+        if frozen is not None:
+            chain = self.chain
+            self.bot.workers.submit(THREAD, chain.write, (frozen,),
+                                    lambda result: chain.thaw(frozen),
+                                    name='Markov.snapshot',
+                                    errback=lambda error: chain.unfreeze(frozen))
+
+    def unload(self):
+        self.snapshot_timer.cancel()
+        self.chain.close()
+        self.chain = None
+
+    def privmsg(self, sender, params, msg):
+        channel = params[0]
+        if channel[:1] not in '#&' or msg.startswith(self.bot.prefix):
+            return
+        words = msg.split()
+        nick = self.bot.nick.lower()
+        mentioned = [w for w in words if w.strip(':,.!?').lower() == nick]
+        if mentioned:
+            if self.allow('mentions', (sender, channel)):
+                seeds = [w for w in words if w not in mentioned]
+                random.shuffle(seeds)
+                self.reply(channel, self.chain.generate(seeds) or None)
+            if words[0] in mentioned:  # 'nick: message', learn the message
+                msg = ' '.join(words[1:])
+        self.chain.learn(msg)
+
+    def babble(self, sender, params, recipient):
+        answer = self.chain.generate(params)
+        self.bot.privmsg(recipient, answer or '...')
@@ -6,6 +6,8 @@ Implementation examples
     * example.py provides a complete dummy plugin for you to read
     * shepard.py may interest you if you're looking for a word trigger plugin
     * admin.py may interest you if you're looking for a custom commands plugin
+    * workers.py explains how to run slow handlers outside of the bot loop
+    * ratelimit.py explains how to keep handlers from flooding channels
 
 
 PEP 8 -- Style Guide for Python Code (and Plugins)
@@ -24,6 +26,10 @@ Examples (formatted as "filename > class name"):
 
 """
 
+import time
+
+from ratelimit import Cooldowns
+
 
 class PluginBase(object):
     """Base class from which plugins should inherit."""
@@ -33,21 +39,108 @@ class PluginBase(object):
         self.commands = {}
         self.user_commands = {}
         self.admin_commands = {}
+        self.cooldowns = {}  # name -> Cooldowns
+
+    def unload(self):
+        """Called when the plugin is unloaded or reloaded.
+
+        Overload it to release what the plugin holds (files, timers...).
+
+        """
+        pass
+
+    def dispatch(self, message):
+        """Dispatch RFC command to its handler and pass the other parameters.
+
+        The bot only calls this method for commands found in self.commands.
+        message is the parsed line (see message.py), handlers get its sender,
+        params and msg parts.
+
+        """
+        # Where answers of offloaded handlers go: channel, or sender if PM
+        recipient = message.params[0] if message.params else message.nick
+        if recipient == self.bot.nick:
+            recipient = message.nick
+        self.call(self.commands[message.command], recipient,
+                  message.nick, message.params, message.trailing)
+
+    def dispatch_custom(self, message, command, params, recipient, admin=False):
+        """Dispatch custom command to its handler and pass the other parameters.
+
+        The bot only calls this method for commands found in self.user_commands
+        or self.admin_commands, after having split the message in command and
+        params and chosen the recipient of the answer.
+
+        """
+        if admin and command in self.admin_commands:
+            self.call(self.admin_commands[command], recipient,
+                      message.nick, params, recipient)
+        elif command in self.user_commands:
+            self.call(self.user_commands[command], recipient,
+                      message.nick, params, recipient)
+
+    def cooldown(self, name, rate, burst=1, maxsize=4096):
+        """Create the cooldowns name, see ratelimit.Cooldowns for parameters.
+
+        Handlers then check them with self.allow(name, key), where key is
+        whatever the limit applies to, e.g. (sender, channel, trigger).
+
+        """
+        self.cooldowns[name] = Cooldowns(rate, burst, maxsize)
+
+    def allow(self, name, key):
+        """Whether an answer keyed by key is allowed by the cooldowns name.
+
+        Denied answers are counted in the 'cooldowns' counter of the bot
+        metrics. Cooldowns run on the clock of the bot (see WrexBot.now).
+
+        """
+        now = self.bot.now()
+        if now is None or self.cooldowns[name].allow(key, now):
+            return True
+        self.bot.metrics.count('cooldowns', name)
+        return False
+
+    def call(self, handler, recipient, *args):
+        """Call handler(*args).
+
+        Handlers decorated with ratelimit.cooldown are not called at all
+        when the sender used them too often in recipient.
+
+        Handlers decorated with workers.offload run in a worker pool instead,
+        and their answer is sent to recipient once they are done. The time
+        spent (until the answer, for offloaded ones) is recorded in the
+        'handlers' histograms of the bot metrics.
+
+        """
+        name = '{}.{}'.format(self.__class__.__name__, handler.__name__)
+        if hasattr(handler, 'cooldown'):
+            if name not in self.cooldowns:
+                self.cooldown(name, *handler.cooldown)
+            if not self.allow(name, (args[0], recipient)):
+                return
+        start = time.time()
+        if not hasattr(handler, 'offload'):
+            try:
+                return handler(*args)
+            finally:
+                self.bot.metrics.observe('handlers', name, time.time() - start)
+        pool, timeout = handler.offload
+
+        def done(answer):
+            self.bot.metrics.observe('handlers', name, time.time() - start)
+            self.reply(recipient, answer)
+
+        def failed(error):
+            self.bot.metrics.count('errors', name)
+        self.bot.workers.submit(pool, handler, args, done, timeout=timeout,
+                                name=name, errback=failed)
 
-    def dispatch(self, sender, command, params, msg, custom=False, admin=False):
-        """Dispatch according to command and pass the other parameters."""
-        if not custom and command in self.commands:
-            self.commands[command](sender, params, msg)
-        elif custom:
-            recipient = params[0]
-            # In case of PRIVMSG to the bot, answer to the sender
-            # Else respond in channel
-            if recipient == self.bot.nick:
-                recipient = sender
-            parts = msg.split(' ')
-            command = parts[0].lstrip(self.bot.prefix)
-            params = parts[1:]  # can be an empty list
-            if admin and command in self.admin_commands:
-                self.admin_commands[command](sender, params, recipient)
-            elif command in self.user_commands:
-                self.user_commands[command](sender, params, recipient)
\ No newline at end of file
+    def reply(self, recipient, answer):
+        """Send answer (None, a string or a list of strings) to recipient."""
+        if answer is None:
+            return
+        if isinstance(answer, basestring):
+            answer = [answer]
+        for line in answer:
+            self.bot.privmsg(recipient, line)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Plugin keeping a quotes database, with !addquote, !quote and !randquote.
+
+    !addquote <Wrex> Shepard.  -> 'Quote #42 added.'
+    !quote 42                  -> quote number 42
+    !quote shepard wrex        -> a random quote containing both words
+    !quote, !randquote         -> a random quote
+    !delquote 42               -> delete quote number 42 (admins only)
+
+Quotes are appended to a journal, and found through an inverted index of
+their words (word -> numbers of the quotes containing it, in an array) kept
+in memory and updated as quotes are added and deleted. The index is written
+from time to time as a snapshot, covering the journal up to some size: at
+startup the snapshot is loaded, and only the journal lines written since
+are replayed. Snapshots are serialized and written by a worker thread, the
+bot is not blocked: it only copies the index dict, and copies the postings
+of a word before changing them while a snapshot holds them.
+
+Database layout (in Quotes.directory, see WrexBot.data_path):
+    * quotes.log: journal, one 'number\\ttimestamp\\tnick\\ttext' line per
+      quote added, one '-number' line per quote deleted.
+    * quotes.idx: snapshot, a marshal dump of a dict: 'journal' (bytes of
+      quotes.log covered), 'count' (quotes), 'offsets' (offset in quotes.log
+      of each quote number, -1 if deleted) and 'index' (word -> numbers of
+      the quotes containing it), arrays being dumped as strings.
+
+"""
+
+import logging
+import marshal
+import os
+import random
+import threading
+import time
+from array import array
+
+from plugin_base import PluginBase
+from history import words
+from ratelimit import cooldown
+from workers import THREAD
+
+VERSION = 1  # of the snapshot format
+MAX_RANDOM_TRIES = 32  # before picking among the live quotes only
+
+
+class QuoteBook(object):
+    """Quotes journal, with an inverted index of their words."""
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.journal_path = os.path.join(directory, 'quotes.log')
+        self.snapshot_path = os.path.join(directory, 'quotes.idx')
+        open(self.journal_path, 'ab').close()
+        self.reader = open(self.journal_path, 'rb')
+        self.offsets = array('l', [-1])  # quote number -> journal offset
+        # word -> numbers of quotes, sorted: array, or its string as loaded
+        # from the snapshot until the word is used
+        self.index = {}
+        self.count = 0
+        self.journal_size = 0
+        self.snapshot_size = 0  # journal bytes covered by the snapshot
+        self.lock = threading.Lock()  # held while writing a snapshot
+        self.frozen = None  # copy of the index a snapshot is written from
+        start = time.time()
+        self._load_snapshot()
+        replayed = self._replay()
+        self.journal = open(self.journal_path, 'ab')
+        logging.info('Loaded %s quotes in %.3fs (%s journal lines replayed)',
+                     self.count, time.time() - start, replayed)
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = marshal.load(snapshot)
+            if data['version'] != VERSION or \
+                    data['journal'] > os.path.getsize(self.journal_path):
+                raise ValueError('snapshot does not match the journal')
+            offsets = array('l')
+            offsets.fromstring(data['offsets'])
+        except (IOError, OSError):  # no snapshot yet
+            return
+        except (EOFError, ValueError, TypeError, KeyError) as e:
+            logging.warning('Ignoring quotes snapshot %s: %s',
+                            self.snapshot_path, e)
+            return
+        self.offsets = offsets
+        self.index = data['index']
+        self.count = data['count']
+        self.journal_size = self.snapshot_size = data['journal']
+
+    def _replay(self):
+        """Apply the journal lines written after the snapshot, return their
+        number."""
+        self.reader.seek(self.journal_size)
+        data = self.reader.read()
+        end = data.rfind('\n') + 1
+        if end < len(data):  # line not fully written before a crash
+            with open(self.journal_path, 'r+b') as journal:
+                journal.truncate(self.journal_size + end)
+        lines = data[:end].splitlines(True)
+        for line in lines:
+            if line.startswith('-'):
+                self._delete(int(line[1:]))
+            else:
+                number, _, _, text = line.rstrip('\n').split('\t', 3)
+                self._add(int(number), self.journal_size, text)
+            self.journal_size += len(line)
+        return len(lines)
+
+    def postings(self, word):
+        """Return the numbers of the quotes containing word, sorted."""
+        postings = self.index.get(word)
+        if isinstance(postings, str):
+            loaded = array('I')
+            loaded.fromstring(postings)
+            postings = self.index[word] = loaded
+        return postings if postings is not None else array('I')
+
+    def _writable(self, word):
+        """postings(word), copied first if a snapshot being written holds
+        them."""
+        postings = self.postings(word)
+        if self.frozen is not None and self.frozen.get(word) is postings:
+            postings = self.index[word] = array('I', postings)
+        return postings
+
+    def _add(self, number, offset, text):
+        while len(self.offsets) <= number:
+            self.offsets.append(-1)
+        self.offsets[number] = offset
+        for word in words(text):
+            if word not in self.index:
+                self.index[word] = array('I')
+            self._writable(word).append(number)
+        self.count += 1
+
+    def _delete(self, number):
+        quote = self.get(number)
+        if quote is None:
+            return
+        for word in words(quote[2]):
+            postings = self._writable(word)
+            postings.remove(number)
+            if not postings:
+                del self.index[word]
+        self.offsets[number] = -1
+        self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def get(self, number):
+        """Return (timestamp, nick, text) of quote number, None if none."""
+        if not 0 < number < len(self.offsets) or self.offsets[number] < 0:
+            return None
+        self.reader.seek(self.offsets[number])
+        _, timestamp, nick, text = \
+            self.reader.readline().rstrip('\n').split('\t', 3)
+        return int(timestamp), nick, text
+
+    def add(self, nick, text, timestamp=None):
+        """Add a quote, return its number."""
+        number = len(self.offsets)
+        text = ' '.join(text.split())  # no tab nor newline in the journal
+        line = '{}\t{}\t{}\t{}\n'.format(number, int(timestamp or time.time()),
+                                         nick, text)
+        self._write(line)
+        self._add(number, self.journal_size - len(line), text)
+        return number
+
+    def delete(self, number):
+        """Delete quote number, return False if there is none."""
+        if self.get(number) is None:
+            return False
+        self._write('-{}\n'.format(number))
+        self._delete(number)
+        return True
+
+    def _write(self, line):
+        self.journal.write(line)
+        self.journal.flush()
+        self.journal_size += len(line)
+
+    def search(self, query):
+        """Return the numbers of the quotes containing every word of query."""
+        postings = sorted((self.postings(word) for word in words(query)),
+                          key=len)
+        if not postings or not postings[0]:
+            return []
+        numbers = set(postings[0])
+        for other in postings[1:]:
+            numbers.intersection_update(other)
+            if not numbers:
+                break
+        return sorted(numbers)
+
+    def random(self):
+        """Return the number of a random quote, None if there is none."""
+        if not self.count:
+            return None
+        for _ in xrange(MAX_RANDOM_TRIES):  # a hit at once, unless most
+            number = random.randrange(1, len(self.offsets))  # are deleted
+            if self.offsets[number] >= 0:
+                return number
+        return random.choice([number for number in xrange(len(self.offsets))
+                              if self.offsets[number] >= 0])
+
+    def freeze(self):
+        """Return (journal size, count, offsets, index) to write with
+        write(), or None if the snapshot is up to date.
+
+        index is a shallow copy of the index, left alone until thaw() is
+        called (see _writable).
+
+        """
+        if self.journal_size == self.snapshot_size:
+            return None
+        self.frozen = dict(self.index)
+        return (self.journal_size, self.count, self.offsets.tostring(),
+                self.frozen)
+
+    def thaw(self, frozen):
+        """Called once the snapshot frozen was written (or failed)."""
+        if self.frozen is frozen[3]:
+            self.frozen = None
+
+    def write(self, journal_size, count, offsets, index):
+        """Serialize and write a snapshot (called from a worker thread)."""
+        with self.lock:
+            if journal_size <= self.snapshot_size:  # newer one written
+                return
+            data = marshal.dumps({
+                'version': VERSION, 'journal': journal_size, 'count': count,
+                'offsets': offsets,
+                'index': dict((word, postings if isinstance(postings, str)
+                               else postings.tostring())
+                              for word, postings in index.iteritems())})
+            with open(self.snapshot_path + '.tmp', 'wb') as snapshot:
+                snapshot.write(data)
+            os.rename(self.snapshot_path + '.tmp', self.snapshot_path)
+            self.snapshot_size = journal_size
+
+    def close(self):
+        frozen = self.freeze()
+        if frozen is not None:
+            self.write(*frozen)
+            self.thaw(frozen)
+        self.journal.close()
+        self.reader.close()
+
+
+class Quotes(PluginBase):
+    """Plugin keeping a quotes database."""
+    directory = 'quotes'
+    snapshot_interval = 600  # seconds between two snapshots
+
+    def __init__(self, bot):
+        super(Quotes, self).__init__(bot)
+        self.user_commands = {'addquote': self.addquote, 'quote': self.quote,
+                              'randquote': self.randquote}
+        self.admin_commands = {'delquote': self.delquote}
+        self.book = QuoteBook(self.bot.data_path(self.directory))
+        self.snapshot_timer = self.bot.loop.call_every(self.snapshot_interval,
+                                                       self.snapshot)
+
+    def snapshot(self):
+        """Periodically write the index, if quotes changed."""
+        book = self.book
+        frozen = book.freeze()
+        if frozen is not None:
+            self.bot.workers.submit(THREAD, book.write, frozen,
+                                    lambda result: book.thaw(frozen),
+                                    name='Quotes.snapshot',
+                                    errback=lambda error: book.thaw(frozen))
+
+    def unload(self):
+        self.snapshot_timer.cancel()
+        self.book.close()
+        self.book = None
+
+    def reply_quote(self, recipient, number, matches=None):
+        timestamp, nick, text = self.book.get(number)
+        self.bot.privmsg(recipient, '#{}{}: {}'.format(
+            number, ' ({} matches)'.format(matches) if matches > 1 else '',
+            text))
+
+    @cooldown(10)
+    def addquote(self, sender, params, recipient):
+        if not params:
+            self.bot.privmsg(recipient, 'Usage: {}addquote text'.format(
+                self.bot.prefix))
+            return
+        number = self.book.add(sender, ' '.join(params))
+        self.bot.privmsg(recipient, 'Quote #{} added.'.format(number))
+
+    def quote(self, sender, params, recipient):
+        if not params:
+            self.randquote(sender, params, recipient)
+        elif len(params) == 1 and params[0].lstrip('#').isdigit():
+            number = int(params[0].lstrip('#'))
+            if self.book.get(number) is None:
+                self.bot.privmsg(recipient, 'No quote #{}.'.format(number))
+            else:
+                self.reply_quote(recipient, number)
+        else:
+            numbers = self.book.search(' '.join(params))
+            if not numbers:
+                self.bot.privmsg(recipient, 'No match.')
+            else:
+                self.reply_quote(recipient, random.choice(numbers), len(numbers))
+
+    def randquote(self, sender, params, recipient):
+        number = self.book.random()
+        if number is None:
+            self.bot.privmsg(recipient, 'No quote yet.')
+        else:
+            self.reply_quote(recipient, number)
+
+    def delquote(self, sender, params, recipient):
+        for param in params:
+            number = param.lstrip('#')
+            if number.isdigit() and self.book.delete(int(number)):
+                self.bot.privmsg(recipient, 'Quote #{} deleted.'.format(number))
+            else:
+                self.bot.privmsg(recipient, 'No quote #{}.'.format(number))
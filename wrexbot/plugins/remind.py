@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Plugin reminding users of something later, with !remind.
+
+    !remind 1h30m tea is ready  -> 'Shepard: tea is ready' in an hour and a half
+    !reminders                  -> your pending reminders, with their numbers
+    !forget 12                  -> cancel reminder number 12
+
+Reminders are kept in the bot store (see store.py), so they survive
+restarts: the plugin is created when the bot starts (lazy = False) and
+schedules the pending ones again. Reminders due while the bot is
+disconnected are sent once it is back.
+
+"""
+
+import re
+import time
+from hostmasks import irc_lower
+from plugin_base import PluginBase
+
+DURATION = re.compile(r'(\d+)([wdhms])')
+UNITS = (('w', 604800), ('d', 86400), ('h', 3600), ('m', 60), ('s', 1))
+
+
+def parse_duration(text):
+    """Seconds in text such as '90s', '10m' or '1d2h30m' (None if invalid)."""
+    text = text.lower()
+    parts = DURATION.findall(text)
+    if not parts or ''.join(n + u for n, u in parts) != text:
+        return None
+    units = dict(UNITS)
+    return sum(int(n) * units[u] for n, u in parts)
+
+
+def format_duration(seconds):
+    """Two biggest units of a duration, e.g. '1d2h', '5m30s' or '45s'."""
+    seconds = int(round(seconds))
+    parts = []
+    for unit, size in UNITS:
+        if seconds >= size or (unit == 's' and not parts):
+            parts.append('{}{}'.format(seconds // size, unit))
+            seconds %= size
+    return ''.join(parts[:2])
+
+
+class Remind(PluginBase):
+    """Plugin reminding users of something later."""
+    lazy = False  # pending reminders are scheduled when the bot starts
+    table = 'reminders'  # store table, keyed by 'bot store key:number'
+    max_delay = 366 * 86400
+    max_per_user = 10
+    retry_delay = 60  # seconds, for reminders due while disconnected
+
+    def __init__(self, bot):
+        super(Remind, self).__init__(bot)
+        self.user_commands = {'remind': self.remind,
+                              'reminders': self.reminders,
+                              'forget': self.forget}
+        self.timers = {}  # key -> Timer
+        self.counts = {}  # lowercased nick -> pending reminders
+        self.next_number = 1
+        for key, reminder in self.bot.store.items(self.table):
+            bot_key, _, number = key.rpartition(':')
+            if bot_key == self.bot.store_key:
+                self.next_number = max(self.next_number, int(number) + 1)
+                self.schedule(key, reminder)
+
+    def unload(self):
+        """Cancel timers, reminders are scheduled again when reloaded."""
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+
+    def key(self, number):
+        return '{}:{}'.format(self.bot.store_key, number)
+
+    def schedule(self, key, reminder):
+        delay = max(0, reminder['when'] - time.time())
+        self.timers[key] = self.bot.loop.call_later(delay, self.fire, key)
+        nick = irc_lower(reminder['nick'])
+        self.counts[nick] = self.counts.get(nick, 0) + 1
+
+    def drop(self, key, reminder):
+        self.bot.store.delete(self.table, key)
+        self.timers.pop(key).cancel()
+        nick = irc_lower(reminder['nick'])
+        self.counts[nick] -= 1
+        if not self.counts[nick]:
+            del self.counts[nick]
+
+    def fire(self, key):
+        reminder = self.bot.store.get(self.table, key)
+        if reminder is None:
+            return
+        if not self.bot.registered:  # reconnecting: try again later
+            self.timers[key] = self.bot.loop.call_later(self.retry_delay,
+                                                        self.fire, key)
+            return
+        self.drop(key, reminder)
+        self.bot.privmsg(reminder['recipient'], '{}: {}'.format(
+            reminder['nick'], reminder['text']))
+
+    def pending(self, nick):
+        """Return the (number, reminder) pairs of nick, soonest first."""
+        nick = irc_lower(nick)
+        found = []
+        for key in self.timers:
+            reminder = self.bot.store.get(self.table, key)
+            if irc_lower(reminder['nick']) == nick:
+                found.append((int(key.rpartition(':')[2]), reminder))
+        found.sort(key=lambda item: item[1]['when'])
+        return found
+
+    def remind(self, sender, params, recipient):
+        delay = parse_duration(params[0]) if len(params) > 1 else None
+        if delay is None:
+            self.bot.privmsg(recipient, 'Usage: {}remind [delay, e.g. 90s, 10m '
+                             'or 1d2h] [message]'.format(self.bot.prefix))
+        elif delay > self.max_delay:
+            self.bot.privmsg(recipient, '{}: that is too far away.'.format(sender))
+        elif self.counts.get(irc_lower(sender), 0) >= self.max_per_user:
+            self.bot.privmsg(recipient, '{}: you already have {} reminders '
+                             'pending.'.format(sender, self.max_per_user))
+        else:
+            number = self.next_number
+            self.next_number += 1
+            reminder = {'when': time.time() + delay, 'recipient': recipient,
+                        'nick': sender, 'text': ' '.join(params[1:])}
+            self.bot.store.set(self.table, self.key(number), reminder)
+            self.schedule(self.key(number), reminder)
+            self.bot.privmsg(recipient, '{}: reminder #{} in {}.'.format(
+                sender, number, format_duration(delay)))
+
+    def reminders(self, sender, params, recipient):
+        pending = self.pending(sender)
+        if not pending:
+            self.bot.privmsg(recipient, '{}: no reminder pending.'.format(sender))
+        now = time.time()
+        for number, reminder in pending:
+            self.bot.privmsg(recipient, '#{} in {}: {}'.format(
+                number, format_duration(reminder['when'] - now),
+                reminder['text']))
+
+    def forget(self, sender, params, recipient):
+        for param in params:
+            key = self.key(param.lstrip('#'))
+            reminder = self.bot.store.get(self.table, key)
+            if key in self.timers and \
+                    irc_lower(reminder['nick']) == irc_lower(sender):
+                self.drop(key, reminder)
+                self.bot.privmsg(recipient, 'Reminder #{} forgotten.'.format(
+                    param.lstrip('#')))
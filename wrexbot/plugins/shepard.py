@@ -1,52 +1,44 @@
 # -*- coding: utf-8 -*-
 """Plugin handling Shepard/Wrex interaction and some other triggers."""
 
-import re
+import os
 import random
 from plugin_base import PluginBase
+from trigger_engine import TriggerEngine
 
 
 class Shepard(PluginBase):
-    """Plugin handling Shepard/Wrex interaction and some other triggers."""
+    """Plugin handling Shepard/Wrex interaction and some other triggers.
+
+    Triggers are defined in triggers_file, see trigger_engine.py for format.
+    Each user gets trigger_burst answers at once per trigger and channel, then
+    one every trigger_cooldown seconds.
+
+    """
+    triggers_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'shepard.json')
+    trigger_cooldown = 30.0
+    trigger_burst = 3
+
     def __init__(self, bot):
         super(Shepard, self).__init__(bot)
         self.commands = {'PRIVMSG': self.privmsg}
+        self.triggers = TriggerEngine.from_file(self.triggers_file)
+        self.cooldown('triggers', 1 / self.trigger_cooldown, self.trigger_burst)
 
     def privmsg(self, sender, params, msg):
-        print (sender, params, msg)
-
         channel = params[0]
         if channel == self.bot.nick:
             channel = sender
-        regex = re.search(r'(?<!\w)(Wrex|Shepard)(?!\w).*?([\W1_]+)?$', msg, re.I+re.U)
-        if regex:
-            shepwrex, term = regex.groups()
-            if re.match(r'Wrex', shepwrex, re.I):
-                shepwrex = 'Shepard'.upper() if shepwrex.isupper() else 'Shepard'
-            else:
-                shepwrex = 'Wrex'.upper() if shepwrex.isupper() else 'Wrex'
-            if term is not None:
-                answer = shepwrex + term
+        for trigger, word, term in self.triggers.search(msg):
+            if not self.allow('triggers', (sender, channel, trigger)):
+                continue
+            if trigger.handler is not None:
+                answer = getattr(self, trigger.handler)()
             else:
-                answer = shepwrex + '.'
+                answer = trigger.answer(word, term)
             self.bot.privmsg(channel, answer)
 
-        regex = re.search(r'(?<!\w)(Ni)(?!\w).*?([\W1_]+)?$', msg, re.I+re.U)
-        if regex:
-            answer = 'Ekke ekke ekke ekke ptangya ziiinnggggggg ni'
-            ni, term = regex.groups()
-            if ni.isupper():
-                answer = answer.upper()
-            if term is not None:
-                answer += term
-            else:
-                answer += '!'
-            self.bot.privmsg(channel, answer)
-
-        regex = re.search(r'(?<!\w)(Hodor(?:(?:at)?ing|e(?:u)?r)?)(?!\w).*?([\W1]+)?$', msg, re.I+re.U)
-        if regex:
-            self.bot.privmsg(channel, self.hodor())
-
     def hodor(self, max_o=3, max_words=3, max_sentences=4):
         """Hoooodoor hodor! Hodor. Hodor? ...Hodor, hodor!!"""
         def get_punctuation(weak=False):
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Word triggers matched in a single pass over messages.
+
+Every trigger word of every trigger is compiled into one Aho-Corasick
+automaton, so the cost of matching a message depends on the message length
+only, whatever the number of triggers.
+
+Triggers are defined in a JSON file, for example:
+    {"triggers": [
+        {"words": {"wrex": "Shepard", "shepard": "Wrex"}, "default_term": "."},
+        {"words": ["ni"], "response": "Ekke ekke ptang", "default_term": "!"},
+        {"words": ["hodor", "hodoring"], "handler": "hodor"}
+    ]}
+
+Where:
+    * words is either a list of words sharing the same response, or a dict
+      of (word: response) pairs. Only the first word found in the message
+      triggers an answer.
+    * response is the answer, in UPPERCASE if the word was in uppercase.
+    * default_term is appended to the answer when the message does not end
+      with punctuation (if it does, the punctuation is echoed instead).
+    * handler is the name of a plugin method returning the answer, used
+      instead of response (no punctuation is added).
+
+Messages are matched as unicode text (utf-8, or latin-1 when they are not
+valid utf-8), so that accented letters are letters, as with re.U regexes:
+'Ni' is found in 'ni !' but not in 'il a nié' nor in 'Niçoise'.
+
+"""
+
+import json
+
+
+def to_str(data):
+    """Encode strings loaded by json as utf-8, like messages received."""
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    elif isinstance(data, dict):
+        return dict((to_str(k), to_str(v)) for k, v in data.items())
+    elif isinstance(data, list):
+        return [to_str(item) for item in data]
+    return data
+
+
+def decode(text):
+    """Return (unicode text, encoding) of utf-8 or latin-1 text."""
+    try:
+        return text.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        return text.decode('latin-1'), 'latin-1'
+
+
+def is_word_char(char):
+    """Same as regex \\w (with re.U)."""
+    return char.isalnum() or char == u'_'
+
+
+def is_term_char(char):
+    """Terminal punctuation (regex [\\W1_], '1' is for '!!!111')."""
+    return not char.isalnum() or char == u'1'
+
+
+def get_term(msg):
+    """Return (term, position) where term is the terminal punctuation of msg."""
+    start = len(msg)
+    while start and is_term_char(msg[start - 1]):
+        start -= 1
+    return msg[start:], start
+
+
+class Trigger(object):
+    """A group of trigger words sharing a common answer."""
+    def __init__(self, words, response=None, default_term='', handler=None):
+        if isinstance(words, dict):
+            self.responses = dict((decode(w)[0].lower(), r)
+                                  for w, r in words.items())
+        else:
+            self.responses = dict((decode(w)[0].lower(), response)
+                                  for w in words)
+        self.default_term = default_term
+        self.handler = handler
+
+    def answer(self, word, term):
+        """Answer to word (as found in the message) ending with term."""
+        word = decode(word)[0]
+        answer = self.responses[word.lower()]
+        if word.isupper():
+            answer = decode(answer)[0].upper().encode('utf-8')
+        return answer + (term or self.default_term)
+
+
+class TriggerEngine(object):
+    """Aho-Corasick automaton over the words of a list of triggers."""
+    def __init__(self, triggers):
+        self.triggers = triggers
+        # Automaton states: transitions, failure links and outputs (list of
+        # (word length, trigger index) pairs of words ending in this state)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for index, trigger in enumerate(triggers):
+            for word in trigger.responses:
+                self._add(word, index)
+        self._link()
+
+    @classmethod
+    def from_file(cls, path):
+        """Load triggers definitions from a JSON file (see module docstring)."""
+        with open(path) as triggers_file:
+            definitions = to_str(json.load(triggers_file))['triggers']
+        return cls([Trigger(**definition) for definition in definitions])
+
+    def _add(self, word, index):
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.out[state].append((len(word), index))
+
+    def _link(self):
+        """Compute failure links, breadth first."""
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, msg):
+        """Return the triggers found in msg, in definition order.
+
+        Each trigger found is returned once, as a (trigger, word, term) tuple,
+        where word is the first of its words found (as written in msg) and
+        term the terminal punctuation of msg following it (None if none).
+
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        msg, encoding = decode(msg)
+        lowered = msg.lower()
+        length = len(msg)
+        found = {}
+        state = 0
+        for end, char in enumerate(lowered, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for word_length, index in out[state]:
+                start = end - word_length
+                if (index in found
+                        or (start and is_word_char(msg[start - 1]))
+                        or (end < length and is_word_char(msg[end]))):
+                    continue
+                found[index] = (msg[start:end], end)
+        if not found:
+            return []
+
+        term, term_start = get_term(msg)
+        matches = []
+        for index in sorted(found):
+            word, end = found[index]
+            word_term = term[max(0, end - term_start):] or None
+            matches.append((self.triggers[index], word.encode(encoding),
+                            word_term and word_term.encode(encoding)))
+        return matches
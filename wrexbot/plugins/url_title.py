@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""Plugin announcing the titles of the web pages linked in messages.
+
+Pages are fetched by a thread pool of the plugin, so the bot loop never
+waits for the network, and slow sites never delay the handlers offloaded
+to the pools of the bot (see workers.py). Fetching stays cheap:
+    * connections are kept alive and reused for the next links to the same
+      site (see ConnectionPool), and at most max_per_host pages of a site
+      are fetched at the same time, the other links waiting in a queue.
+    * only the start of a page is read, until its title or the end of its
+      head, up to max_bytes.
+    * titles are cached for cache_ttl seconds (failures for error_ttl), and
+      a link pasted in ten channels while it is being fetched is fetched
+      once, its title being announced in the ten channels.
+
+Announces are limited per channel with cooldowns (see ratelimit.py).
+
+Links are only followed to public addresses: hosts are resolved before
+connecting, on each redirection, and connections are made to the address
+checked, so that nobody can make the bot query its own network (loopback,
+private, link-local, multicast... addresses are refused). To test with
+benchmarks/fake_httpd.py, which serves test pages locally, set
+UrlTitle.allow_private:
+
+    python benchmarks/fake_httpd.py 8000
+    <Shepard> http://localhost:8000/title/Citadel
+    <Wrex> [localhost] Citadel
+
+"""
+
+import HTMLParser
+import httplib
+import logging
+import re
+import socket
+import threading
+import time
+import urlparse
+from collections import deque
+
+from lru import TTLCache
+from plugin_base import PluginBase
+from workers import THREAD, Workers
+
+URL = re.compile(r'https?://[^\s\x00-\x1f<>"]+', re.I)
+END_OF_TITLE = re.compile(r'</title|</head|<body', re.I)
+TITLE = re.compile(r'<title[^>]*>(.*?)</title', re.I | re.S)
+CHARSET = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+REDIRECTS = (301, 302, 303, 307, 308)
+HEADERS = {'User-Agent': 'WrexBot (+https://github.com/nbusseneau/WrexBot)',
+           'Accept': 'text/html,application/xhtml+xml',
+           'Accept-Encoding': 'identity'}
+
+TIMEOUT = 5.0  # seconds, of each connection, send or receive
+DEADLINE = 10.0  # seconds, to fetch a title (redirections included)
+MAX_REDIRECTS = 3
+CHUNK = 4096  # bytes read at once
+DRAIN_BYTES = 16384  # unread bytes read anyway to reuse the connection
+MAX_IDLE = 2  # idle connections kept per site
+IDLE_TIMEOUT = 30.0  # seconds before idle connections are closed
+MAX_TITLE = 300  # characters
+
+
+def address_bits(family, address):
+    """Binary notation of an IPv4 or IPv6 address, e.g. '0111111100...'."""
+    return ''.join(format(ord(byte), '08b')
+                   for byte in socket.inet_pton(family, address))
+
+
+def networks(family, *cidrs):
+    """Prefixes of address_bits of the networks cidrs."""
+    prefixes = []
+    for cidr in cidrs:
+        network, prefix = cidr.split('/')
+        prefixes.append(address_bits(family, network)[:int(prefix)])
+    return prefixes
+
+
+NOT_PUBLIC = {  # unspecified, loopback, private, link-local, multicast...
+    socket.AF_INET: networks(
+        socket.AF_INET, '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10',
+        '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12', '192.0.0.0/24',
+        '192.168.0.0/16', '198.18.0.0/15', '224.0.0.0/4', '240.0.0.0/4'),
+    socket.AF_INET6: networks(
+        socket.AF_INET6, '::/96', '::1/128', '100::/64', 'fc00::/7',
+        'fe80::/10', 'fec0::/10', 'ff00::/8'),
+}
+IPV4_IN_IPV6 = networks(socket.AF_INET6, '::ffff:0:0/96', '64:ff9b::/96')
+
+
+def is_public(family, address):
+    """Whether address (of family AF_INET or AF_INET6) is public."""
+    bits = address_bits(family, address.partition('%')[0])
+    if family == socket.AF_INET6 and any(bits.startswith(prefix)
+                                         for prefix in IPV4_IN_IPV6):
+        family, bits = socket.AF_INET, bits[96:]
+    return not any(bits.startswith(prefix) for prefix in NOT_PUBLIC[family])
+
+
+def resolve(host, port, allow_private=False):
+    """Return the address to connect to for host, raise ValueError if it
+    has no public one (unless allow_private)."""
+    for family, _, _, _, sockaddr in socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM):
+        if family not in NOT_PUBLIC:
+            continue
+        if allow_private or is_public(family, sockaddr[0]):
+            return sockaddr[0]
+    raise ValueError('{} has no public address'.format(host))
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    """HTTP connection to host, made to an address resolved beforehand."""
+    def __init__(self, host, port, address, timeout):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             self.timeout)
+
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    """HTTPS connection to host, made to an address resolved beforehand
+    (the certificate is still checked against host)."""
+    def __init__(self, host, port, address, timeout):
+        httplib.HTTPSConnection.__init__(self, host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port),
+                                        self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class ConnectionPool(object):
+    """Idle keep-alive HTTP connections, shared by the worker threads."""
+    def __init__(self, timeout=TIMEOUT, max_idle=MAX_IDLE,
+                 idle_timeout=IDLE_TIMEOUT, allow_private=False):
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # (scheme, host, port) -> [(since, connection)]
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def get(self, site):
+        """Return (connection to site, whether it was used before).
+
+        New connections are made to the address site resolves to, raise
+        ValueError if it is not public (unless allow_private).
+
+        """
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(site, [])
+            while idle:
+                since, connection = idle.pop()
+                if now - since < self.idle_timeout:
+                    self.reused += 1
+                    return connection, True
+                connection.close()
+            self.created += 1
+        scheme, host, port = site
+        address = resolve(host, port, self.allow_private)
+        factory = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return factory(host, port, address, self.timeout), False
+
+    def put(self, site, connection):
+        """Keep connection for the next requests to site."""
+        with self.lock:
+            idle = self.idle.setdefault(site, [])
+            if len(idle) < self.max_idle:
+                idle.append((time.time(), connection))
+                return
+        connection.close()
+
+    def release(self, site, connection, response):
+        """Put connection back if response was read (or nearly), close it
+        otherwise."""
+        if not response.isclosed() and response.length is not None \
+                and response.length <= DRAIN_BYTES:
+            response.read()
+        if response.isclosed() and not response.will_close:
+            self.put(site, connection)
+        else:
+            connection.close()
+
+    def request(self, site, path):
+        """GET path from site, return (connection, response).
+
+        A kept-alive connection may have been closed by the server since it
+        was used: the request is then sent again on a new connection.
+
+        """
+        connection, reused = self.get(site)
+        try:
+            connection.request('GET', path, headers=HEADERS)
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+        connection, _ = self.get(site)
+        connection.request('GET', path, headers=HEADERS)
+        return connection, connection.getresponse()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.itervalues():
+                for since, connection in idle:
+                    connection.close()
+            self.idle.clear()
+
+
+def read_head(response, max_bytes, deadline):
+    """Read response until the end of the title or head, up to max_bytes."""
+    data = ''
+    while len(data) < max_bytes and time.time() < deadline:
+        chunk = response.read(min(CHUNK, max_bytes - len(data)))
+        if not chunk:
+            break
+        start = max(0, len(data) - 8)  # the end tag may be split in 2 chunks
+        data += chunk
+        if END_OF_TITLE.search(data, start):
+            break
+    return data
+
+
+def parse_title(head, charset=None):
+    """Return the title in head (utf-8), None if there is none."""
+    match = TITLE.search(head)
+    if match is None:
+        return None
+    if charset is None:
+        match_charset = CHARSET.search(head, 0, match.start())
+        charset = match_charset.group(1) if match_charset else 'utf-8'
+    try:
+        title = match.group(1).decode(charset, 'replace')
+    except LookupError:
+        title = match.group(1).decode('utf-8', 'replace')
+    title = HTMLParser.HTMLParser().unescape(title)
+    # Whitespace and control characters (\r\n included) would break the line
+    title = ''.join(c for c in u' '.join(title.split()) if c >= u' ')
+    if len(title) > MAX_TITLE:
+        title = title[:MAX_TITLE - 3] + u'...'
+    return title.encode('utf-8') or None
+
+
+def fetch_title(pool, url, max_bytes):
+    """Return the title of the page at url (utf-8), None if there is none
+    or it cannot be fetched. Runs in the worker threads."""
+    deadline = time.time() + DEADLINE
+    try:
+        for _ in xrange(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                return None
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            site = (parts.scheme, parts.hostname, port)
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            connection, response = pool.request(site, path)
+            try:
+                if response.status in REDIRECTS:
+                    location = response.getheader('location')
+                    if not location:
+                        return None
+                    url = urlparse.urljoin(url, location)
+                    continue
+                content_type = response.getheader('content-type', '')
+                if response.status != 200 or 'html' not in content_type:
+                    return None
+                charset = CHARSET.search(content_type)
+                return parse_title(read_head(response, max_bytes, deadline),
+                                   charset.group(1) if charset else None)
+            finally:
+                pool.release(site, connection, response)
+    except (httplib.HTTPException, socket.error, ValueError) as e:
+        logging.debug('Cannot fetch %s: %r', url, e)
+    except Exception:  # the title is missing either way
+        logging.exception('Cannot fetch %s', url)
+    return None
+
+
+def find_urls(msg):
+    """Return the http(s) URLs in msg, without trailing punctuation."""
+    urls = []
+    for url in URL.findall(msg):
+        url = url.rstrip('.,;:!?\'')
+        if url.endswith(')') and url.count('(') < url.count(')'):
+            url = url[:-1]
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+class UrlTitle(PluginBase):
+    """Plugin announcing the titles of the web pages linked in messages."""
+    threads = 4  # concurrent fetches
+    max_per_host = 2  # concurrent fetches of a site
+    max_queued = 100  # links waiting for a fetch, later ones are ignored
+    max_urls = 3  # links of a message looked up
+    max_bytes = 65536  # read from a page, at most
+    cache_size = 1024
+    cache_ttl = 3600.0  # seconds
+    error_ttl = 300.0  # seconds, for pages without a title
+    allow_private = False  # follow links to local addresses (for tests only)
+
+    def __init__(self, bot):
+        super(UrlTitle, self).__init__(bot)
+        self.commands = {'PRIVMSG': self.privmsg}
+        self.cooldown('titles', 1 / 5.0, burst=3)  # per channel
+        self.cache = TTLCache(self.cache_size, self.cache_ttl)
+        self.connections = ConnectionPool(allow_private=self.allow_private)
+        self.workers = Workers(self.bot.loop, threads=self.threads)
+        self.waiting = {}  # url -> recipients of its title, while fetched
+        self.active = {}  # host -> fetches running
+        self.queued = {}  # host -> urls waiting for a fetch
+        self.queued_count = 0
+
+    def unload(self):
+        self.waiting.clear()
+        self.queued.clear()
+        self.queued_count = 0
+        self.workers.close()
+        self.connections.close()
+
+    def privmsg(self, sender, params, msg):
+        recipient = params[0] if params and params[0][:1] in '#&' else sender
+        for url in find_urls(msg)[:self.max_urls]:
+            self.lookup(url, recipient)
+
+    def lookup(self, url, recipient):
+        """Announce the title of url to recipient, fetched if not cached."""
+        host = urlparse.urlsplit(url).hostname
+        if not host:
+            return
+        if url in self.cache:
+            self.bot.metrics.count('url_titles', 'cached')
+            self.announce(recipient, host, self.cache.get(url))
+        elif url in self.waiting:
+            if recipient not in self.waiting[url]:
+                self.waiting[url].append(recipient)
+        elif self.active.get(host, 0) < self.max_per_host:
+            self.waiting[url] = [recipient]
+            self.fetch(host, url)
+        elif self.queued_count < self.max_queued:
+            self.waiting[url] = [recipient]
+            self.queued.setdefault(host, deque()).append(url)
+            self.queued_count += 1
+        else:
+            self.bot.metrics.count('url_titles', 'dropped')
+
+    def fetch(self, host, url):
+        self.active[host] = self.active.get(host, 0) + 1
+        self.workers.submit(THREAD, fetch_title,
+                            (self.connections, url, self.max_bytes),
+                            lambda title: self.fetched(host, url, title),
+                            name='UrlTitle.fetch')
+
+    def fetched(self, host, url, title):
+        self.active[host] -= 1
+        if not self.active[host]:
+            del self.active[host]
+        self.bot.metrics.count('url_titles', 'fetched' if title else 'failed')
+        self.cache.put(url, title, None if title else self.error_ttl)
+        for recipient in self.waiting.pop(url, ()):
+            self.announce(recipient, host, title)
+        queue = self.queued.get(host)
+        if queue:
+            self.queued_count -= 1
+            next_url = queue.popleft()
+            if not queue:
+                del self.queued[host]
+            self.fetch(host, next_url)
+
+    def announce(self, recipient, host, title):
+        if title and self.allow('titles', recipient):
+            self.bot.privmsg(recipient, '[{}] {}'.format(host, title))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Sampling profiler, started and stopped while the bot runs.
+
+A thread looks at the stack of the loop thread every few milliseconds, and
+counts how many times each stack was seen: the loop itself is not slowed
+down by tracing hooks, only by the sampler taking the GIL for a moment.
+
+Stacks are written in the collapsed format used by flamegraph.pl and
+speedscope (one 'outer;inner;innermost count' line per stack):
+    flamegraph.pl profile.folded > profile.svg
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler(object):
+    """Sample the stack of a thread for a bounded window."""
+    def __init__(self, thread_id=None, interval=0.005, duration=60.0):
+        """Create a profiler of thread thread_id (default: current thread).
+
+        :keyword interval: seconds between two samples (default=0.005)
+        :type interval: float
+        :keyword duration: seconds after which sampling stops by itself
+                           (default=60.0)
+        :type duration: float
+
+        """
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self.interval = interval
+        self.duration = duration
+        self.stacks = {}  # tuple of frame labels, outermost first -> samples
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._labels = {}  # code object -> label
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return False
+        self._stop.clear()
+        self.started = time.time()
+        self.stopped = None
+        self._thread = threading.Thread(target=self._run, name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def _run(self):
+        deadline = self.started + self.duration
+        while not self._stop.wait(self.interval) and time.time() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:  # thread is gone
+                break
+            self._sample(frame)
+            del frame
+        self.stopped = time.time()
+
+    def _sample(self, frame):
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = '{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        stack = tuple(stack)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def top(self, count=5, idle=('poll', 'poll2')):
+        """Return the count functions most often seen on top of the stack,
+        as (label, percentage of samples), not counting idle functions."""
+        leaves = {}
+        for stack, samples in self.stacks.items():
+            leaves[stack[-1]] = leaves.get(stack[-1], 0) + samples
+        busy = [(label, samples) for label, samples in leaves.items()
+                if label.split(' ', 1)[0] not in idle]
+        busy.sort(key=lambda item: -item[1])
+        return [(label, 100.0 * samples / self.samples)
+                for label, samples in busy[:count]]
+
+    def dump(self, path):
+        """Write collapsed stacks to path."""
+        with open(path, 'w') as output:
+            for stack, samples in sorted(self.stacks.items()):
+                output.write('{} {}\n'.format(';'.join(stack), samples))
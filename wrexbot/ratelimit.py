@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Rate limiting helpers.
+
+TokenBucket paces what the bot sends (see sendqueue.py). Cooldowns keep
+plugins from flooding channels: handlers decorated with cooldown are dropped
+when their sender calls them too often in the same channel:
+
+    @cooldown(30, burst=2)  # twice at once, then once every 30 seconds
+    def quote(self, sender, params, recipient):
+        ...
+
+Handlers needing other keys create cooldowns and check them themselves:
+
+    self.cooldown('triggers', rate=1 / 30.0, burst=2)  # in __init__
+    if self.allow('triggers', (sender, channel, trigger)):
+        ...
+
+Checking a cooldown costs a dictionary lookup and a few operations, so
+suppressed answers are nearly free, as long as the check comes before the
+answer is computed.
+
+"""
+
+import time
+
+
+class TokenBucket(object):
+    """Token bucket: allows burst events at once, then rate events/second."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now=0.0):
+        """Create a full bucket.
+
+        :param rate: tokens added per second
+        :type rate: float
+        :param burst: maximum number of tokens in the bucket
+        :type burst: float
+        :keyword now: current time (default=0.0)
+        :type now: float
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        """Add the tokens earned since last refill."""
+        if now > self.stamp:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def ready(self, now):
+        """Whether a token is available now."""
+        self.refill(now)
+        return self.tokens >= 1
+
+    def consume(self, now, force=False):
+        """Take a token if one is available (or anyway, if force is True).
+
+        Forced consumption can put the bucket in debt, delaying next events.
+
+        """
+        self.refill(now)
+        if self.tokens >= 1 or force:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self, now):
+        """Seconds to wait until a token is available."""
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self, now):
+        """Whether the bucket is full, i.e. it was not used for a while."""
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class Cooldowns(object):
+    """Token buckets by key, e.g. one per (user, channel, trigger).
+
+    At most maxsize buckets are kept: when there are more, full buckets
+    are dropped (they are recreated full when needed), then the longest
+    unused ones if that was not enough. Pruning keeps half of maxsize at
+    most, so its cost is spread over many calls and checking a key stays
+    a dictionary lookup.
+
+    """
+    def __init__(self, rate, burst=1, maxsize=4096):
+        """Create empty cooldowns.
+
+        :param rate: events allowed per second and per key, once the burst
+                     is spent
+        :type rate: float
+        :keyword burst: events allowed at once per key (default=1)
+        :type burst: int
+        :keyword maxsize: maximum number of keys tracked (default=4096)
+        :type maxsize: int
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.buckets = {}
+        self.denied = 0
+
+    def allow(self, key, now=None):
+        """Take a token of the bucket of key, return False if there was none."""
+        if now is None:
+            now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.maxsize:
+                self.prune(now)
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+        if bucket.consume(now):
+            return True
+        self.denied += 1
+        return False
+
+    def prune(self, now):
+        """Drop full buckets, then the longest unused ones, down to half of
+        maxsize."""
+        buckets = self.buckets
+        for key, bucket in buckets.items():
+            if bucket.full(now):
+                del buckets[key]
+        excess = len(buckets) - self.maxsize // 2
+        if excess > 0:
+            oldest = sorted(buckets, key=lambda key: buckets[key].stamp)
+            for key in oldest[:excess]:
+                del buckets[key]
+
+
+def cooldown(seconds, burst=1, maxsize=4096):
+    """Decorator limiting a plugin handler to burst calls at once, then one
+    call every seconds, per (sender, recipient) pair.
+
+    Calls over the limit are dropped before the handler runs (see
+    PluginBase.call).
+
+    :param seconds: seconds between two calls, once the burst is spent
+    :type seconds: float
+    :keyword burst: calls allowed at once (default=1)
+    :type burst: int
+    :keyword maxsize: maximum number of pairs tracked (default=4096)
+    :type maxsize: int
+
+    """
+    def decorator(handler):
+        handler.cooldown = (1.0 / seconds, burst, maxsize)
+        return handler
+    return decorator
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""Replay raw IRC logs through a bot and its plugins, without a network.
+
+Lines are streamed from log files (or stdin) to a ReplayBot, which handles
+them exactly as if they came from its connection (see
+WrexBot.found_terminator), as fast as it can: nothing is rate limited, and
+what the bot sends is written to an output file, one raw line per line
+(without \\r\\n), instead of a socket. Plugins run at the time of the
+lines (see ReplayBot.now), so that the output does not depend on the replay
+speed. Useful to:
+    * backfill the files of plugins (history, Markov chain, quotes...)
+      from years of logs.
+    * regression test plugins: replay a log, then diff the output with the
+      one of a known good version.
+
+Logs are raw lines, as received from the server (':nick!user@host PRIVMSG
+#channel :text'), .gz files being decompressed on the fly. Lines should
+carry an IRCv3 time tag ('@time=2011-10-19T16:40:51.620Z :nick!user@host
+...'): without them, cooldowns are off and history is archived at the time
+of the replay. The bot only
+tracks the channels it joins (see state.py): use the nick the logs were
+recorded with.
+
+With -j N, lines are spread over N worker processes by channel, each one
+replaying its channels with its own bot, writing output.N and keeping the
+plugins files in directory N of --data (lines of no channel, such as QUIT
+or NICK, go to every worker, private messages to the worker of their
+sender). Plugins whose files cover every channel (History, Markov,
+Quotes...) then have one set of files per worker: backfill them with a
+single process.
+
+Usage: python replay.py [-p Plugin,...] [-n nick] [-N network] [-o output]
+                        [-j N] [log ...]
+
+"""
+
+import argparse
+import gzip
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+
+import log
+from core import WrexBot
+from eventloop import EventLoop
+from hostmasks import irc_lower
+
+PUMP_EVERY = 1000  # lines between two runs of the loop (timers, workers)
+BATCH = 2000  # lines sent at once to a worker process
+CHANTYPES = '#&'
+
+
+class ReplayBot(WrexBot):
+    """WrexBot fed with lines by replay(), writing what it sends to a file."""
+    def __init__(self, nick, output, encoding='utf-8', quiet=True, **kwargs):
+        """Create a bot writing its lines to output (a file object), see
+        WrexBot for the other parameters."""
+        self.output = output
+        self.quiet = quiet
+        kwargs.setdefault('loop', EventLoop())
+        kwargs.setdefault('store', ':memory:')
+        WrexBot.__init__(self, nick, **kwargs)
+        self.loop.timeout = 0  # never wait: lines are there already
+        self.encoding = encoding
+        self.registered = True
+        self.time = None  # of the last line with a time tag
+
+    def now(self):
+        """Time of the line being replayed, from the time tags of the lines
+        (None until a line has one)."""
+        return self.time
+
+    def dispatch(self, message):
+        self.time = message.server_time or self.time
+        WrexBot.dispatch(self, message)
+
+    def write(self, *args):
+        """Write the encoded lines sending args to the output file."""
+        key = (self.nick, args)
+        lines = self.encoded.get(key)
+        if lines is None:
+            lines = self.encode_line(args)
+            self.encoded.put(key, lines)
+        self.metrics.count('lines_out', args[0])
+        for line in lines:
+            self.output.write(line + '\n')
+
+    def print_msg(self, sender, recipient, msg):
+        if not self.quiet:
+            WrexBot.print_msg(self, sender, recipient, msg)
+
+    def feed(self, line):
+        """Handle line (without line ending) as if received."""
+        self.collect_incoming_data(line)
+        self.found_terminator()
+
+    def drain(self, timeout=30.0):
+        """Run the loop until offloaded handlers answered (or timeout)."""
+        deadline = time.time() + timeout
+        self.loop.run_once()
+        while self.workers.pending and time.time() < deadline:
+            self.loop.timeout = 0.01
+            self.loop.run_once()
+        self.loop.timeout = 0
+
+    def finish(self):
+        """Drain, then unload plugins so that they write their files."""
+        self.drain()
+        for plugin in self.plugins:
+            plugin.unload()
+        self.plugins = []
+        self.output.flush()
+
+
+def read_lines(paths):
+    """Yield the lines of files paths ('-' for stdin), without line endings."""
+    for path in paths or ['-']:
+        if path == '-':
+            log_file = sys.stdin
+        elif path.endswith('.gz'):
+            log_file = gzip.open(path, 'rb')
+        else:
+            log_file = open(path, 'rb')
+        try:
+            for line in log_file:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+        finally:
+            if log_file is not sys.stdin:
+                log_file.close()
+
+
+def replay(bot, lines):
+    """Feed lines to bot, return the number of lines fed."""
+    count = 0
+    for count, line in enumerate(lines, 1):
+        bot.feed(line)
+        if not count % PUMP_EVERY:
+            bot.loop.run_once()
+    bot.finish()
+    return count
+
+
+def partition_of(line, partitions):
+    """Return the worker of line: by channel, by sender for private
+    messages, None (every worker) for the other lines."""
+    tokens = line.split(' ', 5)
+    if line.startswith('@'):  # message tags
+        tokens = tokens[1:]
+    if not tokens[0].startswith(':'):
+        return None
+    for token in tokens[2:5]:
+        if token.startswith(':'):
+            break
+        if token[:1] in CHANTYPES:
+            return zlib.crc32(irc_lower(token)) % partitions
+    if len(tokens) > 1 and tokens[1] in ('PRIVMSG', 'NOTICE'):
+        nick = tokens[0][1:].partition('!')[0]
+        return zlib.crc32(irc_lower(nick)) % partitions
+    return None
+
+
+def partition(lines, partitions):
+    """Yield (worker, batch of lines, lines read so far) of lines, a batch
+    at a time per worker, lines of every worker being sent to each of them
+    in order."""
+    batches = [[] for _ in xrange(partitions)]
+    count = 0
+    for count, line in enumerate(lines, 1):
+        worker = partition_of(line, partitions)
+        for target in (xrange(partitions) if worker is None else (worker,)):
+            batch = batches[target]
+            batch.append(line)
+            if len(batch) >= BATCH:
+                yield target, batch, count
+                batches[target] = []
+    for target, batch in enumerate(batches):
+        if batch:
+            yield target, batch, count
+
+
+def received(queue):
+    """Yield the lines of the batches received on queue, until None."""
+    for batch in iter(queue.get, None):
+        for line in batch:
+            yield line
+
+
+def worker(number, queue, results, options):
+    """Replay the lines received on queue in data directory number."""
+    directory = os.path.join(options.data, str(number))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    os.chdir(directory)
+    with open('{}.{}'.format(options.output, number), 'wb') as output:
+        bot = make_bot(options, output)
+        results.put((number, replay(bot, received(queue))))
+
+
+def make_bot(options, output):
+    return ReplayBot(options.nick, output, network=options.network,
+                     encoding=options.encoding,
+                     quiet=not options.verbose,
+                     plugins_to_load=options.plugins.split(','),
+                     admins=options.admins.split(',') if options.admins else [])
+
+
+def run(options):
+    """Replay the logs of options, return the number of lines replayed."""
+    lines = read_lines(options.logs)
+    if options.jobs <= 1:
+        output = sys.stdout if options.output == '-' \
+            else open(options.output, 'wb')
+        os.chdir(options.data)
+        try:
+            return replay(make_bot(options, output), lines)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    results = multiprocessing.Queue()
+    queues = [multiprocessing.Queue(64) for _ in xrange(options.jobs)]
+    processes = [multiprocessing.Process(target=worker,
+                                         args=(n, queues[n], results, options))
+                 for n in xrange(options.jobs)]
+    for process in processes:
+        process.start()
+    count = 0
+    for target, batch, count in partition(lines, options.jobs):
+        queues[target].put(batch)
+    for queue in queues:
+        queue.put(None)
+    counts = dict(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    for number in sorted(counts):
+        logging.info('Worker %s replayed %s lines', number, counts[number])
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('logs', nargs='*',
+                        help='files of raw lines, .gz or not (default: stdin)')
+    parser.add_argument('-p', '--plugins', default='Shepard,Admin',
+                        help='plugins to load (default: Shepard,Admin)')
+    parser.add_argument('-n', '--nick', default='WrexBot',
+                        help='nick of the bot, the one the logs were '
+                             'recorded with (default: WrexBot)')
+    parser.add_argument('-N', '--network',
+                        help='network name of the bot, for its plugins files '
+                             'to be the ones of the bot (see '
+                             'WrexBot.data_path)')
+    parser.add_argument('-a', '--admins', default='',
+                        help='admin hostmasks, comma separated')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file of the lines sent by the bot '
+                             '(default: stdout, not with -j)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='worker processes, channels being spread over '
+                             'them (default: 1)')
+    parser.add_argument('-d', '--data', default='.',
+                        help='directory of the plugins files (default: .)')
+    parser.add_argument('-e', '--encoding', default='utf-8',
+                        help='encoding of the logs (default: utf-8)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show logs and messages')
+    options = parser.parse_args(argv)
+    if options.jobs > 1 and options.output == '-':
+        parser.error('-j needs an output file (-o)')
+    options.data = os.path.abspath(options.data)
+    options.output = os.path.abspath(options.output) \
+        if options.output != '-' else '-'
+    options.logs = [os.path.abspath(path) if path != '-' else path
+                    for path in options.logs]
+    # Plugins are imported once in the data directory
+    sys.path[:] = [os.path.abspath(path) for path in sys.path]
+    log.setup(logging.DEBUG if options.verbose else logging.WARNING,
+              stream=sys.stderr)
+    start = time.time()
+    count = run(options)
+    elapsed = time.time() - start
+    sys.stderr.write('Replayed {:,} lines in {:.1f}s ({:,.0f} lines/min)\n'
+                     .format(count, elapsed, count / max(elapsed, 1e-6) * 60))
+
+
+if __name__ == '__main__':
+    main()
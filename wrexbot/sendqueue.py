@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Outbound messages scheduling.
+
+Servers kick clients sending too many lines at once (excess flood), so lines
+are queued and only sent when both the connection and the recipient token
+buckets allow it. Some commands (PONG, NICK, JOIN...) are urgent: they skip
+the queue, so they are never stuck behind a pile of PRIVMSG.
+
+"""
+
+import logging
+from collections import deque, OrderedDict
+
+from ratelimit import TokenBucket
+
+URGENT_COMMANDS = frozenset(['PASS', 'CAP', 'NICK', 'USER', 'PING', 'PONG',
+                             'JOIN'])
+
+
+class SendQueue(object):
+    """Bounded queue of outbound lines with flood control.
+
+    Regular lines are queued per recipient and sent round-robin among
+    recipients, so that one busy channel does not delay all the others.
+    When the queue is full, the oldest line of the longest recipient queue
+    is dropped: a spammy plugin only hurts its own recipient.
+
+    """
+    def __init__(self, rate=0.5, burst=5, target_rate=0.5, target_burst=4,
+                 maxlen=500, max_idle_targets=1000):
+        """Create an empty queue.
+
+        :keyword rate: lines/second allowed on the connection (default=0.5)
+        :keyword burst: lines allowed at once on the connection (default=5)
+        :keyword target_rate: lines/second allowed per recipient (default=0.5)
+        :keyword target_burst: lines allowed at once per recipient (default=4)
+        :keyword maxlen: maximum number of queued regular lines (default=500)
+        :keyword max_idle_targets: number of recipient buckets kept while
+                                   unused (default=1000)
+
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.maxlen = maxlen
+        self.max_idle_targets = max_idle_targets
+        self.urgent = deque()
+        self.targets = OrderedDict()  # recipient -> deque of lines
+        self.target_buckets = {}
+        self.size = 0  # number of regular lines queued
+        self.dropped = 0
+
+    def __len__(self):
+        """Queue depth (urgent and regular lines)."""
+        return len(self.urgent) + self.size
+
+    def put(self, line, command, target=None):
+        """Queue line, return False if some line had to be dropped.
+
+        :param line: encoded line, including line terminator
+        :param command: RFC command of line, e.g. 'PRIVMSG'
+        :param target: recipient, for PRIVMSG and NOTICE
+
+        """
+        if command in URGENT_COMMANDS:
+            self.urgent.append(line)
+            return True
+        self.targets.setdefault(target, deque()).append(line)
+        self.size += 1
+        if self.size <= self.maxlen:
+            return True
+        # Drop the oldest line of the longest queue
+        longest = max(self.targets, key=lambda t: len(self.targets[t]))
+        self.targets[longest].popleft()
+        if not self.targets[longest]:
+            del self.targets[longest]
+        self.size -= 1
+        self.dropped += 1
+        logging.warning('Send queue full ({} lines), dropped a line to '
+                        '{}'.format(self.maxlen, longest))
+        return False
+
+    def clear(self):
+        """Drop every queued line, e.g. when the connection is lost."""
+        self.urgent.clear()
+        self.targets.clear()
+        self.size = 0
+
+    def pop(self, now):
+        """Return (lines, delay): lines which can be sent now, and the delay
+        in seconds before more lines can be sent (None if queue is empty).
+
+        """
+        lines = list(self.urgent)
+        self.urgent.clear()
+        for line in lines:
+            self.bucket.consume(now, force=True)
+
+        blocked = 0  # number of recipients in a row waiting for tokens
+        while self.targets and blocked < len(self.targets):
+            if not self.bucket.ready(now):
+                break
+            target, queue = self.targets.popitem(last=False)
+            bucket = self._target_bucket(target, now)
+            if bucket.consume(now):
+                self.bucket.consume(now)
+                lines.append(queue.popleft())
+                self.size -= 1
+                blocked = 0
+            else:
+                blocked += 1
+            if queue:
+                self.targets[target] = queue  # back to the end of the line
+
+        if not self.targets:
+            return lines, None
+        delay = min(self._target_bucket(t, now).delay(now) for t in self.targets)
+        return lines, max(delay, self.bucket.delay(now))
+
+    def _target_bucket(self, target, now):
+        bucket = self.target_buckets.get(target)
+        if bucket is None:
+            if len(self.target_buckets) >= self.max_idle_targets:
+                # Forget buckets of recipients not used lately
+                for t, b in self.target_buckets.items():
+                    if t not in self.targets and b.full(now):
+                        del self.target_buckets[t]
+            bucket = TokenBucket(self.target_rate, self.target_burst, now)
+            self.target_buckets[target] = bucket
+        return bucket
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""Channels and users the bot can see, updated from the lines it receives.
+
+The bot keeps one User record (nick, user, host) per user, shared by every
+channel the user is on, and per channel a dict of its members (User ->
+status prefixes such as '@', see below) and modes. Plugins query it through
+bot.state:
+
+    bot.state.members('#wrex')  # nicks on #wrex
+    bot.state.hostmask('Skymirrh')  # 'Skymirrh!sky@example.net', or None
+    bot.state.has_status('#wrex', 'Skymirrh', '@')  # channel operator?
+
+Memory stays small on channels of tens of thousands of users:
+    * strings are interned, so a nick or host is stored once whatever the
+      number of channels, lines or records referencing it.
+    * members are dict entries pointing to the shared User, and statuses
+      are interned too (most members share the '' status).
+    * a user is forgotten as soon as they leave the last channel shared
+      with the bot.
+
+NAMES replies are applied line by line as they arrive: a big channel costs
+a few hundred small updates rather than one big rebuild. When names of an
+already known channel are listed again, members not listed anymore are
+dropped once the listing ends.
+
+Multi-prefix and userhost-in-names are requested by the bot when it
+connects (see WrexBot.handle_connect), so that NAMES replies give every
+status and hostmask of the members when the server supports them.
+Otherwise, hostmasks are filled in as members send messages.
+
+"""
+
+import logging
+
+from hostmasks import irc_lower
+
+# Some RFC constants
+RPL_ISUPPORT = '005'
+RPL_CHANNELMODEIS = '324'
+RPL_NAMREPLY = '353'
+RPL_ENDOFNAMES = '366'
+
+
+class User(object):
+    """Somebody on at least one channel shared with the bot."""
+    __slots__ = ('nick', 'user', 'host', 'channels')
+
+    def __init__(self, nick, user='', host=''):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.channels = 0  # number of channels shared with the bot
+
+    @property
+    def hostmask(self):
+        return '{}!{}@{}'.format(self.nick, self.user or '*',
+                                 self.host or '*')
+
+    def __repr__(self):
+        return '<User {}>'.format(self.hostmask)
+
+
+class Channel(object):
+    """A channel the bot is on."""
+    __slots__ = ('name', 'members', 'modes', 'topic', 'synced', 'stale')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # User -> status prefixes, e.g. '' or '@'
+        self.modes = {}  # mode -> argument ('' if none), list modes excluded
+        self.topic = ''
+        self.synced = False  # whether the NAMES listing ended
+        self.stale = None  # members of a previous listing, while relisting
+
+    def __len__(self):
+        return len(self.members)
+
+    def __repr__(self):
+        return '<Channel {} ({} members)>'.format(self.name, len(self.members))
+
+
+class StateTracker(object):
+    """Channels and users seen by a bot."""
+    def __init__(self, bot):
+        self.bot = bot
+        self.channels = {}  # lowercased name -> Channel
+        self.users = {}  # lowercased nick -> User
+        self.statuses = {'': ''}  # status prefixes interned, see status()
+        # Server features (RPL_ISUPPORT), RFC defaults until it is received
+        self.prefixes = '@+'  # status prefixes, highest first
+        self.prefix_modes = 'ov'  # channel modes giving these prefixes
+        self.param_modes = 'beIkl'  # modes with an argument when set
+        self.unset_param_modes = 'beIk'  # modes with an argument when unset
+        self.list_modes = 'beI'  # ban lists and such, not tracked
+        self.chantypes = '#&'
+        # Handlers of the tracked commands, see WrexBot.handlers
+        self.commands = {
+            'JOIN': self.on_join,
+            'PART': self.on_part,
+            'KICK': self.on_kick,
+            'QUIT': self.on_quit,
+            'NICK': self.on_nick,
+            'MODE': self.on_mode,
+            'TOPIC': self.on_topic,
+            RPL_ISUPPORT: self.on_isupport,
+            RPL_CHANNELMODEIS: self.on_channel_mode_is,
+            RPL_NAMREPLY: self.on_names,
+            RPL_ENDOFNAMES: self.on_end_of_names,
+        }
+
+    # Queries
+
+    def channel(self, name):
+        """Return the Channel name, None if the bot is not on it."""
+        return self.channels.get(irc_lower(name))
+
+    def user(self, nick):
+        """Return the User nick, None if not on a channel with the bot."""
+        return self.users.get(irc_lower(nick))
+
+    def members(self, channel):
+        """Return the nicks on channel (empty if the bot is not on it)."""
+        channel = self.channel(channel)
+        if channel is None:
+            return []
+        return [user.nick for user in channel.members]
+
+    def channels_of(self, nick):
+        """Return the names of the channels shared by nick and the bot."""
+        user = self.user(nick)
+        if user is None:
+            return []
+        return [channel.name for channel in self.channels.itervalues()
+                if user in channel.members]
+
+    def is_on(self, channel, nick):
+        user = self.user(nick)
+        channel = self.channel(channel)
+        return user is not None and channel is not None \
+            and user in channel.members
+
+    def has_status(self, channel, nick, prefix='@'):
+        """Whether nick has status prefix (or a higher one) on channel."""
+        user = self.user(nick)
+        channel = self.channel(channel)
+        if user is None or channel is None or user not in channel.members:
+            return False
+        status = channel.members[user]
+        rank = self.prefixes.find(prefix)
+        return any(self.prefixes.find(p) <= rank for p in status)
+
+    def hostmask(self, nick):
+        """Return 'nick!user@host' for nick, None if unknown."""
+        user = self.user(nick)
+        if user is None or not user.host:
+            return None
+        return user.hostmask
+
+    # Records
+
+    def _user(self, nick, user='', host=''):
+        """Return the record of nick, created if needed."""
+        key = irc_lower(nick)
+        record = self.users.get(key)
+        if record is None:
+            record = self.users[intern(key)] = User(intern(nick))
+        if host and (record.host != host or record.user != user):
+            record.user = intern(user)
+            record.host = intern(host)
+        return record
+
+    def _add(self, channel, record, status=''):
+        if record not in channel.members:
+            record.channels += 1
+        channel.members[record] = status
+
+    def _remove(self, channel, record):
+        if channel.members.pop(record, None) is not None:
+            self._release(record)
+
+    def _release(self, record):
+        record.channels -= 1
+        if record.channels <= 0:
+            self.users.pop(irc_lower(record.nick), None)
+
+    def _drop_channel(self, channel):
+        del self.channels[irc_lower(channel.name)]
+        for record in channel.members:
+            self._release(record)
+        for record in channel.stale or ():
+            self._release(record)
+
+    def status(self, prefixes):
+        """Intern status prefixes, ordered from the highest one."""
+        status = self.statuses.get(prefixes)
+        if status is None:
+            ordered = ''.join(p for p in self.prefixes if p in prefixes)
+            status = self.statuses[prefixes] = self.statuses.setdefault(
+                ordered, ordered)
+        return status
+
+    def is_me(self, nick):
+        return irc_lower(nick) == irc_lower(self.bot.nick)
+
+    def is_channel(self, name):
+        return name[:1] in self.chantypes
+
+    def clear(self):
+        """Forget everything, e.g. when the connection is lost."""
+        self.channels.clear()
+        self.users.clear()
+
+    def see(self, message):
+        """Update the hostmask of the sender of message, if known."""
+        record = self.users.get(irc_lower(message.nick))
+        if record is not None and message.host and (
+                record.host != message.host or record.user != message.user):
+            record.user = intern(message.user)
+            record.host = intern(message.host)
+
+    # Handlers
+
+    def on_join(self, message):
+        name = message.params[0] if message.params else message.trailing
+        key = irc_lower(name)
+        channel = self.channels.get(key)
+        if self.is_me(message.nick):
+            if channel is None:
+                channel = self.channels[intern(key)] = Channel(intern(name))
+                self.bot.write('MODE', name)  # answered by RPL_CHANNELMODEIS
+        if channel is not None:
+            record = self._user(message.nick, message.user, message.host)
+            self._add(channel, record)
+
+    def on_part(self, message):
+        channel = self.channel(message.params[0])
+        if channel is None:
+            return
+        if self.is_me(message.nick):
+            self._drop_channel(channel)
+        else:
+            record = self.user(message.nick)
+            if record is not None:
+                self._remove(channel, record)
+
+    def on_kick(self, message):
+        channel = self.channel(message.params[0])
+        if channel is None or len(message.params) < 2:
+            return
+        if self.is_me(message.params[1]):
+            self._drop_channel(channel)
+        else:
+            record = self.user(message.params[1])
+            if record is not None:
+                self._remove(channel, record)
+
+    def on_quit(self, message):
+        record = self.user(message.nick)
+        if record is None:
+            return
+        for channel in self.channels.values():
+            if record in channel.members:
+                self._remove(channel, record)
+
+    def on_nick(self, message):
+        new_nick = message.params[0] if message.params else message.trailing
+        if self.is_me(message.nick):
+            self.bot.nick = new_nick
+        record = self.users.pop(irc_lower(message.nick), None)
+        if record is not None:
+            record.nick = intern(new_nick)
+            self.users[intern(irc_lower(new_nick))] = record
+
+    def on_mode(self, message):
+        args = message.params[1:]
+        if message.trailing:
+            args.append(message.trailing)
+        channel = self.channel(message.params[0])
+        if channel is not None and args:
+            self.apply_modes(channel, args[0], args[1:])
+
+    def on_channel_mode_is(self, message):
+        args = message.params[2:]
+        if message.trailing:
+            args.append(message.trailing)
+        channel = self.channel(message.params[1])
+        if channel is not None and args:
+            self.apply_modes(channel, args[0], args[1:])
+
+    def apply_modes(self, channel, modes, args):
+        """Apply a mode change such as '+ov-k', ['Wrex', 'Shepard', 'key']."""
+        args = iter(args)
+        adding = True
+        for mode in modes:
+            if mode in '+-':
+                adding = mode == '+'
+            elif mode in self.prefix_modes:
+                record = self.user(next(args, ''))
+                if record is not None and record in channel.members:
+                    prefix = self.prefixes[self.prefix_modes.index(mode)]
+                    status = channel.members[record].replace(prefix, '')
+                    if adding:
+                        status += prefix
+                    channel.members[record] = self.status(status)
+            elif mode in self.list_modes:
+                next(args, None)
+            elif adding:
+                arg = next(args, '') if mode in self.param_modes else ''
+                channel.modes[mode] = arg
+            else:
+                if mode in self.unset_param_modes:
+                    next(args, None)
+                channel.modes.pop(mode, None)
+
+    def on_topic(self, message):
+        channel = self.channel(message.params[0])
+        if channel is not None:
+            channel.topic = message.trailing
+
+    def on_isupport(self, message):
+        for token in message.params[1:]:
+            name, _, value = token.partition('=')
+            if name == 'PREFIX' and value.startswith('('):
+                modes, _, prefixes = value[1:].partition(')')
+                if len(modes) == len(prefixes):
+                    self.prefix_modes, self.prefixes = modes, prefixes
+            elif name == 'CHANMODES':
+                groups = (value.split(',') + ['', '', '', ''])[:4]
+                self.list_modes = groups[0]
+                self.unset_param_modes = groups[0] + groups[1]
+                self.param_modes = groups[0] + groups[1] + groups[2]
+            elif name == 'CHANTYPES':
+                self.chantypes = value
+
+    def on_names(self, message):
+        # :server 353 me = #channel :@Wrex +Shepard nick!user@host...
+        if len(message.params) < 3:
+            return
+        channel = self.channel(message.params[2])
+        if channel is None:
+            return
+        if channel.synced:  # listed again: start over, see on_end_of_names
+            channel.synced = False
+            channel.stale = channel.members
+            channel.members = {}
+        prefixes = self.prefixes
+        stale = channel.stale
+        members = channel.members
+        for name in message.trailing.split():
+            start = 0
+            while start < len(name) and name[start] in prefixes:
+                start += 1
+            nick, _, host = name[start:].partition('@')
+            nick, _, user = nick.partition('!')
+            record = self._user(nick, user, host)
+            if stale is not None and stale.pop(record, None) is not None:
+                pass  # already counted in record.channels
+            elif record not in members:
+                record.channels += 1
+            members[record] = self.status(name[:start])
+
+    def on_end_of_names(self, message):
+        if len(message.params) < 2:
+            return
+        channel = self.channel(message.params[1])
+        if channel is None:
+            return
+        channel.synced = True
+        if channel.stale:
+            logging.debug('%s: %s members left during NAMES', channel.name,
+                          len(channel.stale))
+            for record in channel.stale:
+                self._release(record)
+        channel.stale = None
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Key/value store persisting the state of bots and plugins in SQLite.
+
+Values are grouped in tables, e.g. the bot state is in table 'bots', keyed
+by nick. Reads are served from memory, each table being loaded in a single
+query when first used. Writes update memory at once, and are written to the
+database in batches: changes are coalesced for a second, then written in
+one transaction by the thread worker pool, so the loop never waits for the
+disk. Pending changes are also written when the process exits.
+
+    store = bot.store
+    store.set('quotes', '42', {'text': 'Wrex.', 'by': 'Shepard'})
+    store.get('quotes', '42')
+    for key, value in store.items('quotes'):
+        ...
+
+Keys are strings. Values are anything marshal can serialize (numbers,
+strings, lists, tuples, dicts, sets...): plugins keep their own file
+formats for bulk data (see history.py and markov.py), and use the store for
+state which is looked up and updated by key.
+
+Bots of a process share a single store per database file (see get_store).
+
+"""
+
+import atexit
+import logging
+import marshal
+import os
+import sqlite3
+import threading
+
+from workers import THREAD, get_workers
+
+FLUSH_DELAY = 1.0  # seconds changes are coalesced before being written
+DELETED = object()  # placeholder of deleted keys in pending changes
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS kv ('
+          'tbl TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+          'PRIMARY KEY (tbl, key))')
+
+
+class Store(object):
+    """Tables of key/value pairs, cached in memory and written behind."""
+    def __init__(self, path, loop, delay=FLUSH_DELAY):
+        """Open (or create) the store of database file path.
+
+        :param path: SQLite database file (':memory:' to keep nothing)
+        :type path: string
+        :param loop: event loop scheduling the writes
+        :type loop: eventloop.EventLoop
+        :keyword delay: seconds changes are coalesced before being written
+                        (default=FLUSH_DELAY)
+        :type delay: float
+
+        """
+        self.path = path
+        self.loop = loop
+        self.delay = delay
+        self.tables = {}  # name -> {key: value}, loaded on first use
+        self.pending = {}  # (table, key) -> marshalled value or DELETED
+        self.batch = {}  # changes being written by a worker
+        self.scheduled = False
+        self.writing = False
+        self.sequence = 0  # of the last batch taken from pending
+        self.written = 0  # sequence of the last batch written
+        self.lock = threading.Lock()  # the connection is used by 2 threads
+        self.connection = sqlite3.connect(path, timeout=10.0,
+                                          check_same_thread=False)
+        self.connection.text_factory = str
+        if path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def table(self, name):
+        """Return the dict of table name, which must not be changed
+        directly (use set and delete)."""
+        table = self.tables.get(name)
+        if table is None:
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT key, value FROM kv WHERE tbl = ?', (name,))
+                table = dict((key, marshal.loads(str(value)))
+                             for key, value in rows)
+            self.tables[name] = table
+        return table
+
+    def get(self, table, key, default=None):
+        return self.table(table).get(key, default)
+
+    def items(self, table):
+        return self.table(table).items()
+
+    def __contains__(self, table_key):
+        table, key = table_key
+        return key in self.table(table)
+
+    def set(self, table, key, value):
+        """Set key of table to value, written to the database soon.
+
+        Raise ValueError if value cannot be serialized by marshal (nothing
+        is changed then).
+
+        """
+        data = marshal.dumps(value)  # as set now, even if changed later
+        self.table(table)[key] = value
+        self.pending[table, key] = data
+        self.schedule()
+
+    def delete(self, table, key):
+        """Delete key of table (if there), deleted from the database soon."""
+        if self.table(table).pop(key, DELETED) is not DELETED:
+            self.pending[table, key] = DELETED
+            self.schedule()
+
+    def schedule(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_later(self.delay, self.flush)
+
+    def take(self):
+        """Return (sequence, rows to write, keys to delete) of the pending
+        changes, which are not pending anymore."""
+        pending, self.pending = self.pending, {}
+        self.batch = pending
+        self.sequence += 1
+        rows = []
+        deleted = []
+        for (table, key), data in pending.iteritems():
+            if data is DELETED:
+                deleted.append((table, key))
+            else:
+                rows.append((table, key, buffer(data)))
+        return self.sequence, rows, deleted
+
+    def flush(self):
+        """Write pending changes from the thread worker pool."""
+        self.scheduled = False
+        if not self.pending:
+            return
+        if self.writing:  # batches are written one at a time, in order
+            self.schedule()
+            return
+        self.writing = True
+        try:
+            batch = self.take()
+            get_workers(self.loop).submit(
+                THREAD, self.write, batch, self.written_behind,
+                name='Store.write',
+                errback=lambda error: self.written_behind(False))
+        except Exception:
+            logging.exception('Cannot write changes to %s', self.path)
+            self.written_behind(False)
+
+    def written_behind(self, success):
+        self.writing = False
+        if not success:  # try again with the next batch
+            for change, value in self.batch.iteritems():
+                self.pending.setdefault(change, value)
+        self.batch = {}
+        if self.pending:
+            self.schedule()
+
+    def write(self, sequence, rows, deleted):
+        """Write a batch of changes in one transaction, return False if it
+        failed."""
+        with self.lock:
+            if sequence <= self.written or self.connection is None:
+                return True  # superseded, see close
+            try:
+                with self.connection:
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO kv VALUES (?, ?, ?)', rows)
+                    self.connection.executemany(
+                        'DELETE FROM kv WHERE tbl = ? AND key = ?', deleted)
+            except sqlite3.Error:
+                logging.exception('Cannot write %s changes to %s',
+                                  len(rows) + len(deleted), self.path)
+                return False
+            self.written = sequence
+            logging.debug('Wrote %s changes to %s', len(rows) + len(deleted),
+                          self.path)
+            return True
+
+    def close(self):
+        """Write pending changes now and close the database."""
+        if self.connection is None:
+            return
+        if self.pending or self.batch:
+            # Supersedes the batch a worker may not have written yet
+            changes = self.batch
+            changes.update(self.pending)
+            self.pending = changes
+            self.write(*self.take())
+        with self.lock:
+            self.connection.close()
+            self.connection = None
+
+
+_stores = {}
+
+
+def get_store(path, loop):
+    """Return the store of database file path (one per file and process)."""
+    key = os.path.abspath(path) if path != ':memory:' else None
+    if key is None or key not in _stores:
+        store = Store(path, loop)
+        atexit.register(store.close)
+        if key is not None:
+            _stores[key] = store
+        return store
+    return _stores[key]
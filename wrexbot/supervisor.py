@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""Run many bots over several processes from a deployment config.
+
+A single process serves all its connections from one core (see
+eventloop.py). The supervisor spreads connections over worker processes
+instead, restarts workers which die, and keeps what should be global:
+    * admins and ignores: a change made by !admin or !ignore in one worker is
+      sent to the supervisor, which applies it to every other worker (and to
+      workers started later). They start from the config and from what the
+      bots saved in their store when they last ran.
+    * logs: workers send their log records and console output to the
+      supervisor, which writes them all.
+    * metrics: workers send their bots metrics every few seconds, and the
+      supervisor serves them all from a single endpoint (see metrics.py).
+
+Deployment config (JSON):
+
+    {
+        "workers": 4,
+        "admins": ["Skymirrh"],
+        "ignores": [],
+        "plugins": ["Shepard", "Admin"],
+        "metrics_port": 8080,
+        "networks": [
+            {"name": "epiknet", "host": "irc.epiknet.org", "nick": "WrexBot",
+             "channels": ["#wrex", "#shepard"], "max_channels": 50}
+        ]
+    }
+
+host can also be a list of the servers of the network (see
+WrexBot.shepardify). Networks listing more than max_channels channels are
+served by several connections, the extra ones using numbered nicks
+(WrexBot2, WrexBot3...). Connections are then spread over workers by number
+of channels. name (default: the first host) tells apart the saved state and
+plugins files of the bots of each network (see WrexBot.data_path).
+
+Usage: python supervisor.py deployment.json
+
+"""
+
+import asyncore
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import log
+import metrics
+from core import STORE_FILE, WrexBot, bot_key
+from eventloop import EventLoop, get_loop
+from hostmasks import HostmaskIndex
+from plugins.trigger_engine import to_str
+from store import Store
+
+METRICS_INTERVAL = 10.0  # seconds between two metrics reports of a worker
+STABLE_UPTIME = 60.0  # workers running that long are not failing anymore
+MAX_BACKOFF = 300.0  # longest wait before restarting a failing worker
+
+
+def plan(config):
+    """Split config networks in connections and spread them over workers.
+
+    :return: a list of connection specs for each worker
+    :rtype: list of list of dict
+
+    """
+    connections = []
+    for network in config['networks']:
+        channels = network.get('channels', [])
+        size = network.get('max_channels', 50)
+        shards = [channels[i:i + size] for i in range(0, len(channels), size)]
+        host = network['host']
+        name = network.get('name', host if isinstance(host, basestring)
+                           else host[0])
+        for index, shard in enumerate(shards or [[]]):
+            nick = network.get('nick', 'WrexBot')
+            connections.append({
+                'nick': nick + str(index + 1) if index else nick,
+                'network': name,
+                'host': host,
+                'port': network.get('port', 6667),
+                'encoding': network.get('encoding', 'utf-8'),
+                'channels': shard,
+                'plugins': network.get('plugins', config.get('plugins')),
+                'prefix': network.get('prefix', config.get('prefix', '!')),
+            })
+    count = min(config.get('workers') or multiprocessing.cpu_count(),
+                len(connections))
+    workers = [[] for _ in range(count)]
+    loads = [0] * count
+    # Biggest connections first, each to the least loaded worker
+    for connection in sorted(connections, key=lambda c: -len(c['channels'])):
+        index = loads.index(min(loads))
+        workers[index].append(connection)
+        loads[index] += len(connection['channels']) + 1
+    return workers
+
+
+def saved_state(connections, path=STORE_FILE):
+    """Return the admins and ignores saved by the bots of connections in
+    the store at path, as {'admins': [...], 'ignores': [...]}."""
+    state = {'admins': [], 'ignores': []}
+    if not os.path.exists(path):
+        return state
+    store = Store(path, EventLoop())
+    try:
+        for spec in connections:
+            # Bots saved their state by nick only before networks had names
+            for key in (bot_key(spec['nick'], spec['network']), spec['nick']):
+                saved = store.get('bots', key, {})
+                for name in state:
+                    state[name].extend(saved.get(name, []))
+    finally:
+        store.close()
+    return state
+
+
+class ProcessQueueHandler(log.QueueHandler):
+    """QueueHandler sending records to another process.
+
+    Messages are formatted before being sent: their arguments may not be
+    picklable, or mean anything in the other process.
+
+    """
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        log.QueueHandler.emit(self, record)
+
+
+class SharedHostmaskIndex(HostmaskIndex):
+    """HostmaskIndex telling publish(name, action, mask) about its changes."""
+    def __init__(self, name, masks=()):
+        self.name = name
+        self.publish = None  # set once initial masks are added
+        HostmaskIndex.__init__(self, masks)
+
+    def add(self, mask):
+        added = HostmaskIndex.add(self, mask)
+        if added and self.publish is not None:
+            self.publish(self.name, 'add', mask)
+        return added
+
+    def remove(self, mask):
+        removed = HostmaskIndex.remove(self, mask)
+        if removed and self.publish is not None:
+            self.publish(self.name, 'remove', mask)
+        return removed
+
+    def apply(self, action, mask):
+        """Apply a change published by another worker."""
+        getattr(HostmaskIndex, action)(self, mask)
+
+
+class PipeDispatcher(asyncore.dispatcher):
+    """Serve a multiprocessing connection from an event loop."""
+    def __init__(self, loop, connection, handle_message, handle_eof):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.connection = connection
+        self.handle_message = handle_message
+        self.handle_eof = handle_eof
+        self.connected = True  # no handle_connect_event
+        self.closed = False
+        self._fileno = connection.fileno()
+        self.add_channel(loop.map)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            while self.connection.poll():
+                self.handle_message(self.connection.recv())
+        except (EOFError, IOError):
+            self.handle_close()
+
+    def handle_close(self):
+        if not self.closed:
+            self.close()
+            self.handle_eof()
+
+    def send_message(self, message):
+        try:
+            self.connection.send(message)
+        except (EOFError, IOError):
+            pass  # worker died, it will be restarted with the current state
+
+    def close(self):
+        self.closed = True
+        self.del_channel()
+        self.connection.close()
+
+
+def run_worker(connections, state, pipe, log_queue, log_level):
+    """Worker process: serve connections until they are all closed."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops us
+    handler = ProcessQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(log_level)
+    console = logging.getLogger(log.CONSOLE)
+    console.handlers = [handler]
+    console.setLevel(logging.INFO)
+    console.propagate = False
+
+    loop = get_loop()
+    admins = SharedHostmaskIndex('admins', state['admins'])
+    ignores = SharedHostmaskIndex('ignores', state['ignores'])
+    bots = []
+    for spec in connections:
+        bot = WrexBot(spec['nick'], channels=spec['channels'],
+                      plugins_to_load=spec['plugins'], prefix=spec['prefix'],
+                      loop=loop, network=spec['network'])
+        bot.admins = admins
+        bot.ignores = ignores
+        ignores.add(bot.nick)  # bots of the worker ignore each other too
+        bot.shepardify(spec['host'], spec['port'], spec['encoding'], run=False)
+        bots.append(bot)
+
+    def save_state():  # what WrexBot does for its own admins and ignores
+        for bot in bots:
+            bot.save_state()
+    admins.on_change = ignores.on_change = save_state
+
+    def handle_message(message):
+        kind, name, action, mask = message
+        (admins if name == 'admins' else ignores).apply(action, mask)
+
+    def handle_eof():  # supervisor is gone
+        for bot in bots:
+            bot.auto_reconnect = False
+            if bot.socket is not None:
+                bot.close()
+
+    dispatcher = PipeDispatcher(loop, pipe, handle_message, handle_eof)
+    dispatcher.background = True
+    admins.publish = ignores.publish = \
+        lambda *change: dispatcher.send_message(('state',) + change)
+
+    def report_metrics():
+        dispatcher.send_message(('metrics', metrics.bots_snapshot(loop)))
+    loop.call_every(METRICS_INTERVAL, report_metrics)
+    loop.run()
+
+
+class Worker(object):
+    """Supervisor side of a worker process."""
+    def __init__(self, name, connections):
+        self.name = name
+        self.connections = connections
+        self.process = None
+        self.dispatcher = None
+        self.started = None
+        self.failures = 0
+        self.restarts = 0
+        self.metrics = {}
+
+
+class Supervisor(object):
+    """Start, watch and restart the workers of a deployment."""
+    def __init__(self, config):
+        self.config = config
+        self.loop = EventLoop(timeout=1.0)
+        self.workers = [Worker('worker-{}'.format(index + 1), connections)
+                        for index, connections in enumerate(plan(config))]
+        saved = saved_state([spec for worker in self.workers
+                             for spec in worker.connections])
+        self.state = {
+            'admins': HostmaskIndex(config.get('admins', []) + saved['admins']),
+            'ignores': HostmaskIndex(config.get('ignores', []) + saved['ignores']),
+        }
+        self.log_queue = multiprocessing.Queue(config.get('log_queue_size', 10000))
+        self.log_level = getattr(logging, config.get('log_level', 'INFO'))
+        self.stopping = False
+
+    def setup_logging(self):
+        if self.config.get('json_logs'):
+            formatter = log.JsonFormatter()
+        else:
+            formatter = log.Formatter('%(asctime)s %(processName)s %(message)s')
+        self.listener = log.QueueListener(self.log_queue,
+                                          log.StreamWriter(sys.stdout, formatter))
+        self.listener.start()
+        root = logging.getLogger()
+        root.handlers = [ProcessQueueHandler(self.log_queue)]
+        root.setLevel(self.log_level)
+
+    def start(self, worker):
+        if self.stopping:
+            return
+        parent, child = multiprocessing.Pipe()
+        state = dict((name, list(index)) for name, index in self.state.items())
+        worker.process = multiprocessing.Process(
+            target=run_worker, name=worker.name,
+            args=(worker.connections, state, child, self.log_queue,
+                  self.log_level))
+        worker.process.daemon = True
+        worker.process.start()
+        child.close()
+        worker.started = time.time()
+        worker.dispatcher = PipeDispatcher(
+            self.loop, parent,
+            lambda message: self.handle_message(worker, message),
+            lambda: self.handle_exit(worker))
+        logging.info('Started %s (pid %s): %s', worker.name, worker.process.pid,
+                     ', '.join('{nick}@{host}'.format(**c)
+                               for c in worker.connections))
+
+    def handle_message(self, worker, message):
+        if message[0] == 'metrics':
+            worker.metrics = message[1]['bots']
+        elif message[0] == 'state':
+            kind, name, action, mask = message
+            getattr(self.state[name], action)(mask)
+            for other in self.workers:
+                if other is not worker and other.dispatcher is not None:
+                    other.dispatcher.send_message(message)
+
+    def handle_exit(self, worker):
+        """Restart worker, waiting longer each time it fails quickly."""
+        worker.dispatcher = None
+        worker.process.join()
+        if self.stopping:
+            return
+        if time.time() - worker.started > STABLE_UPTIME:
+            worker.failures = 0
+        delay = min(MAX_BACKOFF, 2 ** worker.failures) if worker.failures else 0
+        worker.failures += 1
+        worker.restarts += 1
+        logging.warning('%s exited with code %s, restarting in %ss',
+                        worker.name, worker.process.exitcode, delay)
+        self.loop.call_later(delay, self.start, worker)
+
+    def snapshot(self):
+        """Metrics of every bot, and status of every worker."""
+        bots = {}
+        workers = {}
+        for worker in self.workers:
+            bots.update(worker.metrics)
+            workers[worker.name] = {
+                'pid': worker.process.pid if worker.process else None,
+                'alive': worker.dispatcher is not None,
+                'restarts': worker.restarts,
+                'connections': len(worker.connections),
+                'channels': sum(len(c['channels']) for c in worker.connections),
+            }
+        return {'bots': bots, 'workers': workers}
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        self.setup_logging()
+        if self.config.get('metrics_port'):
+            metrics.serve(self.loop, self.config['metrics_port'],
+                          snapshot=self.snapshot)
+        for worker in self.workers:
+            self.start(worker)
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while not self.stopping:
+                self.loop.run_once()
+        except KeyboardInterrupt:
+            self.stopping = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+        logging.info('Workers stopped.')
+        self.listener.stop()
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as config_file:
+        Supervisor(to_str(json.load(config_file))).run()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Plugin handlers execution in worker pools.
+
+Handlers run in the loop thread by default: a slow one delays every
+connection of the process, PING replies included. Handlers decorated with
+offload run in a thread pool (for blocking I/O) or in a process pool (for
+CPU-bound work) instead, and return their answer rather than sending it:
+
+    @offload('thread', timeout=10)
+    def weather(self, sender, params, recipient):
+        return fetch_weather(params[0])  # blocking call, loop not blocked
+
+The answer (a string, a list of strings or None) is then handed back to the
+loop thread, which sends it to the recipient. Plugin objects cannot be sent
+to worker processes: a process pool handler runs on a bare instance of its
+plugin class (created without calling __init__), so it must only use its
+arguments, not the bot nor the plugin attributes.
+
+"""
+
+import logging
+import traceback
+import types
+from multiprocessing.pool import Pool, ThreadPool
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+def offload(pool=THREAD, timeout=None):
+    """Decorator running a plugin handler in a worker pool.
+
+    :keyword pool: THREAD or PROCESS (default=THREAD)
+    :type pool: string
+    :keyword timeout: seconds after which the answer is dropped (default=None)
+    :type timeout: float
+
+    """
+    if pool not in (THREAD, PROCESS):
+        raise ValueError('Unknown worker pool: {}'.format(pool))
+
+    def decorator(handler):
+        handler.offload = (pool, timeout)
+        return handler
+    return decorator
+
+
+def _run(function, args):
+    """Run function in a worker, catching exceptions so they can be logged."""
+    try:
+        return True, function(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _call_method(cls, name, args):
+    """Call method name of a bare instance of cls (in a worker process)."""
+    return getattr(cls.__new__(cls), name)(*args)
+
+
+class Workers(object):
+    """Thread and process pools, created on first use."""
+    def __init__(self, loop, threads=4, processes=None):
+        """Create pools handing results back to loop.
+
+        :param loop: event loop results are handed back to
+        :type loop: eventloop.EventLoop
+        :keyword threads: thread pool size (default=4)
+        :type threads: int
+        :keyword processes: process pool size (default=number of CPUs)
+        :type processes: int
+
+        """
+        self.loop = loop
+        self.sizes = {THREAD: threads, PROCESS: processes}
+        self.pools = {}
+        self.pending = 0
+
+    def pool(self, kind):
+        if kind not in self.pools:
+            factory = ThreadPool if kind == THREAD else Pool
+            self.pools[kind] = factory(self.sizes[kind])
+        return self.pools[kind]
+
+    def submit(self, kind, function, args, callback, timeout=None, name=None,
+               errback=None):
+        """Run function(*args) in pool kind, then callback(result) in the loop.
+
+        If function raises, or if the result is not there after timeout
+        seconds (the worker cannot be interrupted, its result is dropped),
+        the failure is logged and errback(error message) is called in the
+        loop instead, so that callers can clean up.
+
+        Bound methods run in process pools on a bare instance of their class
+        (see the module documentation).
+
+        """
+        name = name or getattr(function, '__name__', repr(function))
+        if kind == PROCESS and isinstance(function, types.MethodType):
+            function, args = _call_method, (type(function.__self__),
+                                            function.__name__, tuple(args))
+        task = {'done': False, 'timer': None}
+
+        def on_result(result):  # called from a pool thread
+            self.loop.call_soon_threadsafe(self._deliver, task, name, callback,
+                                           errback, result)
+
+        def on_timeout():
+            if not task['done']:
+                task['done'] = True
+                self.pending -= 1
+                logging.warning('{} timed out after {}s, result will be '
+                                'dropped'.format(name, timeout))
+                if errback is not None:
+                    errback('timed out after {}s'.format(timeout))
+
+        self.pending += 1
+        self.pool(kind).apply_async(_run, (function, args), callback=on_result)
+        if timeout is not None:
+            task['timer'] = self.loop.call_later(timeout, on_timeout)
+
+    def _deliver(self, task, name, callback, errback, result):
+        if task['done']:  # timed out
+            return
+        task['done'] = True
+        self.pending -= 1
+        if task['timer'] is not None:
+            task['timer'].cancel()
+        success, value = result
+        if success:
+            callback(value)
+            return
+        logging.error('{} failed:\n{}'.format(name, value))
+        if errback is not None:
+            errback(value)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.terminate()
+        self.pools.clear()
+
+
+_workers = {}
+
+
+def get_workers(loop):
+    """Return the Workers handing results back to loop (one per loop)."""
+    if loop not in _workers:
+        _workers[loop] = Workers(loop)
+    return _workers[loop]